@@ -10,48 +10,128 @@ login_manager = LoginManager()
 def create_app():
     app = Flask(__name__)
     
-    import certifi
-    app.config['MONGODB_SETTINGS'] = {
-        'host': os.getenv('MONGO_URI', 'mongodb://localhost:27017/school_fee_db'),
-        'tlsCAFile': certifi.where()
-    }
+    # Connection profiles: 'default' (primary) and 'reporting' (secondary
+    # preferred, bounded staleness), each with its own pool, timeouts and
+    # compression; see services/connections.py
+    from application.services.connections import connection_settings
+    app.config['MONGODB_SETTINGS'] = connection_settings()
+    # Fee records written per insert_many by bulk fee generation
+    app.config['FEE_GENERATION_CHUNK_SIZE'] = int(os.getenv('FEE_GENERATION_CHUNK_SIZE', 1000))
+    # Rows upserted per bulk_write by the student import
+    app.config['STUDENT_IMPORT_BATCH_SIZE'] = int(os.getenv('STUDENT_IMPORT_BATCH_SIZE', 500))
+    # Rendered receipts are cached on disk ('filesystem') or in GridFS ('gridfs')
+    app.config['RECEIPT_STORE'] = os.getenv('RECEIPT_STORE', 'filesystem')
+    app.config['RECEIPT_CACHE_DIR'] = os.getenv('RECEIPT_CACHE_DIR', os.path.join(app.instance_path, 'receipts'))
+    # Worker processes for batch receipt/statement printing (default: one per
+    # CPU, at most 4)
+    app.config['RECEIPT_BATCH_WORKERS'] = int(os.getenv('RECEIPT_BATCH_WORKERS', 0)) or None
+    # Background jobs: 'thread' (in-process), 'sqlite' or 'redis'; JOB_QUEUE_URL
+    # is the SQLite file or Redis URL
+    app.config['JOB_QUEUE'] = os.getenv('JOB_QUEUE', 'thread')
+    app.config['JOB_QUEUE_URL'] = os.getenv('JOB_QUEUE_URL')
+    app.config['JOB_WORKERS'] = int(os.getenv('JOB_WORKERS', 2))
+    app.config['JOB_MAX_RETRIES'] = int(os.getenv('JOB_MAX_RETRIES', 3))
+    # Record payments in a transaction: 'auto' (when the deployment supports
+    # them), 'on' or 'off'
+    app.config['PAYMENT_TRANSACTIONS'] = os.getenv('PAYMENT_TRANSACTIONS', 'auto')
+    # Receipt numbers: each worker reserves RECEIPT_NUMBER_BLOCK numbers at a
+    # time. RECEIPT_NUMBER_SERIES names the sequence (default: the current
+    # year); RECEIPT_NUMBER_FORMAT may use {series} and {number}.
+    app.config['RECEIPT_NUMBER_BLOCK'] = int(os.getenv('RECEIPT_NUMBER_BLOCK', 50))
+    app.config['RECEIPT_NUMBER_SERIES'] = os.getenv('RECEIPT_NUMBER_SERIES')
+    app.config['RECEIPT_NUMBER_FORMAT'] = os.getenv('RECEIPT_NUMBER_FORMAT', 'RCP{series}{number:06d}')
+    # Audit entries are written in batches of AUDIT_BUFFER_SIZE, or after
+    # AUDIT_FLUSH_INTERVAL seconds; 0 writes every entry immediately
+    app.config['AUDIT_BUFFER_SIZE'] = int(os.getenv('AUDIT_BUFFER_SIZE', 100))
+    app.config['AUDIT_FLUSH_INTERVAL'] = float(os.getenv('AUDIT_FLUSH_INTERVAL', 2))
+    # `flask audit rotate` keeps audit_log to the last AUDIT_HOT_DAYS days and
+    # at most AUDIT_HOT_MAX_ENTRIES entries (0 turns a limit off), moving the
+    # rest to audit_archive, created with AUDIT_ARCHIVE_COMPRESSOR ('' for the
+    # server default)
+    app.config['AUDIT_HOT_DAYS'] = int(os.getenv('AUDIT_HOT_DAYS', 90))
+    app.config['AUDIT_HOT_MAX_ENTRIES'] = int(os.getenv('AUDIT_HOT_MAX_ENTRIES', 50000))
+    app.config['AUDIT_ARCHIVE_COMPRESSOR'] = os.getenv('AUDIT_ARCHIVE_COMPRESSOR', 'zstd')
+    # Logged in admins cached per worker: how many, and for how long (seconds)
+    app.config['PRINCIPAL_CACHE_SIZE'] = int(os.getenv('PRINCIPAL_CACHE_SIZE', 256))
+    app.config['PRINCIPAL_CACHE_TTL'] = float(os.getenv('PRINCIPAL_CACHE_TTL', 60))
+    # One-by-one dereferences of a reference field allowed per request; more
+    # fail the request in debug/testing and are logged otherwise
+    app.config['REFERENCE_LAZY_LOAD_LIMIT'] = int(os.getenv('REFERENCE_LAZY_LOAD_LIMIT', 3))
+    # How often a worker checks for a new fee schedule version (seconds)
+    app.config['PRICING_REFRESH_INTERVAL'] = float(os.getenv('PRICING_REFRESH_INTERVAL', 30))
+    # Days after the 1st of the month before a month's fee counts as overdue
+    app.config['ARREARS_GRACE_DAYS'] = int(os.getenv('ARREARS_GRACE_DAYS', 15))
+    # Age (seconds) after which the defaulters report totals are recomputed
+    # in the background
+    app.config['DEFAULTER_TOTALS_MAX_AGE'] = float(os.getenv('DEFAULTER_TOTALS_MAX_AGE', 60))
+    # Collection analytics: timezone days are counted in, and how long
+    # computed series are cached per worker (seconds)
+    app.config['ANALYTICS_TIMEZONE'] = os.getenv('ANALYTICS_TIMEZONE', 'Asia/Kolkata')
+    app.config['ANALYTICS_CACHE_TTL'] = float(os.getenv('ANALYTICS_CACHE_TTL', 60))
 
-    # Initialize extensions
+    # Request metrics: requests slower than SLOW_REQUEST_MS (milliseconds)
+    # are logged with the query plan of their slowest Mongo command.
+    # SERVER_TIMING=0 turns off the Server-Timing response header.
+    app.config['SLOW_REQUEST_MS'] = float(os.getenv('SLOW_REQUEST_MS', 500))
+    app.config['SERVER_TIMING'] = os.getenv('SERVER_TIMING', '1') == '1'
+    # Lets a Prometheus scraper read /admin/metrics without logging in
+    app.config['METRICS_TOKEN'] = os.getenv('METRICS_TOKEN')
+    # Directory where each worker process writes its metrics, so that
+    # /admin/metrics adds up every worker (gunicorn.conf.py sets one).
+    # Unset, /admin/metrics only covers the worker that answers.
+    app.config['METRICS_DIR'] = os.getenv('METRICS_DIR')
+    # Compression of HTML and JSON responses of HTTP_COMPRESSION_MIN_SIZE
+    # bytes or more: 'gzip', 'br' (needs brotli) or both in order of
+    # preference ('br,gzip'). Off by default, e.g. behind a compressing proxy.
+    app.config['HTTP_COMPRESSION'] = [name.strip() for name in os.getenv('HTTP_COMPRESSION', '').split(',')
+                                      if name.strip()]
+    app.config['HTTP_COMPRESSION_MIN_SIZE'] = int(os.getenv('HTTP_COMPRESSION_MIN_SIZE', 1024))
+    # The student list and fee grid are streamed as they render;
+    # STREAM_TEMPLATES=0 renders them whole before sending
+    app.config['STREAM_TEMPLATES'] = os.getenv('STREAM_TEMPLATES', '1') == '1'
+
+    # Initialize extensions; the metrics listener is passed to the Mongo
+    # client, so it goes first
+    from application.services import metrics
+    metrics.init_app(app)
     db.init_app(app)
     login_manager.init_app(app)
     login_manager.login_view = 'auth.login'
+    from application.services import analytics, audit, compression, jobs, pricing
+    analytics.init_app(app)
+    compression.init_app(app)
+    audit.init_app(app)
+    pricing.init_app(app)
+    jobs.init_app(app)
+
+    # Amounts are integer paise; templates show them with |rupees
+    from application.services.money import format_rupees
+    app.add_template_filter(format_rupees, 'rupees')
 
     @app.route('/')
     def index():
         return redirect(url_for('auth.login'))
 
-    # Add user_loader for Flask-Login
-    from application.models import Admin
-    @login_manager.user_loader
-    def load_user(user_id):
-        return Admin.objects(pk=user_id).first()
+    # Add user_loader for Flask-Login: cached id/username/email principals
+    # instead of an Admin query per request
+    from application.services import principals
+    principals.init_app(app, login_manager)
 
     with app.app_context():
         # Import parts of our application
-        from application.models import Admin, Student, Fee, PaymentHistory, AuditLog
-        from application.routes import auth, student, fee, admin
+        from application.routes import auth, student, fee, admin, export
 
         # Register blueprints
         app.register_blueprint(auth.bp)
         app.register_blueprint(student.bp)
         app.register_blueprint(fee.bp)
         app.register_blueprint(admin.bp)
+        app.register_blueprint(export.bp)
 
-        # Create default admin if none exists
-        if not Admin.objects.first():
-            default_admin = Admin(
-                username='admin',
-                email='admin@school.com'
-            )
-            default_admin.set_password('admin123')
-            default_admin.save()
+        # Register management commands (flask indexes ...). The default
+        # admin and the indexes are set up once by `flask bootstrap`, not by
+        # every worker on startup.
+        from application.cli import register_commands
+        register_commands(app)
 
     return app
-
-# Expose app for WSGI servers
-app = create_app()
\ No newline at end of file
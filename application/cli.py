@@ -0,0 +1,397 @@
+import time
+import click
+from flask.cli import AppGroup, with_appcontext
+
+indexes_cli = AppGroup('indexes', help='Build and inspect MongoDB indexes.')
+dashboard_cli = AppGroup('dashboard', help='Maintain the dashboard summary.')
+fees_cli = AppGroup('fees', help='Bulk fee operations.')
+students_cli = AppGroup('students', help='Bulk student operations.')
+receipts_cli = AppGroup('receipts', help='Manage the receipt cache.')
+jobs_cli = AppGroup('jobs', help='Background job queue.')
+payments_cli = AppGroup('payments', help='Payment maintenance.')
+balances_cli = AppGroup('balances', help='Maintain the student balance ledger.')
+analytics_cli = AppGroup('analytics', help='Collection analytics rollups.')
+money_cli = AppGroup('money', help='Money storage migration and reconciliation.')
+audit_cli = AppGroup('audit', help='Audit log retention.')
+
+
+@indexes_cli.command('sync')
+def sync_indexes_command():
+    """Build all declared indexes in the background."""
+    from flask import current_app
+    from application.services.indexes import sync_indexes, index_report
+
+    errors = sync_indexes(archive_compressor=current_app.config['AUDIT_ARCHIVE_COMPRESSOR'])
+    for collection, error in errors.items():
+        click.echo(f'{collection}: index build failed: {error}', err=True)
+    _print_report(index_report())
+    if errors:
+        raise SystemExit(1)
+
+
+@indexes_cli.command('report')
+def report_indexes_command():
+    """Report missing, undeclared and unused indexes."""
+    from application.services.indexes import index_report
+
+    report = index_report()
+    _print_report(report)
+    if any(entry['missing'] for entry in report):
+        raise SystemExit(1)
+
+
+@indexes_cli.command('explain')
+def explain_indexes_command():
+    """Fail if any hot query is planned as a collection scan."""
+    from application.services.indexes import explain_hot_queries
+
+    failed = False
+    plans = explain_hot_queries()
+    for name, stages in plans.items():
+        if stages is None:
+            click.echo(f'{name}: explain not supported, skipped')
+        elif 'COLLSCAN' in stages:
+            failed = True
+            click.echo(f'{name}: COLLSCAN ({" <- ".join(stages)})', err=True)
+        else:
+            click.echo(f'{name}: {" <- ".join(stages)}')
+    if all(stages is None for stages in plans.values()):
+        raise click.ClickException('this server does not support explain; nothing was checked')
+    if failed:
+        raise SystemExit(1)
+
+
+@dashboard_cli.command('rebuild')
+@click.option('--dry-run', is_flag=True, help='Only report drift, do not rewrite the summary.')
+def rebuild_dashboard_command(dry_run):
+    """Recompute the dashboard summary from students and fees."""
+    from application.services.dashboard import FEE_COUNTERS, rebuild_summaries
+    from application.services.money import format_rupees
+
+    drift = rebuild_summaries(dry_run=dry_run)
+    for scope, key, name, stored, actual in sorted(drift):
+        if name in FEE_COUNTERS:
+            stored, actual = format_rupees(stored), format_rupees(actual)
+        click.echo(f'{scope} {key} {name}: stored {stored}, actual {actual}')
+    click.echo(f'{len(drift)} drifted counter(s)' + (' (dry run)' if dry_run else ' fixed'))
+
+
+@balances_cli.command('rebuild')
+@click.option('--dry-run', is_flag=True, help='Only report drift, do not rewrite the balances.')
+def rebuild_balances_command(dry_run):
+    """Recompute every student balance from the fee records."""
+    from application.services.balances import rebuild_balances
+    from application.services.money import format_rupees
+
+    drift = rebuild_balances(dry_run=dry_run)
+    for roll_number, name, stored, actual in sorted(drift, key=lambda d: (str(d[0]), d[1])):
+        click.echo(f'{roll_number} {name}: stored {format_rupees(stored)}, actual {format_rupees(actual)}')
+    click.echo(f'{len(drift)} drifted value(s)' + (' (dry run)' if dry_run else ' fixed'))
+
+
+@fees_cli.command('generate')
+@click.option('--month', type=click.IntRange(1, 12), required=True, help='Month number, e.g. 4')
+@click.option('--year', type=int, required=True, help='Year, e.g. 2025')
+@click.option('--class', 'class_name', help='Only generate for this class.')
+@click.option('--admin', 'username', default='admin', show_default=True,
+              help='Admin recorded in the audit log.')
+@click.option('--chunk-size', type=int, help='Fee records per insert (default FEE_GENERATION_CHUNK_SIZE).')
+def generate_fees_command(month, year, class_name, username, chunk_size):
+    """Create the monthly fee record of every student that has none."""
+    from flask import current_app
+    from application.services.fee_generation import generate_monthly_fees
+    from application.services.money import format_rupees
+
+    admin = _get_admin(username)
+    started = time.perf_counter()
+    result = generate_monthly_fees(
+        month, year, admin, class_name=class_name,
+        chunk_size=chunk_size or current_app.config['FEE_GENERATION_CHUNK_SIZE']
+    )
+    elapsed = time.perf_counter() - started
+    click.echo(f"Created {result['created']} fee record(s), skipped {result['skipped']}, "
+               f"total {format_rupees(result['total_fees'])} in {elapsed:.2f}s")
+
+
+@fees_cli.command('schedule')
+@click.option('--year', help='Year to show (default: current year).')
+def show_schedule_command(year):
+    """Show the fee schedule in force in a year."""
+    from datetime import datetime
+    from application.services.pricing import current_schedule
+
+    version, classes, discounts = current_schedule(year or datetime.now().year)
+    click.echo(f'Version {version}' if version else 'Built-in default schedule')
+    for name, rates in sorted(classes.items(), key=lambda item: item[0].zfill(3)):
+        click.echo(f"class {name}: base {rates.get('base', 0)}, hostel {rates.get('hostel', 0)}, "
+                   f"milk {rates.get('milk', 0)}")
+    for status, rule in sorted(discounts.items()):
+        click.echo(f"discount {status}: {rule.get('percent', 0)}% + {rule.get('amount', 0)} off the base fee")
+
+
+@fees_cli.command('publish-schedule')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--year', required=True, help='First year the schedule applies to, e.g. 2025')
+@click.option('--admin', 'username', default='admin', show_default=True,
+              help='Admin recorded as the author.')
+def publish_schedule_command(path, year, username):
+    """Publish a new fee schedule version from a JSON file.
+
+    The file holds {"classes": {"1": {"base": 5000, "hostel": 20000, "milk": 500}, ...},
+    "discounts": {"Poor": {"percent": 50, "amount": 0}}}.
+    """
+    import json
+    from application.services.pricing import publish_schedule
+
+    with open(path) as f:
+        data = json.load(f)
+    try:
+        schedule = publish_schedule(year, data['classes'], data.get('discounts'), admin=_get_admin(username))
+    except (KeyError, ValueError) as e:
+        raise click.ClickException(f'Invalid schedule: {e}')
+    click.echo(f'Published version {schedule.version} of the {schedule.year} fee schedule')
+
+
+@students_cli.command('import')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--admin', 'username', default='admin', show_default=True,
+              help='Admin recorded in the audit log.')
+@click.option('--batch-size', type=int, help='Rows per bulk write (default STUDENT_IMPORT_BATCH_SIZE).')
+def import_students_command(path, username, batch_size):
+    """Create or update students from a CSV or XLSX file."""
+    from flask import current_app
+    from application.services.student_import import import_students, rows_from_file
+
+    admin = _get_admin(username)
+    started = time.perf_counter()
+    with open(path, 'rb') as stream:
+        report = import_students(
+            rows_from_file(stream, path), admin,
+            batch_size=batch_size or current_app.config['STUDENT_IMPORT_BATCH_SIZE']
+        )
+    elapsed = time.perf_counter() - started
+    for line, roll_number, message in report.errors:
+        click.echo(f'line {line} ({roll_number or "-"}): {message}', err=True)
+    click.echo(f'{report.inserted} created, {report.updated} updated, '
+               f'{report.error_count} rejected in {elapsed:.2f}s')
+
+
+@receipts_cli.command('prune')
+def prune_receipts_command():
+    """Delete cached receipts rendered with an older template version."""
+    from application.services.receipts import get_store
+
+    click.echo(f'Removed {get_store().prune()} stale receipt(s)')
+
+
+@receipts_cli.command('batch')
+@click.argument('output_path', type=click.Path(dir_okay=False, writable=True))
+@click.option('--kind', type=click.Choice(['receipts', 'statements']), default='receipts', show_default=True)
+@click.option('--class', 'class_name', help='Class to print for (with --month and --year).')
+@click.option('--month')
+@click.option('--year')
+@click.option('--payment', 'payment_ids', multiple=True, help='Payment id; may be repeated.')
+@click.option('--workers', type=int, help='Worker processes (default RECEIPT_BATCH_WORKERS).')
+def batch_receipts_command(output_path, kind, class_name, month, year, payment_ids, workers):
+    """Render receipts or statements to a merged PDF (.pdf) or a ZIP (.zip)."""
+    from flask import current_app
+    from application.services.batch_pdf import (
+        load_receipt_jobs, load_statement_jobs, stream_zip, merged_pdf, Throughput
+    )
+
+    if not payment_ids and not (class_name and month and year):
+        raise click.UsageError('give --class, --month and --year, or --payment ids')
+    if kind == 'receipts':
+        jobs = load_receipt_jobs(payment_ids, class_name, month, year)
+    else:
+        jobs = load_statement_jobs(class_name, month, year)
+
+    def report(done, total, pages_per_second):
+        click.echo(f'{done}/{total} pages ({pages_per_second:.1f} pages/s)')
+
+    throughput = Throughput(report)
+    options = {'workers': workers or current_app.config['RECEIPT_BATCH_WORKERS'], 'progress': throughput}
+    with open(output_path, 'wb') as f:
+        if output_path.lower().endswith('.pdf'):
+            f.write(merged_pdf(kind, jobs, **options))
+        else:
+            for chunk in stream_zip(kind, jobs, **options):
+                f.write(chunk)
+    click.echo(f'Wrote {len(jobs)} {kind} to {output_path} '
+               f'({throughput.pages_per_second:.1f} pages/s)')
+
+
+@jobs_cli.command('work')
+def work_jobs_command():
+    """Consume jobs from the sqlite or redis queue in the foreground."""
+    from flask import current_app
+
+    if current_app.config['JOB_QUEUE'] == 'thread':
+        raise click.UsageError('the in-process queue has no external consumer; '
+                               'set JOB_QUEUE to sqlite or redis')
+    click.echo(f"Working {current_app.config['JOB_QUEUE']} jobs, Ctrl+C to stop")
+    try:
+        current_app.extensions['jobs'].work()
+    except KeyboardInterrupt:
+        pass
+
+
+@payments_cli.command('recover')
+@click.option('--older-than', type=int, default=300, show_default=True,
+              help='Only settle payments pending for at least this many seconds.')
+def recover_payments_command(older_than):
+    """Settle payments interrupted between the insert and the fee update."""
+    from datetime import timedelta
+    from application.services.payments import recover_pending_payments
+
+    applied, removed = recover_pending_payments(timedelta(seconds=older_than))
+    click.echo(f'{applied} payment(s) marked applied, {removed} removed')
+
+
+@analytics_cli.command('backfill')
+@click.option('--start', help='First day, YYYY-MM-DD (default: day of the first payment).')
+@click.option('--end', help='Last day, YYYY-MM-DD (default: today).')
+def backfill_analytics_command(start, end):
+    """Rebuild the daily collection rollups from the payment history, month by month."""
+    from datetime import date, datetime, timedelta
+    from application.models import PaymentHistory
+    from application.services.analytics import backfill_rollups
+
+    if not start:
+        first = PaymentHistory.objects.order_by('payment_date').only('payment_date').first()
+        if first is None:
+            click.echo('No payments to backfill')
+            return
+        # A day early, in case the first payment falls on the previous local day
+        start = (first.payment_date - timedelta(days=1)).strftime('%Y-%m-%d')
+    end = end or date.today().isoformat()
+    day = datetime.strptime(start, '%Y-%m-%d').date()
+    last = datetime.strptime(end, '%Y-%m-%d').date()
+    while day <= last:
+        month_end = min((day.replace(day=28) + timedelta(days=4)).replace(day=1) - timedelta(days=1), last)
+        written = backfill_rollups(day.isoformat(), month_end.isoformat())
+        click.echo(f'{day.isoformat()}..{month_end.isoformat()}: {written} rollup(s)')
+        day = month_end + timedelta(days=1)
+
+
+@money_cli.command('migrate')
+def migrate_money_command():
+    """Convert amounts stored as float rupees to integer paise."""
+    from application.services.reconciliation import migrate_to_paise
+    from application.services.dashboard import rebuild_summaries
+    from application.services.balances import rebuild_balances
+
+    for collection, count in migrate_to_paise().items():
+        click.echo(f'{collection}: {count} document(s) converted')
+    # The running totals were summed from floats; recompute them exactly
+    rebuild_summaries()
+    rebuild_balances()
+    click.echo('Dashboard summary and student balances rebuilt')
+
+
+@money_cli.command('reconcile')
+@click.option('--report', 'report_path', type=click.Path(dir_okay=False, writable=True),
+              help='Write every mismatch to this CSV file.')
+@click.option('--repair', is_flag=True, help='Set total and paid amounts to the expected values.')
+@click.option('--batch-size', type=int, default=50000, show_default=True, help='Documents per cursor batch.')
+def reconcile_money_command(report_path, repair, batch_size):
+    """Check fee totals and paid amounts against their components and payments."""
+    from application.services.reconciliation import reconcile
+    from application.services.dashboard import rebuild_summaries
+    from application.services.balances import rebuild_balances
+
+    try:
+        result = reconcile(report_path, repair=repair, batch_size=batch_size)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    click.echo(f"Checked {result['fees']} fee(s) and {result['payments']} payment(s): "
+               f"loaded in {result['load_seconds']:.2f}s, checked in {result['check_seconds']:.3f}s")
+    click.echo(f"{result['total_mismatches']} total_fee mismatch(es), "
+               f"{result['paid_mismatches']} paid_amount mismatch(es), {result['overpaid']} overpaid, "
+               f"{result['orphan_payments']} payment(s) without a fee")
+    if repair:
+        click.echo(f"Repaired {result['repaired']} fee(s), skipped {result['skipped']} changed since read")
+        if result['repaired']:
+            rebuild_summaries()
+            rebuild_balances()
+            click.echo('Dashboard summary and student balances rebuilt')
+    if not repair and (result['total_mismatches'] or result['paid_mismatches'] or result['orphan_payments']):
+        raise SystemExit(1)
+
+
+@audit_cli.command('rotate')
+@click.option('--hot-days', type=int, help='Keep entries this many days old (default AUDIT_HOT_DAYS).')
+@click.option('--max-entries', type=int, help='Keep at most this many entries (default AUDIT_HOT_MAX_ENTRIES).')
+@click.option('--batch-size', type=int, default=1000, show_default=True, help='Entries moved per batch.')
+def rotate_audit_command(hot_days, max_entries, batch_size):
+    """Move old audit entries from audit_log to the compressed audit_archive."""
+    import time
+    from flask import current_app
+    from application.models import AuditLog, AuditArchive
+    from application.services.audit_archive import rotate
+
+    config = current_app.config
+    started = time.perf_counter()
+    moved = rotate(
+        config['AUDIT_HOT_DAYS'] if hot_days is None else hot_days,
+        config['AUDIT_HOT_MAX_ENTRIES'] if max_entries is None else max_entries,
+        batch_size=batch_size, compressor=config['AUDIT_ARCHIVE_COMPRESSOR'],
+    )
+    click.echo(f'Moved {moved} entry(ies) in {time.perf_counter() - started:.2f}s; '
+               f'{AuditLog.objects.count()} in audit_log, {AuditArchive.objects.count()} in audit_archive')
+
+
+@click.command('bootstrap')
+@click.option('--username', help='Default admin username (default: admin).')
+@click.option('--email', help='Default admin email (default: admin@school.com).')
+@click.option('--password', help='Default admin password (default: admin123).')
+@with_appcontext
+def bootstrap_command(username, email, password):
+    """Build indexes and create the default admin; run once per deploy."""
+    from application.services.bootstrap import bootstrap
+
+    given = {'username': username, 'email': email, 'password': password}
+    errors, admin = bootstrap(**{key: value for key, value in given.items() if value})
+    for collection, error in errors.items():
+        click.echo(f'{collection}: index build failed: {error}', err=True)
+    if admin:
+        click.echo(f'Created admin {admin.username}; change the password after logging in')
+    else:
+        click.echo('An admin already exists')
+    if errors:
+        raise SystemExit(1)
+
+
+def _get_admin(username):
+    from application.models import Admin
+
+    admin = Admin.objects(username=username).first()
+    if not admin:
+        raise click.BadParameter(f'no admin named {username}', param_hint='--admin')
+    return admin
+
+
+def _print_report(report):
+    for entry in report:
+        click.echo(entry['collection'])
+        click.echo(f"  missing: {', '.join(entry['missing']) or '-'}")
+        click.echo(f"  extra:   {', '.join(entry['extra']) or '-'}")
+        if entry['unused'] is None:
+            click.echo('  unused:  (index stats not available)')
+        else:
+            click.echo(f"  unused:  {', '.join(entry['unused']) or '-'}")
+
+
+def register_commands(app):
+    app.cli.add_command(bootstrap_command)
+    app.cli.add_command(indexes_cli)
+    app.cli.add_command(dashboard_cli)
+    app.cli.add_command(fees_cli)
+    app.cli.add_command(students_cli)
+    app.cli.add_command(receipts_cli)
+    app.cli.add_command(jobs_cli)
+    app.cli.add_command(payments_cli)
+    app.cli.add_command(balances_cli)
+    app.cli.add_command(analytics_cli)
+    app.cli.add_command(money_cli)
+    app.cli.add_command(audit_cli)
@@ -2,6 +2,8 @@ from application import db
 from flask_login import UserMixin
 from werkzeug.security import generate_password_hash, check_password_hash
 from datetime import datetime
+# Lazy loads go through the request's identity map and the N+1 guard
+from application.services.references import ReferenceField
 
 class Admin(UserMixin, db.Document):
     username = db.StringField(max_length=64, unique=True, required=True)
@@ -32,39 +34,233 @@ class Student(db.Document):
     created_at = db.DateTimeField(default=datetime.utcnow)
     updated_at = db.DateTimeField(default=datetime.utcnow)
 
+    # Indexes are built by `flask indexes sync` rather than on first query,
+    # so a large collection never gets indexed inside a request.
+    meta = {
+        'auto_create_index': False,
+        'index_background': True,
+        'indexes': [
+            # Class filter + roll_number order of the fee grid and student list
+            ('class_name', 'roll_number'),
+            'economic_status',
+        ]
+    }
+
     def save(self, *args, **kwargs):
         self.updated_at = datetime.utcnow()
         return super(Student, self).save(*args, **kwargs)
 
 class Fee(db.Document):
-    student = db.ReferenceField('Student', required=True)
+    student = ReferenceField('Student', required=True)
     month = db.StringField(max_length=10, required=True)
     year = db.StringField(max_length=10, required=True)
-    base_fee = db.FloatField(required=True)
-    hostel_food_fee = db.FloatField(default=0.0)
-    milk_fee = db.FloatField(default=0.0)
-    discount = db.FloatField(default=0.0)
-    total_fee = db.FloatField(required=True)
-    paid_amount = db.FloatField(default=0.0)
+    # Amounts are integer paise (see application/services/money.py)
+    base_fee = db.IntField(required=True)
+    hostel_food_fee = db.IntField(default=0)
+    milk_fee = db.IntField(default=0)
+    discount = db.IntField(default=0)
+    total_fee = db.IntField(required=True)
+    paid_amount = db.IntField(default=0)
+    # Ids of the payments included in paid_amount; makes applying a payment
+    # idempotent (see application/services/payments.py)
+    applied_payments = db.ListField(db.ObjectIdField())
     created_at = db.DateTimeField(default=datetime.utcnow)
     updated_at = db.DateTimeField(default=datetime.utcnow)
 
+    meta = {
+        'auto_create_index': False,
+        'index_background': True,
+        'indexes': [
+            # One fee record per student per period; also serves the
+            # student__in/month/year lookup of the fee grid
+            {'fields': ['student', 'year', 'month'], 'unique': True},
+            # Period-wide queries (dashboard, reports)
+            ('year', 'month'),
+        ]
+    }
+
     def save(self, *args, **kwargs):
         self.updated_at = datetime.utcnow()
         return super(Fee, self).save(*args, **kwargs)
 
 class PaymentHistory(db.Document):
-    student = db.ReferenceField('Student', required=True)
-    fee = db.ReferenceField('Fee', required=True)
-    amount = db.FloatField(required=True)
+    student = ReferenceField('Student', required=True)
+    fee = ReferenceField('Fee', required=True)
+    amount = db.IntField(required=True)  # paise
     payment_date = db.DateTimeField(default=datetime.utcnow)
     receipt_number = db.StringField(max_length=20, unique=True, required=True)
-    created_by = db.ReferenceField('Admin', required=True)
+    created_by = ReferenceField('Admin', required=True)
     payment_method = db.StringField(max_length=10, default='cash')
     transaction_id = db.StringField(max_length=64)
+    # 'pending' between the insert and the fee update when no transaction is
+    # available; 'applied' once paid_amount includes this payment
+    status = db.StringField(max_length=10, default='applied')
+
+    meta = {
+        'auto_create_index': False,
+        'index_background': True,
+        'indexes': [
+            'fee',
+            'student',
+            # Date range exports and reports
+            'payment_date',
+            # Recovery of interrupted payments
+            {'fields': ['status'], 'partialFilterExpression': {'status': 'pending'}},
+        ]
+    }
 
-class AuditLog(db.Document):
-    admin = db.ReferenceField('Admin', required=True)
+class AuditEntry(db.Document):
+    admin = ReferenceField('Admin', required=True)
     action = db.StringField(max_length=100, required=True)
     details = db.StringField()
-    timestamp = db.DateTimeField(default=datetime.utcnow)
\ No newline at end of file
+    # What the action touched ('student', 'fee', 'payment', ...) and how:
+    # changes maps field names to [old value, new value]
+    entity_type = db.StringField(max_length=20)
+    entity_id = db.StringField(max_length=64)
+    changes = db.DictField()
+    timestamp = db.DateTimeField(default=datetime.utcnow)
+
+    meta = {
+        'abstract': True,
+        'auto_create_index': False,
+        'index_background': True,
+        'indexes': [
+            # Newest first; _id orders entries with the same timestamp, so
+            # the audit viewer can page by (timestamp, _id)
+            ('-timestamp', '-id'),
+            # History of one record, and of one admin or action
+            ('entity_type', 'entity_id', '-timestamp'),
+            ('admin', '-timestamp', '-id'),
+            ('action', '-timestamp', '-id'),
+        ]
+    }
+
+class AuditLog(AuditEntry):
+    # Recent entries, kept small by `flask audit rotate`
+    pass
+
+class AuditArchive(AuditEntry):
+    # Entries rotated out of audit_log, unchanged (same _id). Created with
+    # block compression, see application/services/audit_archive.py
+    pass
+
+class DashboardSummary(db.Document):
+    # Read model behind the admin dashboard, maintained with $inc by the
+    # student and fee write paths (see application/services/dashboard.py).
+    # scope 'class' documents are keyed by class_name, scope 'year' by year.
+    # scope 'defaulters' documents hold the defaulters report totals per
+    # 'class_name|economic_status', and under '*' for all of them
+    # (see balances.refresh_defaulter_totals()).
+    scope = db.StringField(max_length=10, required=True)
+    key = db.StringField(max_length=32, required=True)
+    students = db.IntField(default=0)
+    hostelers = db.IntField(default=0)
+    poor_students = db.IntField(default=0)
+    total_fees = db.IntField(default=0)  # paise
+    collected_fees = db.IntField(default=0)
+    billed = db.IntField(default=0)  # paise; defaulters scope only
+    paid = db.IntField(default=0)
+    outstanding = db.IntField(default=0)
+    # Latest payments counted in by retried payment jobs, so a retry does
+    # not count one twice (inc_once() in services/jobs.py)
+    counted_payments = db.ListField(db.ObjectIdField())
+    updated_at = db.DateTimeField(default=datetime.utcnow)
+
+    meta = {
+        'auto_create_index': False,
+        'index_background': True,
+        'indexes': [
+            {'fields': ['scope', 'key'], 'unique': True},
+        ]
+    }
+
+class StudentBalance(db.Document):
+    # Running balance of a student over all fee records, maintained with $inc
+    # by the fee and payment write paths (see application/services/balances.py).
+    # periods maps 'YYYY-MM' to what is still owed on that month's fee.
+    # Student fields are copied in for the defaulters report.
+    student = ReferenceField('Student', required=True)
+    roll_number = db.StringField(max_length=20)
+    name = db.StringField(max_length=100)
+    class_name = db.StringField(max_length=10)
+    economic_status = db.StringField(max_length=10)
+    billed = db.IntField(default=0)  # paise, as are the periods
+    paid = db.IntField(default=0)
+    outstanding = db.IntField(default=0)
+    periods = db.DictField()
+    # As DashboardSummary.counted_payments
+    counted_payments = db.ListField(db.ObjectIdField())
+    updated_at = db.DateTimeField(default=datetime.utcnow)
+
+    meta = {
+        'collection': 'student_balances',
+        'auto_create_index': False,
+        'index_background': True,
+        'indexes': [
+            {'fields': ['student'], 'unique': True},
+            # Defaulters report, largest balances first; only students who owe
+            # anything are indexed
+            {'fields': ['-outstanding'], 'partialFilterExpression': {'outstanding': {'$gt': 0}}},
+            {'fields': ['class_name', '-outstanding'], 'partialFilterExpression': {'outstanding': {'$gt': 0}}},
+            {'fields': ['economic_status', '-outstanding'],
+             'partialFilterExpression': {'outstanding': {'$gt': 0}}},
+            # The report's other sort orders
+            {'fields': ['roll_number'], 'partialFilterExpression': {'outstanding': {'$gt': 0}}},
+            {'fields': ['name'], 'partialFilterExpression': {'outstanding': {'$gt': 0}}},
+        ]
+    }
+
+class CollectionRollup(db.Document):
+    # Payments collected per local day, payment method and class, maintained
+    # with $inc by the payment path (see application/services/analytics.py).
+    # day is 'YYYY-MM-DD' so ranges and months compare as strings.
+    day = db.StringField(max_length=10, required=True)
+    payment_method = db.StringField(max_length=10, required=True)
+    class_name = db.StringField(max_length=10, required=True)
+    payments = db.IntField(default=0)
+    amount = db.IntField(default=0)  # paise
+    # As DashboardSummary.counted_payments
+    counted_payments = db.ListField(db.ObjectIdField())
+    updated_at = db.DateTimeField(default=datetime.utcnow)
+
+    meta = {
+        'collection': 'collection_rollups',
+        'auto_create_index': False,
+        'index_background': True,
+        'indexes': [
+            {'fields': ['day', 'payment_method', 'class_name'], 'unique': True},
+        ]
+    }
+
+class FeeSchedule(db.Document):
+    # Fee rates effective from a year. Every change is stored as a new
+    # version; the highest version of a year is in force. classes maps
+    # class_name to {'base', 'hostel', 'milk'}; discounts maps an economic
+    # status to {'percent', 'amount'} taken off the base fee. Amounts are
+    # rupees as published; the pricing engine compiles them to paise.
+    year = db.StringField(max_length=4, required=True)
+    version = db.IntField(required=True)
+    classes = db.DictField(required=True)
+    discounts = db.DictField()
+    created_by = ReferenceField('Admin')
+    created_at = db.DateTimeField(default=datetime.utcnow)
+
+    meta = {
+        'auto_create_index': False,
+        'index_background': True,
+        'indexes': [
+            {'fields': ['year', '-version'], 'unique': True},
+        ]
+    }
+
+class Counter(db.Document):
+    # Named sequences, advanced with an atomic $inc (receipt numbers, see
+    # application/services/receipt_numbers.py), and collection version
+    # stamps (application/services/versions.py)
+    name = db.StringField(max_length=64, primary_key=True)
+    value = db.IntField(default=0)
+    updated_at = db.DateTimeField()
+
+    meta = {
+        'collection': 'counters',
+    }
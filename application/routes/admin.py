@@ -1,60 +1,37 @@
 
-from flask import Blueprint, render_template
+from flask import Blueprint, render_template, request, jsonify, current_app, make_response, flash, redirect, url_for
 from flask_login import login_required, current_user
 from application.models import Student, Fee, Admin, AuditLog
 from application import db
+from application.services import dashboard as dashboard_summary
+from application.services import analytics, audit_archive, metrics, principals, references
+from application.services.connections import REPORTING
 from datetime import datetime
-import pytz
+from bson.errors import InvalidId
+import hmac
 
 bp = Blueprint('admin', __name__)
 
 @bp.route('/dashboard')
 @login_required
 def dashboard():
-    # Get statistics
-    total_students = Student.objects.count()
-    total_hostelers = Student.objects(hostel_food_opted=True).count()
-    total_food = Student.objects(hostel_food_opted=True).count()
-    poor_students = Student.objects(economic_status='Poor').count()
-    
-    # Fee statistics for current year
+    # Statistics come from the incrementally maintained summary documents
     current_year = str(datetime.now().year)
-    
-    # MongoEngine aggregation for sums
-    pipeline = [
-        {'$match': {'year': current_year}},
-        {'$group': {
-            '_id': None, 
-            'total_fees': {'$sum': '$total_fee'},
-            'collected_fees': {'$sum': '$paid_amount'}
-        }}
-    ]
-    
-    fee_stats = list(Fee.objects.aggregate(pipeline))
-    if fee_stats:
-        total_fees = fee_stats[0]['total_fees']
-        collected_fees = fee_stats[0]['collected_fees']
-    else:
-        total_fees = 0
-        collected_fees = 0
-        
+    summary = dashboard_summary.load_summary(current_year)
+
+    total_students = summary['students']
+    total_hostelers = summary['hostelers']
+    total_food = summary['hostelers']
+    poor_students = summary['poor_students']
+    total_fees = summary['total_fees']
+    collected_fees = summary['collected_fees']
     pending_fees = total_fees - collected_fees
-    
-    # Get class-wise student count
-    class_pipeline = [
-        {'$group': {
-            '_id': '$class_name',
-            'count': {'$sum': 1}
-        }}
-    ]
-    class_stats = list(Student.objects.aggregate(class_pipeline))
-    # Format for template: [(class_name, count), ...]
-    class_distribution = [(stat['_id'], stat['count']) for stat in class_stats]
-    # Sort by class name (simple string sort for now)
-    class_distribution.sort(key=lambda x: x[0])
+    class_distribution = summary['class_distribution']
     
     # Get recent audit logs
-    recent_logs = AuditLog.objects.order_by('-timestamp').limit(10)
+    # Admins of all entries loaded with one query
+    recent_logs = references.resolve(AuditLog.objects.using(REPORTING).order_by('-timestamp', '-id').limit(10), 'admin')
+    import pytz
     local_tz = pytz.timezone('Asia/Kolkata')
     
     # We need to convert to list to modify attributes or use a wrapper
@@ -67,6 +44,7 @@ def dashboard():
         log_data = {
             'action': log.action,
             'details': log.details,
+            'changes': log.changes,
             'admin': log.admin,
             'timestamp': log.timestamp,
             'local_timestamp': log.timestamp.replace(tzinfo=pytz.utc).astimezone(local_tz) if log.timestamp else None
@@ -74,7 +52,7 @@ def dashboard():
         logs_to_display.append(log_data)
     
     # Get other active admins
-    active_admins = Admin.objects(last_login__exists=True).order_by('-last_login')
+    active_admins = Admin.objects.using(REPORTING).filter(last_login__exists=True).order_by('-last_login')
     
     return render_template('admin/dashboard.html',
                          total_students=total_students,
@@ -86,4 +64,81 @@ def dashboard():
                          pending_fees=pending_fees,
                          class_distribution=class_distribution,
                          recent_logs=logs_to_display,
-                         active_admins=active_admins)
\ No newline at end of file
+                         active_admins=active_admins)
+
+@bp.route('/analytics/collections')
+@login_required
+def collection_analytics():
+    # JSON time series for the dashboard charts, read from the daily rollups:
+    # ?start=YYYY-MM-DD&end=YYYY-MM-DD&interval=day|month|year&by=payment_method|class_name
+    default_start, default_end = analytics.default_range()
+    start = request.args.get('start') or default_start
+    end = request.args.get('end') or default_end
+    interval = request.args.get('interval', 'day')
+    by = request.args.get('by') or None
+    try:
+        start = analytics.parse_day(start).isoformat()
+        end = analytics.parse_day(end).isoformat()
+        data = analytics.cached_collection_series(start, end, interval, by)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    response = jsonify(data)
+    response.cache_control.private = True
+    response.cache_control.max_age = int(current_app.config['ANALYTICS_CACHE_TTL'])
+    return response
+
+@bp.route('/audit')
+@login_required
+def audit_log():
+    # Both audit tiers, newest first, 50 entries a page:
+    # ?admin=<id>&action=<name>&start=YYYY-MM-DD&end=YYYY-MM-DD&before=<cursor>
+    filters = {name: request.args.get(name) for name in ('admin', 'action', 'start', 'end')}
+    filters = {name: value for name, value in filters.items() if value}
+    tz = analytics.school_timezone()
+    try:
+        since = until = None
+        if 'start' in filters or 'end' in filters:
+            # Days in the school's timezone; either end may be left open
+            since, until = analytics.utc_bounds(filters.get('start', filters.get('end')),
+                                                filters.get('end', filters.get('start')), tz)
+            since = since if 'start' in filters else None
+            until = until if 'end' in filters else None
+        entries, next_before = audit_archive.search(
+            admin=filters.get('admin'), action=filters.get('action'), since=since, until=until,
+            before=request.args.get('before'),
+        )
+    except (ValueError, InvalidId) as e:
+        flash(f'Invalid filter: {e}', 'error')
+        return redirect(url_for('admin.audit_log'))
+    import pytz
+    logs = [{
+        'action': entry.action,
+        'details': entry.details,
+        'changes': entry.changes,
+        'admin': entry.admin,
+        'local_timestamp': pytz.utc.localize(entry.timestamp).astimezone(tz),
+    } for entry in entries]
+    return render_template('admin/audit.html', logs=logs, next_before=next_before, filters=filters,
+                           admins=Admin.objects.using(REPORTING).only('username').order_by('username'),
+                           actions=audit_archive.actions())
+
+@bp.route('/admin/metrics')
+def request_metrics():
+    # Prometheus text format, summed over the workers sharing METRICS_DIR;
+    # the cache gauges are this worker's. Admins only; a scraper
+    # can send METRICS_TOKEN as a bearer token instead of logging in.
+    token = current_app.config['METRICS_TOKEN']
+    authorization = request.headers.get('Authorization', '')
+    if not current_user.is_authenticated and not (
+            token and hmac.compare_digest(authorization, f'Bearer {token}')):
+        return current_app.login_manager.unauthorized()
+    cache = principals.stats()
+    response = make_response(metrics.render([
+        ('principal_cache_hits', 'Logged in admins served from the cache.', cache['hits']),
+        ('principal_cache_misses', 'Logged in admins loaded from Mongo.', cache['misses']),
+        ('principal_cache_size', 'Admins in the cache.', cache['size']),
+    ]))
+    response.mimetype = 'text/plain'
+    response.headers['Content-Type'] = 'text/plain; version=0.0.4; charset=utf-8'
+    response.cache_control.no_store = True
+    return response
@@ -1,6 +1,7 @@
 from flask import Blueprint, render_template, redirect, url_for, flash, request
 from flask_login import login_user, logout_user, login_required, current_user
-from application.models import Admin, AuditLog
+from application.models import Admin
+from application.services import audit
 from application import db
 from datetime import datetime
 
@@ -20,16 +21,11 @@ def login():
             login_user(admin)
             
             # Update last login time
-            admin.last_login = datetime.utcnow()
-            admin.save()
+            Admin.objects(pk=admin.pk).update_one(set__last_login=datetime.utcnow())
             
             # Create audit log
-            log = AuditLog(
-                admin=admin,
-                action='LOGIN',
-                details=f'Admin {admin.username} logged in'
-            )
-            log.save()
+            audit.record(admin, 'LOGIN', entity_type='admin', entity_id=admin.pk,
+                         details=f'Admin {admin.username} logged in')
             
             return redirect(url_for('admin.dashboard'))
         
@@ -41,12 +37,8 @@ def login():
 @login_required
 def logout():
     # Create audit log before logout
-    log = AuditLog(
-        admin=current_user.id,
-        action='LOGOUT',
-        details=f'Admin {current_user.username} logged out'
-    )
-    log.save()
+    audit.record(current_user.id, 'LOGOUT', entity_type='admin', entity_id=current_user.id,
+                 details=f'Admin {current_user.username} logged out')
     
     logout_user()
     return redirect(url_for('auth.login'))
\ No newline at end of file
@@ -0,0 +1,128 @@
+from flask import Blueprint, render_template, redirect, url_for, flash, request, Response, stream_with_context, current_app, \
+    jsonify
+from flask_login import login_required
+from datetime import datetime, timedelta
+from bson import ObjectId
+from bson.errors import InvalidId
+from application.services.export import (
+    FEE_COLUMNS, PAYMENT_COLUMNS, fee_ledger_rows, payment_history_rows,
+    stream_csv, stream_xlsx, gzip_stream
+)
+from application.services.batch_pdf import (
+    KINDS, load_receipt_jobs, load_statement_jobs, stream_zip, merged_pdf, Throughput
+)
+
+bp = Blueprint('export', __name__, url_prefix='/export')
+
+MIMETYPES = {
+    'csv': 'text/csv',
+    'xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+}
+
+
+def _export_response(filename, columns, rows):
+    fmt = request.args.get('format', 'csv')
+    if fmt not in MIMETYPES:
+        fmt = 'csv'
+    chunks = stream_xlsx(columns, rows) if fmt == 'xlsx' else stream_csv(columns, rows)
+    filename = f'{filename}.{fmt}'
+    mimetype = MIMETYPES[fmt]
+    if request.args.get('gzip'):
+        chunks = gzip_stream(chunks)
+        filename += '.gz'
+        mimetype = 'application/gzip'
+    return Response(
+        stream_with_context(chunks),
+        mimetype=mimetype,
+        headers={'Content-Disposition': f'attachment; filename={filename}'}
+    )
+
+
+@bp.route('/')
+@login_required
+def index():
+    return render_template('export/index.html', now=datetime.now())
+
+
+@bp.route('/fees')
+@login_required
+def fee_ledger():
+    year = request.args.get('year') or str(datetime.now().year)
+    month = request.args.get('month') or None
+    class_filter = request.args.get('class') or None
+    try:
+        filename = f'fee_ledger_{year}' + (f'_{month}' if month else '') + \
+                   (f'_class{class_filter}' if class_filter else '')
+        return _export_response(filename, FEE_COLUMNS, fee_ledger_rows(year, month, class_filter))
+    except ValueError as e:
+        flash(f'Error exporting fee ledger: {str(e)}', 'error')
+        return redirect(url_for('export.index'))
+
+
+@bp.route('/payments')
+@login_required
+def payment_history():
+    try:
+        start = datetime.strptime(request.args['from'], '%Y-%m-%d')
+        # The end date is inclusive
+        end = datetime.strptime(request.args['to'], '%Y-%m-%d') + timedelta(days=1)
+        filename = f"payments_{request.args['from']}_{request.args['to']}"
+        return _export_response(filename, PAYMENT_COLUMNS, payment_history_rows(start, end))
+    except (KeyError, ValueError) as e:
+        flash(f'Error exporting payments: {str(e)}', 'error')
+        return redirect(url_for('export.index'))
+
+
+@bp.route('/documents')
+@login_required
+def documents():
+    # Receipts (by class and period, or by payment ids) or monthly statements
+    # (by class and period), as one merged PDF or a ZIP of PDFs
+    kind = request.args.get('kind', 'receipts')
+    class_filter = request.args.get('class')
+    month = request.args.get('month')
+    year = request.args.get('year')
+    output = request.args.get('output', 'zip')
+    try:
+        payment_ids = [ObjectId(pid) for pid in request.args.get('ids', '').split(',') if pid]
+    except InvalidId:
+        return jsonify({'error': 'ids must be a comma-separated list of payment ids'}), 400
+    try:
+        if kind not in KINDS:
+            raise ValueError(f'unknown document kind {kind}')
+        if not payment_ids and not (class_filter and month and year):
+            raise ValueError('choose a class, month and year')
+        if kind == 'receipts':
+            jobs = load_receipt_jobs(payment_ids, class_filter, month, year)
+        else:
+            jobs = load_statement_jobs(class_filter, month, year)
+        if not jobs:
+            raise ValueError('nothing to print for this selection')
+
+        name = f'{kind}_class{class_filter}_{month}_{year}' if class_filter else kind
+        throughput = Throughput()
+        options = {'workers': current_app.config['RECEIPT_BATCH_WORKERS'], 'progress': throughput}
+
+        def log_throughput():
+            current_app.logger.info('Rendered %d %s at %.1f pages/s', throughput.pages, kind,
+                                    throughput.pages_per_second)
+
+        if output == 'pdf':
+            data = merged_pdf(kind, jobs, **options)
+            log_throughput()
+            response = Response(data, mimetype='application/pdf')
+            response.headers['Content-Disposition'] = f'inline; filename={name}.pdf'
+            return response
+
+        def generate():
+            yield from stream_zip(kind, jobs, **options)
+            log_throughput()
+
+        return Response(
+            stream_with_context(generate()),
+            mimetype='application/zip',
+            headers={'Content-Disposition': f'attachment; filename={name}.zip'}
+        )
+    except ValueError as e:
+        flash(f'Error generating {kind}: {str(e)}', 'error')
+        return redirect(url_for('export.index'))
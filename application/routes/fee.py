@@ -1,30 +1,50 @@
-from flask import Blueprint, render_template, redirect, url_for, flash, request, jsonify, make_response
+from flask import Blueprint, render_template, redirect, url_for, flash, request, jsonify, make_response, current_app
 from flask_login import login_required, current_user
-from application.models import Student, Fee, PaymentHistory, AuditLog
+from application.models import Student, Fee, PaymentHistory
 from application import db
 from datetime import datetime
-from reportlab.pdfgen import canvas
-from reportlab.lib.pagesizes import letter
-from io import BytesIO
 import json
-from application.utils import generate_receipt_pdf
+from bson import ObjectId
+from bson.errors import InvalidId
+from application.services.fee_grid import FeeGridPage
+from application.services import audit, balances, dashboard, versions
+from application.services.pricing import quote_fee, quote_students
+from application.services.fee_generation import generate_monthly_fees, normalize_period
+from application.services.receipts import get_receipt, receipt_ready
+from application.services.payments import apply_payment, enqueue_payment_side_effects
+from application.services.receipt_numbers import next_receipt_number
+from application.services.money import to_paise, to_rupees, format_rupees
+from application.services.streaming import stream_template
 
 bp = Blueprint('fee', __name__, url_prefix='/fee')
 
+# Fields recorded in the audit log's changes
+FEE_AUDIT_FIELDS = ('month', 'year', 'base_fee', 'hostel_food_fee', 'milk_fee', 'discount', 'total_fee')
+FEE_AMOUNT_FIELDS = ('base_fee', 'hostel_food_fee', 'milk_fee', 'discount', 'total_fee')
+
+def _audit_values(fee):
+    # Audit entries show amounts in rupees
+    return {field: format_rupees(fee[field]) if field in FEE_AMOUNT_FIELDS else fee[field]
+            for field in FEE_AUDIT_FIELDS}
+
+def _in_rupees(quote):
+    return {name: to_rupees(amount) for name, amount in quote.items()}
+
 # ...existing code...
 
 # Add the new routes here
 @bp.route('/get/<string:fee_id>')
 @login_required
+@versions.versioned(versions.FEES)
 def get_fee(fee_id):
     fee = Fee.objects.get_or_404(pk=fee_id)
     return jsonify({
         'month': fee.month,
         'year': fee.year,
-        'base_fee': fee.base_fee,
-        'hostel_food_fee': fee.hostel_food_fee,
-        'milk_fee': fee.milk_fee,
-        'discount': fee.discount
+        'base_fee': to_rupees(fee.base_fee),
+        'hostel_food_fee': to_rupees(fee.hostel_food_fee),
+        'milk_fee': to_rupees(fee.milk_fee),
+        'discount': to_rupees(fee.discount)
     })
 
 @bp.route('/edit/<string:fee_id>', methods=['POST'])
@@ -32,60 +52,40 @@ def get_fee(fee_id):
 def edit_fee(fee_id):
     fee = Fee.objects.get_or_404(pk=fee_id)
     try:
-        old_data = {
-            'month': fee.month,
-            'year': fee.year,
-            'base_fee': fee.base_fee,
-            'hostel_food_fee': fee.hostel_food_fee,
-            'milk_fee': fee.milk_fee,
-            'discount': fee.discount,
-            'total_fee': fee.total_fee
-        }
+        old_data = {field: fee[field] for field in FEE_AUDIT_FIELDS}
+        old_values = _audit_values(fee)
         fee.month = request.form['month']
         fee.year = request.form['year']
-        fee.base_fee = float(request.form['base_fee'])
-        fee.hostel_food_fee = float(request.form['hostel_food_fee'])
-        fee.milk_fee = float(request.form['milk_fee'])
-        fee.discount = float(request.form['discount'])
+        fee.base_fee = to_paise(request.form['base_fee'])
+        fee.hostel_food_fee = to_paise(request.form['hostel_food_fee'])
+        fee.milk_fee = to_paise(request.form['milk_fee'])
+        fee.discount = to_paise(request.form['discount'])
         fee.total_fee = fee.base_fee + fee.hostel_food_fee + fee.milk_fee - fee.discount
         fee.updated_at = datetime.utcnow()
 
-        # Audit log for changes
-        changes = []
-        for key, old_value in old_data.items():
-            new_value = getattr(fee, key)
-            if old_value != new_value:
-                changes.append(f"{key}: {old_value}   {new_value}")
+        fee.save()
+        dashboard.fee_changed(old_data['year'], old_data['total_fee'], fee)
+        balances.fee_changed(old_data, fee)
+        versions.bump(versions.FEES)
+
+        # Audit log for changes, written synchronously as it changes money owed
+        changes = audit.changes_between(old_values, _audit_values(fee))
         if changes:
             student = fee.student
-            log = AuditLog(
-                admin=current_user.id,
-                action='EDIT_FEE',
-                details=f'Edited fee for student {student.name} (Roll: {student.roll_number})\nChanges:\n' + '\n'.join(changes)
+            audit.record(
+                current_user.id, 'EDIT_FEE',
+                entity_type='fee', entity_id=fee.pk, changes=changes,
+                details=f'Edited fee for student {student.name} (Roll: {student.roll_number})',
+                strict=True
             )
-            log.save()
-
-        fee.save()
         flash('Fee updated successfully!', 'success')
     except Exception as e:
         flash(f'Error updating fee: {str(e)}', 'error')
     return redirect(url_for('fee.manage_fees'))
  
-class_fee_structure = {
-    '1': {'base': 5000, 'hostel': 20000, 'food': 15000},
-    '2': {'base': 5500, 'hostel': 20000, 'food': 15000},
-    '3': {'base': 6000, 'hostel': 20000, 'food': 15000},
-    '4': {'base': 6500, 'hostel': 20000, 'food': 15000},
-    '5': {'base': 7000, 'hostel': 20000, 'food': 15000},
-    '6': {'base': 7500, 'hostel': 20000, 'food': 15000},
-    '7': {'base': 8000, 'hostel': 20000, 'food': 15000},
-    '8': {'base': 8500, 'hostel': 20000, 'food': 15000},
-    '9': {'base': 9000, 'hostel': 20000, 'food': 15000},
-    '10': {'base': 9500, 'hostel': 20000, 'food': 15000},
-}
-
 @bp.route('/')
 @login_required
+@versions.versioned(versions.STUDENTS, versions.FEES)
 def manage_fees():
     # Get filter parameters
     status = request.args.get('status')
@@ -94,65 +94,64 @@ def manage_fees():
     # Base query parameters
     month = request.args.get('month') or str(datetime.now().month)
     year = request.args.get('year') or str(datetime.now().year)
-    
-    # In MongoDB, we can't easily do a left outer join in one query like SQL.
-    # Strategy:
-    # 1. Fetch all students (filtered by class if needed).
-    # 2. Fetch all fees for the given month/year.
-    # 3. Map fees to students in Python.
-    
-    # 1. Fetch Students
-    student_query = Student.objects
-    if class_filter:
-        student_query = student_query.filter(class_name=class_filter)
-    students = list(student_query.all())
-    
-    # 2. Fetch Fees
-    # We want fees for these students for the specific month/year
-    student_ids = [s.id for s in students]
-    fees = Fee.objects(student__in=student_ids, month=month, year=year)
-    fee_map = {f.student.id: f for f in fees}
-    
-    # 3. Combine
-    students_fees = []
-    for student in students:
-        fee = fee_map.get(student.id)
-        
-        # Apply status filter in Python
-        include = True
-        if status:
-            if status == 'fully_paid':
-                if not fee or fee.paid_amount < fee.total_fee:
-                    include = False
-            elif status == 'pending':
-                if fee and fee.paid_amount >= fee.total_fee:
-                    include = False
-                # If fee is None, it's pending (not even created), so include it
-            elif status == 'discounted':
-                if not fee or fee.discount <= 0:
-                    include = False
-        
-        if include:
-            # Emulate the SQL result tuple (Student, Fee)
-            students_fees.append((student, fee))
-            
-    return render_template('fee/manage.html', students_fees=students_fees, class_fee_structure=class_fee_structure, now=datetime.now())
+    # Keyset pagination: roll number of the last row of the previous page
+    after = request.args.get('after')
+
+    # Join, status filter and pagination all run in one aggregation, once
+    # the streamed page reaches the table
+    grid = FeeGridPage(month, year, class_name=class_filter, status=status, after=after)
+    filters = {k: v for k, v in request.args.items() if k != 'after'}
+    first_url = url_for('fee.manage_fees', **filters) if after else None
+
+    return stream_template('fee/manage.html', grid=grid, filters=filters, year=year,
+                           first_url=first_url, now=datetime.now())
+
+@bp.route('/defaulters')
+@login_required
+def defaulters():
+    # Students owing money across all months, from the balance ledger
+    class_filter = request.args.get('class') or None
+    economic_filter = request.args.get('economic') or None
+    sort = request.args.get('sort', 'outstanding')
+    min_outstanding = request.args.get('min', 0, type=to_paise)
+    rows, totals = balances.defaulters(
+        class_name=class_filter, economic_status=economic_filter, min_outstanding=min_outstanding,
+        sort=sort, grace_days=current_app.config['ARREARS_GRACE_DAYS'],
+        totals_max_age=current_app.config['DEFAULTER_TOTALS_MAX_AGE']
+    )
+    return render_template('fee/defaulters.html', rows=rows, totals=totals, sort=sort,
+                           bucket_labels=['current'] + [label for label, _, _ in balances.AGE_BUCKETS],
+                           limit=balances.REPORT_LIMIT)
 
 @bp.route('/calculate/<string:student_id>')
 @login_required
 def calculate_fee(student_id):
     student = Student.objects.get_or_404(pk=student_id)
-    fees = class_fee_structure.get(student.class_name, {})
-    base_fee = fees.get('base', 0)
-    hostel_food_fee = fees.get('hostel', 0) if student.hostel_food_opted else 0
-    milk_fee = 500 if student.milk_opted else 0
-    total = base_fee + hostel_food_fee + milk_fee
-    return jsonify({
-        'base_fee': base_fee,
-        'hostel_food_fee': hostel_food_fee,
-        'milk_fee': milk_fee,
-        'total': total
-    })
+    year = request.args.get('year') or str(datetime.now().year)
+    try:
+        int(year)
+    except ValueError:
+        return jsonify({'error': 'year must be a number'}), 400
+    return jsonify(_in_rupees(quote_fee(student.class_name, student.hostel_food_opted, student.milk_opted,
+                                        student.economic_status, year)))
+
+@bp.route('/quotes', methods=['POST'])
+@login_required
+def quote_fees():
+    # Quotes for many students in one call: {"student_ids": [...], "year": "2025"}
+    data = request.get_json(silent=True) or {}
+    year = str(data.get('year') or datetime.now().year)
+    try:
+        student_ids = [ObjectId(student_id) for student_id in data.get('student_ids', [])]
+        int(year)
+    except (InvalidId, TypeError, ValueError):
+        return jsonify({'error': 'student_ids must be a list of ids and year a number'}), 400
+    students = Student._get_collection().find(
+        {'_id': {'$in': student_ids}},
+        {'class_name': 1, 'hostel_food_opted': 1, 'milk_opted': 1, 'economic_status': 1}
+    )
+    quotes = quote_students(students, year)
+    return jsonify({'year': year, 'quotes': {student_id: _in_rupees(quote) for student_id, quote in quotes.items()}})
 
 @bp.route('/add/<string:student_id>', methods=['POST'])
 @login_required
@@ -174,93 +173,88 @@ def add_fee(student_id):
             student=student,
             month=month,
             year=year,
-            base_fee=float(request.form['base_fee']),
-            hostel_food_fee=float(request.form['hostel_food_fee']),
-            milk_fee=float(request.form['milk_fee']),
-            discount=float(request.form.get('discount', 0)),
+            base_fee=to_paise(request.form['base_fee']),
+            hostel_food_fee=to_paise(request.form['hostel_food_fee']),
+            milk_fee=to_paise(request.form['milk_fee']),
+            discount=to_paise(request.form.get('discount', 0)),
         )
         # Calculate total fee
         fee.total_fee = fee.base_fee + fee.hostel_food_fee + fee.milk_fee - fee.discount
         fee.save()
+        dashboard.fee_added(fee)
+        balances.fee_added(fee, student)
+        versions.bump(versions.FEES)
         
         # Create audit log
-        log = AuditLog(
-            admin=current_user.id,
-            action='ADD_FEE',
-            details=f'Added fee for student {student.name} (Roll: {student.roll_number})\n' + \
-                    f'Base: {fee.base_fee}, Hostel+Food: {fee.hostel_food_fee}, Milk: {fee.milk_fee}\n' + \
-                    f'Discount: {fee.discount}, Total: {fee.total_fee}'
+        audit.record(
+            current_user.id, 'ADD_FEE',
+            entity_type='fee', entity_id=fee.pk,
+            changes=audit.created(_audit_values(fee)),
+            details=f'Added fee for student {student.name} (Roll: {student.roll_number})'
         )
-        log.save()
         flash('Fee added successfully!', 'success')
     except Exception as e:
         flash(f'Error adding fee: {str(e)}', 'error')
     return redirect(url_for('fee.manage_fees'))
 
+@bp.route('/generate', methods=['POST'])
+@login_required
+def generate_fees():
+    month = request.form.get('month') or str(datetime.now().month)
+    year = request.form.get('year') or str(datetime.now().year)
+    class_filter = request.form.get('class') or None
+    try:
+        month, year = normalize_period(month, year)
+        result = generate_monthly_fees(
+            month, year, current_user.id, class_name=class_filter,
+            chunk_size=current_app.config['FEE_GENERATION_CHUNK_SIZE']
+        )
+        flash(f"Generated {result['created']} fee record(s), skipped {result['skipped']} existing", 'success')
+    except Exception as e:
+        flash(f'Error generating fees: {str(e)}', 'error')
+    return redirect(url_for('fee.manage_fees', month=month, year=year, **({'class': class_filter} if class_filter else {})))
+
 @bp.route('/payment/<string:fee_id>', methods=['POST'])
 @login_required
 def add_payment(fee_id):
     fee = Fee.objects.get_or_404(pk=fee_id)
-    amount = float(request.form['amount'])
+    amount = to_paise(request.form['amount'])
     payment_method = request.form.get('payment_method', 'cash')
     transaction_id = request.form.get('transaction_id') if payment_method == 'qr' else None
     want_json = request.headers.get('X-Requested-With') == 'XMLHttpRequest'
 
     try:
-        if amount <= 0:
-            raise ValueError("Payment amount must be greater than 0")
-
-        remaining = fee.total_fee - fee.paid_amount
-        if amount > remaining:
-            raise ValueError(f"Payment amount exceeds remaining fee ({remaining})")
-
         # Create payment record
         payment = PaymentHistory(
-            student=fee.student,
+            student=fee.to_mongo()['student'],
             fee=fee,
             amount=amount,
-            receipt_number=f"RCP{datetime.now().strftime('%Y%m%d%H%M%S')}",
+            receipt_number=next_receipt_number(),
             created_by=current_user.id,
             payment_method=payment_method,
             transaction_id=transaction_id
         )
 
-        # Update fee paid amount
-        fee.paid_amount += amount
-
-        payment.save()
-        fee.save()
-
-        # Create audit log
-        student = fee.student
-        log = AuditLog(
-            admin=current_user.id,
-            action='ADD_PAYMENT',
-            details=f'Added payment for student {student.name} (Roll: {student.roll_number})\n' + \
-                    f'Amount: {amount}, Receipt: {payment.receipt_number}, Method: {payment_method}' + \
-                    (f', Txn: {transaction_id}' if transaction_id else '')
-        )
-        log.save()
+        # Only the money movement happens on the request path: the payment
+        # and a conditional $inc of the fee's paid_amount. The dashboard
+        # update, audit entry and receipt are written by background jobs.
+        updated_fee = apply_payment(payment)
+        enqueue_payment_side_effects(str(current_user.id), str(payment.id), updated_fee, amount,
+                                     updated_fee['total_fee'] - updated_fee['paid_amount'])
 
         flash('Payment recorded successfully!', 'success')
 
-        # Generate receipt PDF using utility
-        # student and fee are available in this scope
-        buffer = generate_receipt_pdf(payment, student, fee, current_user)
-
+        receipt_url = url_for('fee.generate_receipt', payment_id=str(payment.id))
         if want_json:
             return jsonify({
                 'success': True,
                 'message': 'Payment recorded successfully!',
-                'receipt_url': url_for('fee.generate_receipt', payment_id=str(payment.id))
+                'receipt_url': receipt_url,
+                'receipt_status_url': url_for('fee.receipt_status', payment_id=str(payment.id))
             })
         else:
-            # Return PDF directly
-            buffer.seek(0)
-            response = make_response(buffer.getvalue())
-            response.mimetype = 'application/pdf'
-            response.headers['Content-Disposition'] = f'inline; filename=receipt_{payment.receipt_number}.pdf'
-            return response
+            # The receipt view renders on demand if the job has not run yet
+            return redirect(receipt_url)
 
     except Exception as e:
         flash(f'Error recording payment: {str(e)}', 'error')
@@ -276,54 +270,27 @@ def add_payment(fee_id):
 @login_required
 def generate_receipt(payment_id):
     payment = PaymentHistory.objects.get_or_404(pk=payment_id)
-    student = payment.student
-    fee = payment.fee
-    admin = current_user
-    
-    # Create PDF
-    buffer = BytesIO()
-    p = canvas.Canvas(buffer, pagesize=letter)
-    
-    # School header
-    p.setFont("Helvetica-Bold", 18)
-    p.drawCentredString(300, 750, "School Fee Receipt")
-    
-    # Fee details
-    p.drawString(50, 540, "Fee Details:")
-    p.drawString(70, 520, f"Base Fee:  {fee.base_fee}")
-    if fee.hostel_food_fee:
-        p.drawString(70, 500, f"Hostel+Food Fee:  {fee.hostel_food_fee}")
-    if fee.milk_fee:
-        p.drawString(70, 480, f"Milk Fee:  {fee.milk_fee}")
-    if fee.discount:
-        p.drawString(70, 460, f"Discount:  {fee.discount}")
-    p.drawString(50, 420, f"Total Fee:  {fee.total_fee}")
-    p.drawString(50, 400, f"Amount Paid:  {payment.amount}")
-    p.drawString(50, 380, f"Balance:  {fee.total_fee - fee.paid_amount}")
-    p.drawString(50, 360, f"Payment Method: {payment.payment_method}")
-    if payment.transaction_id:
-        p.drawString(50, 340, f"Transaction ID: {payment.transaction_id}")
-    # Signature
-    p.drawString(50, 300, "Received by:")
-    p.drawString(50, 280, admin.username)
-    if fee.milk_fee:
-        p.drawString(70, 480, f"Milk Fee: ₹{fee.milk_fee}")
-    if fee.discount:
-        p.drawString(70, 460, f"Discount: ₹{fee.discount}")
-    p.drawString(50, 420, f"Total Fee: ₹{fee.total_fee}")
-    p.drawString(50, 400, f"Amount Paid: ₹{payment.amount}")
-    p.drawString(50, 380, f"Balance: ₹{fee.total_fee - fee.paid_amount}")
-    
-    # Signature
-    p.drawString(50, 300, "Received by:")
-    p.drawString(50, 280, admin.username)
-    
-    p.showPage()
-    p.save()
-    
-    buffer.seek(0)
-    response = make_response(buffer.getvalue())
+    data, etag, last_modified = get_receipt(payment)
+    return _receipt_response(payment, data, etag, last_modified)
+
+@bp.route('/receipt/<string:payment_id>/status')
+@login_required
+def receipt_status(payment_id):
+    # Polled by the fee page after a payment. Answers at once: a request
+    # waiting here would hold one of the few sync workers.
+    return jsonify({
+        'ready': receipt_ready(payment_id),
+        'receipt_url': url_for('fee.generate_receipt', payment_id=payment_id)
+    })
+
+def _receipt_response(payment, data, etag, last_modified):
+    # Receipts never change for a given template version, so clients can
+    # revalidate with If-None-Match / If-Modified-Since and get a 304
+    response = make_response(data)
     response.mimetype = 'application/pdf'
     response.headers['Content-Disposition'] = f'inline; filename=receipt_{payment.receipt_number}.pdf'
-    
-    return response
\ No newline at end of file
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
@@ -1,35 +1,37 @@
-from flask import Blueprint, render_template, redirect, url_for, flash, request, jsonify
+from flask import Blueprint, render_template, redirect, url_for, flash, request, jsonify, current_app
 from flask_login import login_required, current_user
-from application.models import Student, AuditLog, Fee, PaymentHistory
+from application.models import Student, Fee, PaymentHistory
 from application import db
+from application.services import audit, balances, dashboard, versions
+from application.services.student_import import import_students, rows_from_file
+from application.services.student_list import student_rows
+from application.services.streaming import stream_template
 from datetime import datetime
 
 bp = Blueprint('student', __name__, url_prefix='/student')
 
+# Fields recorded in the audit log's changes
+STUDENT_AUDIT_FIELDS = ('name', 'roll_number', 'class_name', 'section', 'contact', 'economic_status',
+                        'hostel_food_opted', 'milk_opted')
+
 @bp.route('/')
 @login_required
+@versions.versioned(versions.STUDENTS)
 def list_students():
     # Get filter parameters
     class_filter = request.args.get('class')
     hostel_food_filter = request.args.get('hostel_food')
     milk_filter = request.args.get('milk')
     economic_filter = request.args.get('economic')
-    
-    # Base query
-    query = Student.objects
-    
-    # Apply filters
-    if class_filter:
-        query = query.filter(class_name=class_filter)
-    if hostel_food_filter:
-        query = query.filter(hostel_food_opted=(hostel_food_filter == 'yes'))
-    if milk_filter:
-        query = query.filter(milk_opted=(milk_filter == 'yes'))
-    if economic_filter:
-        query = query.filter(economic_status=economic_filter)
-    
-    students = query.all()
-    return render_template('student/list.html', students=students)
+
+    # Rows are read from a projected cursor while the page streams
+    students = student_rows(
+        class_name=class_filter,
+        hostel_food_opted=(hostel_food_filter == 'yes') if hostel_food_filter else None,
+        milk_opted=(milk_filter == 'yes') if milk_filter else None,
+        economic_status=economic_filter,
+    )
+    return stream_template('student/list.html', students=students)
 
 @bp.route('/add', methods=['GET', 'POST'])
 @login_required
@@ -48,14 +50,16 @@ def add_student():
             )
             
             student.save()
+            dashboard.student_added(student)
+            versions.bump(versions.STUDENTS)
             
             # Create audit log
-            log = AuditLog(
-                admin=current_user.id,
-                action='CREATE_STUDENT',
+            audit.record(
+                current_user.id, 'CREATE_STUDENT',
+                entity_type='student', entity_id=student.pk,
+                changes=audit.created({field: student[field] for field in STUDENT_AUDIT_FIELDS}),
                 details=f'Created student {student.name} (Roll: {student.roll_number})'
             )
-            log.save()
             
             flash('Student added successfully!', 'success')
             return redirect(url_for('student.list_students'))
@@ -65,6 +69,28 @@ def add_student():
     
     return render_template('student/add.html')
 
+@bp.route('/import', methods=['GET', 'POST'])
+@login_required
+def import_students_file():
+    report = None
+    if request.method == 'POST':
+        upload = request.files.get('file')
+        if not upload or not upload.filename:
+            flash('Please choose a CSV or XLSX file', 'error')
+        else:
+            try:
+                report = import_students(
+                    rows_from_file(upload.stream, upload.filename), current_user.id,
+                    batch_size=current_app.config['STUDENT_IMPORT_BATCH_SIZE']
+                )
+                flash(f'Imported students: {report.inserted} created, {report.updated} updated, '
+                      f'{report.error_count} row(s) rejected',
+                      'success' if not report.error_count else 'warning')
+            except Exception as e:
+                flash(f'Error importing students: {str(e)}', 'error')
+
+    return render_template('student/import.html', report=report)
+
 @bp.route('/edit/<string:id>', methods=['GET', 'POST'])
 @login_required
 def edit_student(id):
@@ -72,16 +98,7 @@ def edit_student(id):
     
     if request.method == 'POST':
         try:
-            old_data = {
-                'name': student.name,
-                'roll_number': student.roll_number,
-                'class_name': student.class_name,
-                'section': student.section,
-                'contact': student.contact,
-                'economic_status': student.economic_status,
-                'hostel_food_opted': student.hostel_food_opted,
-                'milk_opted': student.milk_opted
-            }
+            old_data = {field: student[field] for field in STUDENT_AUDIT_FIELDS}
             
             student.name = request.form['name']
             student.roll_number = request.form['roll_number']
@@ -93,22 +110,20 @@ def edit_student(id):
             student.milk_opted = bool(request.form.get('milk_opted'))
             student.updated_at = datetime.utcnow()
             
+            student.save()
+
             # Create audit log
-            changes = []
-            for key, old_value in old_data.items():
-                new_value = getattr(student, key)
-                if old_value != new_value:
-                    changes.append(f"{key}: {old_value} → {new_value}")
-            
+            changes = audit.changes_between(old_data, {field: student[field] for field in STUDENT_AUDIT_FIELDS})
             if changes:
-                log = AuditLog(
-                    admin=current_user.id,
-                    action='EDIT_STUDENT',
-                    details=f'Updated student {student.name} (Roll: {student.roll_number})\nChanges:\n' + '\n'.join(changes)
+                audit.record(
+                    current_user.id, 'EDIT_STUDENT',
+                    entity_type='student', entity_id=student.pk, changes=changes,
+                    details=f'Updated student {student.name} (Roll: {student.roll_number})'
                 )
-                log.save()
-            
-            student.save()
+
+            dashboard.student_changed(old_data, student)
+            balances.student_changed(student)
+            versions.bump(versions.STUDENTS)
             flash('Student updated successfully!', 'success')
             return redirect(url_for('student.list_students'))
             
@@ -122,22 +137,27 @@ def edit_student(id):
 def delete_student(id):
     student = Student.objects.get_or_404(pk=id)
     try:
-        # Create audit log before deletion
-        log = AuditLog(
-            admin=current_user.id,
-            action='DELETE_STUDENT',
-            details=f'Deleted student {student.name} (Roll: {student.roll_number})'
+        # Create audit log before deletion; written synchronously, as the
+        # record of the student is gone afterwards
+        audit.record(
+            current_user.id, 'DELETE_STUDENT',
+            entity_type='student', entity_id=student.pk,
+            changes={field: [student[field], None] for field in STUDENT_AUDIT_FIELDS},
+            details=f'Deleted student {student.name} (Roll: {student.roll_number})',
+            strict=True
         )
-        log.save()
 
         # Delete related payments and fees
         # In MongoEngine, if we set reverse_delete_rule=CASCADE in models, this happens automatically.
         # But since we didn't set it explicitly yet, we can do manual deletion or rely on the fact that ReferenceField doesn't enforce FK constraints strictly like SQL.
         # Ideally, we should delete them.
+        dashboard.student_removed(student)
+        balances.student_removed(student)
         Fee.objects(student=student).delete()
         PaymentHistory.objects(student=student).delete()
 
         student.delete()
+        versions.bump(versions.STUDENTS, versions.FEES)
         flash('Student deleted successfully!', 'success')
     except Exception as e:
         flash(f'Error deleting student: {str(e)}', 'error')
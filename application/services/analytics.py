@@ -0,0 +1,207 @@
+import threading
+import time
+from datetime import datetime, timedelta
+from bson import ObjectId
+from pymongo import DeleteOne, UpdateOne
+from flask import current_app
+from application.models import Student, PaymentHistory, CollectionRollup
+from application.services.connections import REPORTING
+from application.services.jobs import inc_once, task
+from application.services.money import to_rupees
+
+# Length of the 'YYYY-MM-DD' prefix that identifies a period
+INTERVALS = {'day': 10, 'month': 7, 'year': 4}
+
+# Rollup fields a series can be split by
+GROUPS = ('payment_method', 'class_name')
+
+
+def school_timezone():
+    # Days are counted in the school's timezone. pytz is imported when first
+    # needed, not when a worker starts.
+    import pytz
+    return pytz.timezone(current_app.config['ANALYTICS_TIMEZONE'])
+
+
+def local_day(moment, tz):
+    import pytz
+    return pytz.utc.localize(moment).astimezone(tz).strftime('%Y-%m-%d')
+
+
+def _inc(day, payment_method, class_name, payments, amount, payment_id):
+    inc_once(
+        CollectionRollup._get_collection(),
+        {'day': day, 'payment_method': payment_method, 'class_name': class_name}, payment_id,
+        {'$inc': {'payments': payments, 'amount': amount}, '$set': {'updated_at': datetime.utcnow()}},
+    )
+
+
+@task('analytics.payment_added')
+def payment_added(payment_id):
+    # Counts the payment under the class its student is in when it is recorded
+    payment = PaymentHistory._get_collection().find_one(
+        {'_id': ObjectId(payment_id)}, {'student': 1, 'amount': 1, 'payment_method': 1, 'payment_date': 1})
+    if payment is None:
+        return
+    student = Student._get_collection().find_one({'_id': payment['student']}, {'class_name': 1})
+    _inc(local_day(payment['payment_date'], school_timezone()), payment.get('payment_method', 'cash'),
+         student['class_name'] if student else '', 1, payment['amount'], payment['_id'])
+
+
+def parse_day(value):
+    # A 'YYYY-MM-DD' day as a date. strptime also takes '2025-1-5', so days
+    # are compared and cached as date.isoformat(), never as given.
+    return datetime.strptime(value, '%Y-%m-%d').date()
+
+
+def utc_bounds(start, end, tz):
+    # UTC datetimes of the first moment of start and the day after end
+    import pytz
+    first = tz.localize(datetime.strptime(start, '%Y-%m-%d'))
+    last = tz.localize(datetime.strptime(end, '%Y-%m-%d') + timedelta(days=1))
+    return first.astimezone(pytz.utc).replace(tzinfo=None), last.astimezone(pytz.utc).replace(tzinfo=None)
+
+
+def backfill_rollups(start, end):
+    # Rebuilds the rollups of days start..end ('YYYY-MM-DD', inclusive) from
+    # PaymentHistory. Returns the number of rollup documents written.
+    start, end = parse_day(start).isoformat(), parse_day(end).isoformat()
+    tz = school_timezone()
+    since, until = utc_bounds(start, end, tz)
+    classes = {doc['_id']: doc.get('class_name', '') for doc in
+               Student._get_collection().find({}, {'class_name': 1})}
+    payments = PaymentHistory._get_collection().find(
+        {'payment_date': {'$gte': since, '$lt': until}, 'status': {'$ne': 'pending'}},
+        {'student': 1, 'amount': 1, 'payment_method': 1, 'payment_date': 1}
+    )
+    rollups = {}
+    for payment in payments:
+        key = (local_day(payment['payment_date'], tz), payment.get('payment_method', 'cash'),
+               classes.get(payment['student'], ''))
+        counts = rollups.setdefault(key, [0, 0, []])
+        counts[0] += 1
+        counts[1] += payment['amount']
+        counts[2].append(payment['_id'])
+
+    # Amounts are set rather than replaced: the payments counted already are
+    # kept and the ones found here added, so a payment_added job still queued
+    # (or retried) after the backfill does not count its payment again
+    now = datetime.utcnow()
+    collection = CollectionRollup._get_collection()
+    operations = [
+        UpdateOne({'day': day, 'payment_method': method, 'class_name': class_name}, {
+            '$set': {'payments': payments, 'amount': amount, 'updated_at': now},
+            '$addToSet': {'counted_payments': {'$each': payment_ids}},
+        }, upsert=True)
+        for (day, method, class_name), (payments, amount, payment_ids) in rollups.items()
+    ]
+    for stale in collection.find({'day': {'$gte': start, '$lte': end}}, {'day': 1, 'payment_method': 1,
+                                                                          'class_name': 1}):
+        if (stale['day'], stale['payment_method'], stale['class_name']) not in rollups:
+            operations.append(DeleteOne({'_id': stale['_id']}))
+    if operations:
+        collection.bulk_write(operations, ordered=False)
+    return len(rollups)
+
+
+def _periods(start, end, interval):
+    # Every period key between start and end, so charts have no gaps
+    periods = []
+    day = parse_day(start)
+    last = parse_day(end)
+    size = INTERVALS[interval]
+    while day <= last:
+        key = day.isoformat()[:size]
+        if not periods or periods[-1] != key:
+            periods.append(key)
+        day += timedelta(days=1)
+    return periods
+
+
+def collection_series(start, end, interval='day', by=None):
+    # Collections between two days as chart-ready series (amounts in rupees),
+    # read from the rollups only. by splits the series by payment method or
+    # class.
+    if interval not in INTERVALS:
+        raise ValueError(f'interval must be one of {", ".join(INTERVALS)}')
+    if by and by not in GROUPS:
+        raise ValueError(f'by must be one of {", ".join(GROUPS)}')
+    # The day field holds zero-padded 'YYYY-MM-DD' strings
+    start, end = parse_day(start).isoformat(), parse_day(end).isoformat()
+    if start > end:
+        raise ValueError('start must not be after end')
+
+    group = {'period': {'$substr': ['$day', 0, INTERVALS[interval]]}}
+    if by:
+        group['key'] = f'${by}'
+    pipeline = [
+        {'$match': {'day': {'$gte': start, '$lte': end}}},
+        {'$group': {'_id': group, 'amount': {'$sum': '$amount'}, 'payments': {'$sum': '$payments'}}},
+    ]
+
+    periods = _periods(start, end, interval)
+    index = {period: i for i, period in enumerate(periods)}
+    series = {}
+    # Charts read from a secondary when there is one
+    for row in CollectionRollup.objects.using(REPORTING).aggregate(pipeline):
+        key = row['_id'].get('key', 'all') if by else 'all'
+        values = series.setdefault(key, {'amount': [0] * len(periods), 'payments': [0] * len(periods)})
+        i = index[row['_id']['period']]
+        values['amount'][i] += row['amount']
+        values['payments'][i] += row['payments']
+
+    return {
+        'start': start,
+        'end': end,
+        'interval': interval,
+        'by': by,
+        'periods': periods,
+        'series': [dict(key=key, amount=[to_rupees(amount) for amount in values['amount']],
+                        payments=values['payments']) for key, values in sorted(series.items())],
+        'total': {
+            'amount': to_rupees(sum(sum(values['amount']) for values in series.values())),
+            'payments': sum(sum(values['payments']) for values in series.values()),
+        },
+    }
+
+
+def default_range(days=30):
+    # The last days days, up to today in the school's timezone
+    today = datetime.now(school_timezone()).date()
+    return (today - timedelta(days=days - 1)).isoformat(), today.isoformat()
+
+
+class ResponseCache:
+    # Small per-process cache of computed responses, each kept ttl seconds
+    def __init__(self, ttl=60.0, max_size=256):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get_or_compute(self, key, compute):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > now:
+                return entry[1]
+        value = compute()
+        with self._lock:
+            if len(self._entries) >= self.max_size:
+                self._entries = {k: v for k, v in self._entries.items() if v[0] > now}
+                if len(self._entries) >= self.max_size:
+                    self._entries.clear()
+            self._entries[key] = (now + self.ttl, value)
+        return value
+
+
+cache = ResponseCache()
+
+
+def init_app(app):
+    cache.ttl = app.config['ANALYTICS_CACHE_TTL']
+
+
+def cached_collection_series(start, end, interval='day', by=None):
+    return cache.get_or_compute((start, end, interval, by),
+                                lambda: collection_series(start, end, interval, by))
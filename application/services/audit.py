@@ -0,0 +1,141 @@
+import atexit
+import logging
+import os
+import threading
+import time
+from bson import ObjectId
+from application.models import AuditLog, PaymentHistory
+from application.services.jobs import task
+from application.services.money import format_rupees
+
+logger = logging.getLogger(__name__)
+
+
+def changes_between(old, new):
+    # {field: [old, new]} for every field whose value differs
+    return {key: [old.get(key), new.get(key)] for key in new if old.get(key) != new.get(key)}
+
+
+def created(fields):
+    return {key: [None, value] for key, value in fields.items()}
+
+
+class AuditSink:
+    # Collects audit entries in process and writes them with insert_many once
+    # max_size entries are waiting or the oldest has waited flush_interval
+    # seconds. Entries are flushed at exit (atexit, and the gunicorn worker
+    # hooks in gunicorn.conf.py). Entries recorded with strict=True, or any
+    # entry when max_size is 0, are written before record() returns.
+    def __init__(self, max_size=100, flush_interval=2.0):
+        self.max_size = max_size
+        self.flush_interval = flush_interval
+        self._entries = []
+        self._lock = threading.Lock()
+        self._oldest = None
+        self._pid = None
+        self._wake = threading.Event()
+
+    def configure(self, max_size, flush_interval):
+        self.max_size = max_size
+        self.flush_interval = flush_interval
+
+    def record(self, admin, action, entity_type=None, entity_id=None, changes=None, details=None,
+               strict=False):
+        entry = AuditLog(
+            admin=admin.pk if hasattr(admin, 'pk') else ObjectId(admin),
+            action=action,
+            details=details,
+            entity_type=entity_type,
+            entity_id=str(entity_id) if entity_id is not None else None,
+            changes=changes or {},
+        )
+        entry.validate()
+        doc = entry.to_mongo().to_dict()
+        if strict or not self.max_size:
+            AuditLog._get_collection().insert_one(doc)
+            return
+        self._ensure_started()
+        with self._lock:
+            if not self._entries:
+                self._oldest = time.monotonic()
+            self._entries.append(doc)
+            full = len(self._entries) >= self.max_size
+        if full:
+            self.flush()
+
+    def _ensure_started(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            # Entries copied from the parent by a fork are the parent's to write
+            self._entries = []
+            self._wake.clear()
+            threading.Thread(target=self._run, daemon=True).start()
+            self._pid = os.getpid()
+            atexit.register(self.flush)
+
+    def _run(self):
+        while not self._wake.wait(self.flush_interval / 2):
+            with self._lock:
+                due = self._entries and time.monotonic() - self._oldest >= self.flush_interval
+            if due:
+                self.flush()
+
+    def flush(self):
+        if self._pid != os.getpid():
+            return
+        with self._lock:
+            entries, self._entries = self._entries, []
+        if not entries:
+            return
+        try:
+            AuditLog._get_collection().insert_many(entries, ordered=False)
+        except Exception:
+            # Kept for the next flush
+            logger.exception('Writing %d audit entries failed', len(entries))
+            with self._lock:
+                if not self._entries:
+                    self._oldest = time.monotonic()
+                self._entries = entries + self._entries
+
+
+sink = AuditSink()
+
+
+def init_app(app):
+    sink.configure(app.config['AUDIT_BUFFER_SIZE'], app.config['AUDIT_FLUSH_INTERVAL'])
+
+
+def record(admin, action, **kwargs):
+    sink.record(admin, action, **kwargs)
+
+
+def flush():
+    sink.flush()
+
+
+@task('audit.payment')
+def log_payment(admin_id, payment_id):
+    # Written after the payment request has returned; strict so the job is
+    # only finished once the entry is stored
+    payment = PaymentHistory.objects(pk=payment_id).first()
+    if payment is None:
+        return
+    student = payment.student
+    record(
+        admin_id, 'ADD_PAYMENT',
+        entity_type='payment', entity_id=payment.pk,
+        changes=created({
+            'amount': format_rupees(payment.amount),
+            'receipt_number': payment.receipt_number,
+            'payment_method': payment.payment_method,
+            'transaction_id': payment.transaction_id,
+            'fee': str(payment.to_mongo()['fee']),
+        }),
+        details=f'Added payment for student {student.name} (Roll: {student.roll_number})\n' + \
+                f'Amount: ₹{format_rupees(payment.amount)}, Receipt: {payment.receipt_number}, Method: {payment.payment_method}' + \
+                (f', Txn: {payment.transaction_id}' if payment.transaction_id else ''),
+        strict=True,
+    )
@@ -0,0 +1,157 @@
+import heapq
+import logging
+from datetime import datetime, timedelta
+from bson import ObjectId
+from bson.errors import InvalidId
+from mongoengine import Q
+from pymongo.errors import BulkWriteError, CollectionInvalid, OperationFailure
+from application.models import AuditLog, AuditArchive
+from application.services import references
+from application.services.connections import REPORTING
+
+logger = logging.getLogger(__name__)
+
+# Entries per page of the audit viewer
+PAGE_SIZE = 50
+
+# Entries moved from audit_log to audit_archive per insert_many/delete_many
+ROTATE_BATCH_SIZE = 1000
+
+DUPLICATE_KEY = 11000
+
+
+def create_archive(compressor='zstd'):
+    # Creates audit_archive with the given WiredTiger block compressor (the
+    # server default is snappy; zstd stores JSON-like audit entries in
+    # roughly half the space). Does nothing if the collection exists.
+    db = AuditArchive._get_db()
+    name = AuditArchive._get_collection_name()
+    if name in db.list_collection_names():
+        return False
+    options = {}
+    if compressor:
+        options['storageEngine'] = {'wiredTiger': {'configString': f'block_compressor={compressor}'}}
+    try:
+        db.create_collection(name, **options)
+    except CollectionInvalid:
+        # Created by another process in the meantime
+        return False
+    except (OperationFailure, NotImplementedError):
+        # Servers that do not allow storage options (shared Atlas tiers,
+        # mongomock) get the default compression
+        logger.warning('Creating %s with %s compression failed; using the server default', name, compressor)
+        db.create_collection(name)
+    return True
+
+
+def _rotation_query(hot_days, max_entries, now=None):
+    # Entries older than hot_days, and every entry beyond the newest
+    # max_entries; either limit is off when 0
+    clauses = []
+    if hot_days:
+        clauses.append({'timestamp': {'$lt': (now or datetime.utcnow()) - timedelta(days=hot_days)}})
+    hot = AuditLog._get_collection()
+    if max_entries and hot.estimated_document_count() > max_entries:
+        newest = hot.find({}, {'timestamp': 1}).sort([('timestamp', -1), ('_id', -1)]).skip(max_entries).limit(1)
+        boundary = next(newest, None)
+        if boundary is not None:
+            clauses.append(_at_or_before(boundary['timestamp'], boundary['_id']))
+    if not clauses:
+        return None
+    return clauses[0] if len(clauses) == 1 else {'$or': clauses}
+
+
+def _at_or_before(timestamp, entry_id):
+    return {'$or': [
+        {'timestamp': {'$lt': timestamp}},
+        {'timestamp': timestamp, '_id': {'$lte': entry_id}},
+    ]}
+
+
+def rotate(hot_days, max_entries, batch_size=ROTATE_BATCH_SIZE, compressor='zstd', now=None):
+    # Moves entries out of audit_log into audit_archive, oldest first, and
+    # returns how many were moved. Each batch is copied before it is deleted
+    # and keeps its _id, so a rotation interrupted between the two is
+    # finished by the next run without duplicates.
+    query = _rotation_query(hot_days, max_entries, now)
+    if query is None:
+        return 0
+    create_archive(compressor)
+    hot = AuditLog._get_collection()
+    archive = AuditArchive._get_collection()
+    moved = 0
+    while True:
+        batch = list(hot.find(query).sort([('timestamp', 1), ('_id', 1)]).limit(batch_size))
+        if not batch:
+            return moved
+        try:
+            archive.insert_many(batch, ordered=False)
+        except BulkWriteError as e:
+            # Already archived by an earlier, interrupted run
+            if any(error['code'] != DUPLICATE_KEY for error in e.details['writeErrors']):
+                raise
+        moved += hot.delete_many({'_id': {'$in': [doc['_id'] for doc in batch]}}).deleted_count
+
+
+def encode_cursor(entry):
+    return f'{entry.timestamp.isoformat()}_{entry.pk}'
+
+
+def decode_cursor(cursor):
+    # (timestamp, ObjectId) of the last entry of the previous page
+    try:
+        timestamp, entry_id = cursor.rsplit('_', 1)
+        return datetime.fromisoformat(timestamp), ObjectId(entry_id)
+    except (ValueError, InvalidId):
+        raise ValueError(f'invalid page cursor {cursor!r}')
+
+
+def _page(document, filters, before, limit):
+    queryset = document.objects.using(REPORTING).filter(**filters)
+    if before:
+        timestamp, entry_id = before
+        queryset = queryset.filter(Q(timestamp__lt=timestamp) | Q(timestamp=timestamp, id__lt=entry_id))
+    return list(queryset.order_by('-timestamp', '-id').limit(limit))
+
+
+def search(admin=None, action=None, since=None, until=None, before=None, limit=PAGE_SIZE):
+    # One page of entries from both tiers, newest first: returns
+    # (entries, next_before) where next_before is the cursor of the next page,
+    # None on the last one. since/until are UTC datetimes (until exclusive),
+    # before a cursor from encode_cursor. Each tier answers from an index
+    # on (filter field, timestamp, _id), however far back the page is.
+    filters = {}
+    if admin:
+        filters['admin'] = ObjectId(admin)
+    if action:
+        filters['action'] = action
+    if since:
+        filters['timestamp__gte'] = since
+    if until:
+        filters['timestamp__lt'] = until
+    before = decode_cursor(before) if before else None
+
+    # audit_log is read first: an entry rotated between the two reads is then
+    # seen twice (and dropped once below) rather than missed
+    hot = _page(AuditLog, filters, before, limit + 1)
+    archived = _page(AuditArchive, filters, before, limit + 1)
+    entries, seen = [], set()
+    for entry in heapq.merge(hot, archived, key=lambda entry: (entry.timestamp, entry.pk), reverse=True):
+        if entry.pk not in seen:
+            seen.add(entry.pk)
+            entries.append(entry)
+        if len(entries) > limit:
+            break
+
+    next_before = None
+    if len(entries) > limit:
+        entries = entries[:limit]
+        next_before = encode_cursor(entries[-1])
+    return references.resolve(entries, 'admin'), next_before
+
+
+def actions():
+    # Action names for the viewer's filter, from the action index of each tier
+    names = set(AuditLog.objects.using(REPORTING).distinct('action'))
+    names.update(AuditArchive.objects.using(REPORTING).distinct('action'))
+    return sorted(names)
@@ -0,0 +1,306 @@
+import time
+from datetime import date, datetime, timedelta
+from bson import ObjectId
+from pymongo import DeleteMany, DeleteOne, UpdateOne
+from application.models import Student, Fee, StudentBalance, DashboardSummary
+from application.services import connections
+from application.services.jobs import enqueue, inc_once, task
+
+# Age buckets of overdue amounts: (label, first day overdue, last day or None)
+AGE_BUCKETS = (
+    ('1-30', 1, 30),
+    ('31-60', 31, 60),
+    ('61-90', 61, 90),
+    ('90+', 91, None),
+)
+
+# A month's fee falls due this many days after the 1st of the month
+DEFAULT_GRACE_DAYS = 15
+
+# Largest number of rows the defaulters report returns
+REPORT_LIMIT = 500
+
+SORTS = {
+    'outstanding': [('outstanding', -1)],
+    'roll_number': [('roll_number', 1)],
+    'name': [('name', 1)],
+}
+
+STUDENT_FIELDS = ('roll_number', 'name', 'class_name', 'economic_status')
+
+# Defaulters report totals in DashboardSummary: one document per
+# 'class_name|economic_status' and one for all defaulters
+TOTALS_SCOPE = 'defaulters'
+ALL_DEFAULTERS = '*'
+TOTALS = ('students', 'billed', 'paid', 'outstanding')
+DEFAULT_TOTALS_MAX_AGE = 60
+
+# When this process last queued a refresh of the totals (monotonic seconds)
+_refresh_queued = 0.0
+
+
+def period_key(month, year):
+    return f'{year}-{int(month):02d}'
+
+
+def _student_fields(student):
+    if isinstance(student, dict):
+        return {name: student.get(name) for name in STUDENT_FIELDS}
+    return {name: student[name] for name in STUDENT_FIELDS}
+
+
+def _changes(billed=0, paid=0, periods=None, student=None):
+    # The $inc of one student's balance; periods maps period keys to the
+    # change in what is owed for them. Amounts are paise.
+    inc = {'billed': billed, 'paid': paid, 'outstanding': billed - paid}
+    for key, amount in (periods or {}).items():
+        inc[f'periods.{key}'] = amount
+    update = {
+        '$inc': {name: value for name, value in inc.items() if value},
+        '$set': {'updated_at': datetime.utcnow()},
+    }
+    if student is not None:
+        update['$set'].update(_student_fields(student))
+    return update
+
+
+def _update(student_id, billed=0, paid=0, periods=None, student=None):
+    return UpdateOne({'student': student_id}, _changes(billed, paid, periods, student), upsert=True)
+
+
+def _write(operations):
+    if operations:
+        StudentBalance._get_collection().bulk_write(operations, ordered=False)
+
+
+def fee_added(fee, student=None):
+    student = student or fee.student
+    _write([_update(student.id, billed=fee.total_fee, paid=fee.paid_amount,
+                    periods={period_key(fee.month, fee.year): fee.total_fee - fee.paid_amount},
+                    student=student)])
+
+
+def fees_added(docs, students):
+    # Bulk fee generation: docs are the inserted fee documents, students the
+    # raw student documents by id. One bulk_write for the whole chunk.
+    _write([
+        _update(doc['student'], billed=doc['total_fee'], paid=doc['paid_amount'],
+                periods={period_key(doc['month'], doc['year']): doc['total_fee'] - doc['paid_amount']},
+                student=students.get(doc['student']))
+        for doc in docs
+    ])
+
+
+def fee_changed(old_data, fee):
+    # old_data holds month, year and total_fee from before the edit; editing
+    # a fee never touches paid_amount
+    old_key = period_key(old_data['month'], old_data['year'])
+    new_key = period_key(fee.month, fee.year)
+    delta = fee.total_fee - old_data['total_fee']
+    if old_key == new_key:
+        periods = {new_key: delta}
+    else:
+        periods = {old_key: fee.paid_amount - old_data['total_fee'],
+                   new_key: fee.total_fee - fee.paid_amount}
+    _write([_update(fee.to_mongo()['student'], billed=delta, periods=periods)])
+
+
+@task('balances.payment_added')
+def payment_added(student_id, period, amount, payment_id=None):
+    if payment_id is None:
+        # Enqueued before payment ids were passed
+        _write([_update(ObjectId(student_id), paid=amount, periods={period: -amount})])
+        return
+    inc_once(StudentBalance._get_collection(), {'student': ObjectId(student_id)}, ObjectId(payment_id),
+             _changes(paid=amount, periods={period: -amount}))
+
+
+def student_changed(student):
+    StudentBalance._get_collection().update_one(
+        {'student': student.id}, {'$set': _student_fields(student)})
+
+
+def students_changed(students):
+    # Import: raw student documents (with _id) whose details may have changed
+    _write([UpdateOne({'student': student['_id']}, {'$set': _student_fields(student)})
+            for student in students])
+
+
+def student_removed(student):
+    StudentBalance._get_collection().delete_one({'student': student.id})
+
+
+def age_buckets(periods, today=None, grace_days=DEFAULT_GRACE_DAYS):
+    # Splits what is owed per period into not yet due and overdue age buckets
+    today = today or date.today()
+    buckets = dict.fromkeys(['current'] + [label for label, _, _ in AGE_BUCKETS], 0)
+    for key, amount in periods.items():
+        if amount <= 0:
+            continue
+        year, month = key.split('-')
+        days = (today - (date(int(year), int(month), 1) + timedelta(days=grace_days))).days
+        label = 'current'
+        for name, first, last in AGE_BUCKETS:
+            if days >= first and (last is None or days <= last):
+                label = name
+        buckets[label] += amount
+    return buckets
+
+
+def defaulters(class_name=None, economic_status=None, min_outstanding=0, sort='outstanding',
+               limit=REPORT_LIMIT, grace_days=DEFAULT_GRACE_DAYS, totals_max_age=DEFAULT_TOTALS_MAX_AGE):
+    # Students who owe money, served by the partial outstanding, roll number
+    # and name indexes. Returns (rows, totals); rows carry the age buckets of
+    # each balance, totals cover every matching defaulter (not only the rows).
+    # min_outstanding is in paise; $gt keeps the query within the indexes'
+    # outstanding > 0 filter.
+    query = {'outstanding': {'$gt': max(min_outstanding - 1, 0)}}
+    if class_name:
+        query['class_name'] = class_name
+    if economic_status:
+        query['economic_status'] = economic_status
+    # A report: read from a secondary when there is one
+    balances = connections.collection(StudentBalance, connections.REPORTING)
+
+    today = date.today()
+    rows = []
+    for doc in balances.find(query, {'counted_payments': 0}).sort(SORTS.get(sort, SORTS['outstanding'])).limit(limit):
+        # $inc leaves out amounts that were never changed
+        for name in ('billed', 'paid', 'outstanding'):
+            doc.setdefault(name, 0)
+        doc['buckets'] = age_buckets(doc.get('periods', {}), today, grace_days)
+        rows.append(doc)
+
+    if min_outstanding > 0:
+        # Not kept in the summaries: add up the matching defaulters
+        totals = dict.fromkeys(TOTALS, 0)
+        for stat in balances.aggregate([
+            {'$match': query},
+            {'$group': dict({'_id': None, 'students': {'$sum': 1}},
+                            **{name: {'$sum': f'${name}'} for name in TOTALS[1:]})},
+        ]):
+            totals = {name: stat[name] for name in TOTALS}
+    else:
+        totals = defaulter_totals(class_name, economic_status, totals_max_age)
+    return rows, totals
+
+
+def _totals_key(class_name, economic_status):
+    return f'{class_name or ""}|{economic_status or ""}'
+
+
+@task('balances.refresh_defaulter_totals')
+def refresh_defaulter_totals():
+    # Recomputes the defaulters report totals, in one pass over the partial
+    # outstanding index, read like the report itself. Returns {key: totals}.
+    totals = {ALL_DEFAULTERS: dict.fromkeys(TOTALS, 0)}
+    balances = connections.collection(StudentBalance, connections.REPORTING)
+    for stat in balances.aggregate([
+        {'$match': {'outstanding': {'$gt': 0}}},
+        {'$group': dict({'_id': {'class_name': '$class_name', 'economic_status': '$economic_status'},
+                         'students': {'$sum': 1}},
+                        **{name: {'$sum': f'${name}'} for name in TOTALS[1:]})},
+    ]):
+        key = _totals_key(stat['_id'].get('class_name'), stat['_id'].get('economic_status'))
+        totals[key] = {name: stat[name] for name in TOTALS}
+        for name in TOTALS:
+            totals[ALL_DEFAULTERS][name] += stat[name]
+    now = datetime.utcnow()
+    operations = [UpdateOne({'scope': TOTALS_SCOPE, 'key': key}, {'$set': dict(values, updated_at=now)},
+                            upsert=True) for key, values in totals.items()]
+    operations.append(DeleteMany({'scope': TOTALS_SCOPE, 'key': {'$nin': list(totals)}}))
+    DashboardSummary._get_collection().bulk_write(operations, ordered=False)
+    return totals
+
+
+def defaulter_totals(class_name=None, economic_status=None, max_age=DEFAULT_TOTALS_MAX_AGE):
+    # Totals of the defaulters report from the summaries. They are computed
+    # here the first time; afterwards a background job recomputes them once
+    # they are more than max_age seconds old, so they may lag the rows.
+    global _refresh_queued
+    summaries = connections.collection(DashboardSummary, connections.REPORTING)
+    stored = {doc['key']: doc for doc in summaries.find({'scope': TOTALS_SCOPE}, {'counted_payments': 0})}
+    if ALL_DEFAULTERS not in stored:
+        stored = refresh_defaulter_totals()
+    elif (stored[ALL_DEFAULTERS]['updated_at'] < datetime.utcnow() - timedelta(seconds=max_age)
+          and time.monotonic() - _refresh_queued > max_age):
+        _refresh_queued = time.monotonic()
+        enqueue('balances.refresh_defaulter_totals')
+    if not class_name and not economic_status:
+        return {name: stored[ALL_DEFAULTERS].get(name, 0) for name in TOTALS}
+    totals = dict.fromkeys(TOTALS, 0)
+    for key, values in stored.items():
+        if key == ALL_DEFAULTERS:
+            continue
+        key_class, key_status = key.split('|', 1)
+        if class_name and key_class != class_name or economic_status and key_status != economic_status:
+            continue
+        for name in TOTALS:
+            totals[name] += values.get(name, 0)
+    return totals
+
+
+def compute_balances():
+    # Recomputes every balance from Fee and Student: {student id: document}
+    students = {doc['_id']: doc for doc in Student._get_collection().find(
+        {}, {name: 1 for name in STUDENT_FIELDS})}
+    balances = {}
+    fees = Fee._get_collection().find({}, {'student': 1, 'month': 1, 'year': 1, 'total_fee': 1, 'paid_amount': 1,
+                                           'applied_payments': 1})
+    for fee in fees:
+        student = students.get(fee['student'])
+        if student is None:
+            continue
+        balance = balances.get(fee['student'])
+        if balance is None:
+            balance = balances[fee['student']] = dict(
+                student=fee['student'], billed=0, paid=0, outstanding=0, periods={}, counted_payments=[],
+                **_student_fields(student))
+        owed = fee['total_fee'] - fee['paid_amount']
+        balance['billed'] += fee['total_fee']
+        balance['paid'] += fee['paid_amount']
+        balance['outstanding'] += owed
+        key = period_key(fee['month'], fee['year'])
+        balance['periods'][key] = balance['periods'].get(key, 0) + owed
+        balance['counted_payments'] += fee.get('applied_payments', [])
+    return balances
+
+
+def _rebuilt(balance):
+    # The update writing a recomputed balance. It keeps the payments counted
+    # already and adds those its fees include, so a payment_added job still
+    # queued (or retried) after the rebuild does not count its payment again.
+    fields = {name: value for name, value in balance.items() if name != 'counted_payments'}
+    fields['updated_at'] = datetime.utcnow()
+    return {'$set': fields, '$addToSet': {'counted_payments': {'$each': balance['counted_payments']}}}
+
+
+def rebuild_balances(dry_run=False, batch_size=1000):
+    # Returns the drift found as a list of (roll number, field, stored, actual)
+    # and, unless dry_run, rewrites the stored balances
+    actual = compute_balances()
+    collection = StudentBalance._get_collection()
+    drift = []
+    operations = []
+    seen = set()
+    for stored in collection.find({}):
+        student_id = stored['student']
+        seen.add(student_id)
+        balance = actual.get(student_id)
+        if balance is None:
+            drift.append((stored.get('roll_number'), 'outstanding', stored.get('outstanding', 0), 0))
+            operations.append(DeleteOne({'_id': stored['_id']}))
+            continue
+        for name in ('billed', 'paid', 'outstanding'):
+            if stored.get(name, 0) != balance[name]:
+                drift.append((balance['roll_number'], name, stored.get(name, 0), balance[name]))
+        operations.append(UpdateOne({'_id': stored['_id']}, _rebuilt(balance)))
+    for student_id, balance in actual.items():
+        if student_id not in seen:
+            drift.append((balance['roll_number'], 'outstanding', 0, balance['outstanding']))
+            operations.append(UpdateOne({'student': student_id}, _rebuilt(balance), upsert=True))
+    if not dry_run:
+        for i in range(0, len(operations), batch_size):
+            collection.bulk_write(operations[i:i + batch_size], ordered=False)
+        refresh_defaulter_totals()
+    return drift
@@ -0,0 +1,256 @@
+import io
+import multiprocessing
+import os
+import threading
+import time
+import zipfile
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from types import SimpleNamespace
+from bson import ObjectId
+from application.models import Admin, Student, Fee, PaymentHistory
+
+# Documents rendered per task sent to a worker process
+CHUNK_SIZE = 50
+
+KINDS = ('receipts', 'statements')
+
+# Worker processes when RECEIPT_BATCH_WORKERS is not set; every gunicorn
+# worker has its own pool
+DEFAULT_WORKERS = min(4, os.cpu_count() or 1)
+
+# Chunks submitted per worker process ahead of the one being written out,
+# so a large batch never holds more than this many rendered chunks
+CHUNKS_IN_FLIGHT = 2
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+# Optional fields are not stored when unset
+PAYMENT_DEFAULTS = {'transaction_id': None, 'payment_method': 'cash'}
+
+
+def _payment(doc):
+    return SimpleNamespace(**{**PAYMENT_DEFAULTS, **doc})
+
+
+def _by_id(document, ids, projection=None):
+    cursor = document._get_collection().find({'_id': {'$in': list(ids)}}, projection)
+    return {doc['_id']: SimpleNamespace(**doc) for doc in cursor}
+
+
+def _class_fee_ids(class_name, month, year):
+    student_ids = Student._get_collection().distinct('_id', {'class_name': class_name})
+    return Fee._get_collection().distinct(
+        '_id', {'student': {'$in': student_ids}, 'month': month, 'year': year})
+
+
+def _payments_by_fee(fee_ids):
+    payments = {}
+    cursor = PaymentHistory._get_collection().find({'fee': {'$in': list(fee_ids)}}).sort('payment_date', 1)
+    for doc in cursor:
+        payments.setdefault(doc['fee'], []).append(_payment(doc))
+    return payments
+
+
+def load_receipt_jobs(payment_ids=None, class_name=None, month=None, year=None):
+    # Everything needed to render the receipts, in a handful of bulk queries.
+    # Jobs are plain picklable (filename, payment, student, fee, admin, balance)
+    # tuples so they can be sent to worker processes.
+    if payment_ids:
+        query = {'_id': {'$in': [ObjectId(pid) for pid in payment_ids]}}
+    else:
+        query = {'fee': {'$in': _class_fee_ids(class_name, month, year)}}
+    payments = [_payment(doc) for doc in PaymentHistory._get_collection().find(query)]
+
+    fees = _by_id(Fee, {p.fee for p in payments})
+    students = _by_id(Student, {p.student for p in payments})
+    admins = _by_id(Admin, {p.created_by for p in payments}, {'username': 1})
+    # All payments of the fees involved, to work out the balance after each one
+    history = _payments_by_fee(fees)
+
+    jobs = []
+    for payment in payments:
+        fee = fees.get(payment.fee)
+        student = students.get(payment.student)
+        if fee is None or student is None:
+            continue
+        paid = sum(p.amount for p in history.get(fee._id, []) if p.payment_date <= payment.payment_date)
+        admin = admins.get(payment.created_by) or SimpleNamespace(username='')
+        jobs.append((f'receipt_{payment.receipt_number}.pdf', payment, student, fee, admin,
+                     fee.total_fee - paid))
+    jobs.sort(key=lambda job: (job[2].roll_number, job[1].payment_date))
+    return jobs
+
+
+def load_statement_jobs(class_name, month, year):
+    # One statement per fee record of the class for the period
+    fee_ids = _class_fee_ids(class_name, month, year)
+    fees = _by_id(Fee, fee_ids)
+    students = _by_id(Student, {fee.student for fee in fees.values()})
+    payments = _payments_by_fee(fee_ids)
+
+    jobs = []
+    for fee in fees.values():
+        student = students.get(fee.student)
+        if student is None:
+            continue
+        jobs.append((f'statement_{student.roll_number}_{month}_{year}.pdf', student, fee,
+                     payments.get(fee._id, [])))
+    jobs.sort(key=lambda job: job[1].roll_number)
+    return jobs
+
+
+def render_chunk(kind, jobs, combined):
+    # Runs in a worker process. Returns one multi-page PDF for the chunk when
+    # combined, else a list of (filename, PDF bytes).
+    from application.utils import draw_receipt, draw_statement, new_canvas
+
+    draw = draw_receipt if kind == 'receipts' else draw_statement
+    if combined:
+        buffer = io.BytesIO()
+        p = new_canvas(buffer)
+        for filename, *args in jobs:
+            draw(p, *args)
+        p.save()
+        return buffer.getvalue()
+
+    files = []
+    for filename, *args in jobs:
+        buffer = io.BytesIO()
+        p = new_canvas(buffer)
+        draw(p, *args)
+        p.save()
+        files.append((filename, buffer.getvalue()))
+    return files
+
+
+def _executor(workers):
+    # One pool per process, created on first use and shared by concurrent
+    # batches. Workers are spawned rather than forked: a gunicorn worker runs
+    # the job queue and audit flusher threads, and forking a process with
+    # threads can copy a held lock into the child.
+    global _pool
+    with _pool_lock:
+        if _pool is not None and (_pool[0] != os.getpid() or _pool[1] != workers):
+            if _pool[0] == os.getpid():
+                _pool[2].shutdown(wait=False)
+            _pool = None
+        if _pool is None:
+            executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+            _pool = (os.getpid(), workers, executor)
+        return _pool[2]
+
+
+def _discard(executor):
+    # A worker process died; the next batch starts a new pool
+    global _pool
+    with _pool_lock:
+        if _pool is not None and _pool[2] is executor:
+            _pool = None
+    executor.shutdown(wait=False)
+
+
+def render_jobs(kind, jobs, combined, workers=None, chunk_size=CHUNK_SIZE, progress=None):
+    # Renders jobs across the process pool and yields chunk results in order,
+    # with at most CHUNKS_IN_FLIGHT chunks per worker submitted ahead.
+    # progress(done, total) is called after every chunk.
+    workers = workers or DEFAULT_WORKERS
+    chunks = (jobs[i:i + chunk_size] for i in range(0, len(jobs), chunk_size))
+    executor = _executor(workers)
+    pending = deque()
+
+    def submit():
+        chunk = next(chunks, None)
+        if chunk is not None:
+            pending.append((chunk, executor.submit(render_chunk, kind, chunk, combined)))
+
+    done = 0
+    try:
+        for _ in range(workers * CHUNKS_IN_FLIGHT):
+            submit()
+        while pending:
+            chunk, future = pending.popleft()
+            result = future.result()
+            submit()
+            done += len(chunk)
+            if progress:
+                progress(done, len(jobs))
+            yield result
+    except BrokenProcessPool:
+        _discard(executor)
+        raise
+    finally:
+        # Left early, e.g. the client went away mid-download
+        for _, future in pending:
+            future.cancel()
+
+
+class _ZipSink:
+    # Write-only file object collecting what zipfile writes, so the archive
+    # can be streamed as it is built (zipfile supports unseekable output)
+    def __init__(self):
+        self.parts = []
+        self.offset = 0
+
+    def write(self, data):
+        self.parts.append(bytes(data))
+        self.offset += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.offset
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self.parts)
+        self.parts = []
+        return data
+
+
+def stream_zip(kind, jobs, **render_options):
+    # Yields a ZIP archive holding one PDF per job, chunk by chunk
+    sink = _ZipSink()
+    with zipfile.ZipFile(sink, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for files in render_jobs(kind, jobs, combined=False, **render_options):
+            for filename, data in files:
+                archive.writestr(filename, data)
+            yield sink.drain()
+    yield sink.drain()
+
+
+def merged_pdf(kind, jobs, **render_options):
+    # One multi-page PDF. Workers render a multi-page PDF per chunk, which
+    # are then joined with pypdf (optional dependency).
+    try:
+        from pypdf import PdfWriter
+    except ImportError:
+        raise ValueError('Merged PDF output requires pypdf (pip install pypdf); use ZIP output instead')
+    writer = PdfWriter()
+    for data in render_jobs(kind, jobs, combined=True, **render_options):
+        writer.append(io.BytesIO(data))
+    output = io.BytesIO()
+    writer.write(output)
+    return output.getvalue()
+
+
+class Throughput:
+    # Progress callback that keeps track of pages rendered per second
+    def __init__(self, report=None):
+        self.report = report
+        self.started = time.perf_counter()
+        self.pages = 0
+
+    def __call__(self, done, total):
+        self.pages = done
+        if self.report:
+            self.report(done, total, self.pages_per_second)
+
+    @property
+    def pages_per_second(self):
+        elapsed = time.perf_counter() - self.started
+        return self.pages / elapsed if elapsed else 0.0
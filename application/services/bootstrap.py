@@ -0,0 +1,27 @@
+from flask import current_app
+from application.models import Admin
+from application.services.indexes import sync_indexes
+
+# The admin created on a new deployment; change the password after logging in
+DEFAULT_ADMIN_USERNAME = 'admin'
+DEFAULT_ADMIN_EMAIL = 'admin@school.com'
+DEFAULT_ADMIN_PASSWORD = 'admin123'
+
+
+def create_default_admin(username=DEFAULT_ADMIN_USERNAME, email=DEFAULT_ADMIN_EMAIL,
+                         password=DEFAULT_ADMIN_PASSWORD):
+    # The first admin; returns None when there already is one
+    if Admin.objects.first():
+        return None
+    admin = Admin(username=username, email=email)
+    admin.set_password(password)
+    admin.save()
+    return admin
+
+
+def bootstrap(**admin):
+    # One-time setup of a deployment, run once per release instead of by
+    # every worker as it starts: builds the declared indexes and creates the
+    # default admin. Returns ({collection: index error}, created admin or None).
+    compressor = current_app.config['AUDIT_ARCHIVE_COMPRESSOR']
+    return sync_indexes(archive_compressor=compressor), create_default_admin(**admin)
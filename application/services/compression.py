@@ -0,0 +1,74 @@
+import zlib
+from flask import current_app, request
+
+ENCODINGS = ('br', 'gzip')
+
+# Only text responses are compressed; PDFs and XLSX are compressed already,
+# exports are sent as files (and have ?gzip=1)
+COMPRESSIBLE = ('text/html', 'application/json')
+
+GZIP_LEVEL = 6
+# Brotli quality 5 compresses HTML about as fast as gzip level 6, and smaller
+BROTLI_QUALITY = 5
+
+
+def _brotli():
+    try:
+        import brotli
+    except ImportError:
+        raise ValueError('HTTP_COMPRESSION=br requires brotli (pip install brotli)')
+    return brotli
+
+
+def _encode(encoding, data):
+    if encoding == 'br':
+        return _brotli().compress(data, quality=BROTLI_QUALITY)
+    compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)  # wbits 31: gzip container
+    return compressor.compress(data) + compressor.flush()
+
+
+def _encode_stream(encoding, chunks):
+    # Compresses a streamed page chunk by chunk. Each chunk is flushed, so
+    # the browser can render the top of the page before the rest is sent.
+    if encoding == 'br':
+        compressor = _brotli().Compressor(quality=BROTLI_QUALITY)
+        for chunk in chunks:
+            yield compressor.process(chunk) + compressor.flush()
+        yield compressor.finish()
+        return
+    compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        yield compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    yield compressor.flush()
+
+
+def _compress(response):
+    encodings = current_app.config['HTTP_COMPRESSION']
+    if (not encodings or response.status_code != 200 or response.direct_passthrough
+            or 'Content-Encoding' in response.headers
+            or response.mimetype not in COMPRESSIBLE):
+        return response
+    response.vary.add('Accept-Encoding')
+    # The first of the configured encodings the browser accepts
+    encoding = next((name for name in encodings if request.accept_encodings[name]), None)
+    if response.is_streamed:
+        # The size is not known up front; streamed pages are the long ones
+        if encoding is not None:
+            response.response = _encode_stream(encoding, response.iter_encoded())
+            response.headers['Content-Encoding'] = encoding
+        return response
+    data = response.get_data()
+    if encoding is None or len(data) < current_app.config['HTTP_COMPRESSION_MIN_SIZE']:
+        return response
+    response.set_data(_encode(encoding, data))
+    response.headers['Content-Encoding'] = encoding
+    return response
+
+
+def init_app(app):
+    for encoding in app.config['HTTP_COMPRESSION']:
+        if encoding not in ENCODINGS:
+            raise ValueError(f'HTTP_COMPRESSION must list {" and/or ".join(ENCODINGS)}, not {encoding}')
+        if encoding == 'br':
+            _brotli()
+    app.after_request(_compress)
@@ -0,0 +1,71 @@
+import os
+from mongoengine.connection import DEFAULT_CONNECTION_NAME, get_db
+from pymongo.read_preferences import SecondaryPreferred
+
+# Connection aliases. Writes, and reads that must see them, use DEFAULT on
+# the primary. Dashboards and reports read through REPORTING, which prefers
+# secondaries so heavy reads do not compete with cashiers on the primary.
+DEFAULT = DEFAULT_CONNECTION_NAME
+REPORTING = 'reporting'
+
+# pymongo options an alias can tune from the environment: MONGO_<NAME> for
+# the default alias, MONGO_REPORTING_<NAME> for reporting (which otherwise
+# inherits the default alias' options)
+POOL_OPTIONS = {
+    'MAX_POOL_SIZE': ('maxPoolSize', int),
+    'MIN_POOL_SIZE': ('minPoolSize', int),
+    'MAX_IDLE_TIME_MS': ('maxIdleTimeMS', int),
+    'WAIT_QUEUE_TIMEOUT_MS': ('waitQueueTimeoutMS', int),
+    'CONNECT_TIMEOUT_MS': ('connectTimeoutMS', int),
+    'SOCKET_TIMEOUT_MS': ('socketTimeoutMS', int),
+    'SERVER_SELECTION_TIMEOUT_MS': ('serverSelectionTimeoutMS', int),
+    # e.g. 'zstd,zlib'; zstd and snappy need the zstandard / python-snappy packages
+    'COMPRESSORS': ('compressors', str),
+}
+
+# Reports are a handful of concurrent requests at most
+REPORTING_POOL_SIZE = 10
+
+# The smallest maxStalenessSeconds MongoDB accepts
+MIN_MAX_STALENESS = 90
+
+
+def _with_options(prefix, settings):
+    for name, (option, parse) in POOL_OPTIONS.items():
+        value = os.getenv(prefix + name)
+        if value:
+            settings[option] = parse(value)
+    return settings
+
+
+def connection_settings():
+    # MONGODB_SETTINGS for both aliases. The reporting alias reads from a
+    # secondary at most MONGO_REPORTING_MAX_STALENESS seconds behind the
+    # primary, and from the primary when there is none (e.g. a single node).
+    # connect=False: clients connect on their first query, i.e. in the worker
+    # after gunicorn forks, so the app can be preloaded (--preload).
+    import certifi
+
+    host = os.getenv('MONGO_URI', 'mongodb://localhost:27017/school_fee_db')
+    default = _with_options('MONGO_', {
+        'alias': DEFAULT,
+        'host': host,
+        'tlsCAFile': certifi.where(),
+        'connect': False,
+    })
+    max_staleness = int(os.getenv('MONGO_REPORTING_MAX_STALENESS', MIN_MAX_STALENESS))
+    if max_staleness < MIN_MAX_STALENESS:
+        raise ValueError(f'MONGO_REPORTING_MAX_STALENESS must be at least {MIN_MAX_STALENESS} seconds')
+    reporting = _with_options('MONGO_REPORTING_', dict(
+        default,
+        alias=REPORTING,
+        host=os.getenv('MONGO_REPORTING_URI') or host,
+        maxPoolSize=REPORTING_POOL_SIZE,
+        read_preference=SecondaryPreferred(max_staleness=max_staleness),
+    ))
+    return [default, reporting]
+
+
+def collection(document, alias=DEFAULT):
+    # document's pymongo collection on the given alias
+    return get_db(alias)[document._get_collection_name()]
@@ -0,0 +1,180 @@
+from datetime import datetime
+from bson import ObjectId
+from mongoengine.queryset.visitor import Q
+from application.models import Student, Fee, DashboardSummary
+from application.services.connections import REPORTING
+from application.services.jobs import inc_once, task
+
+STUDENT_COUNTERS = ('students', 'hostelers', 'poor_students')
+FEE_COUNTERS = ('total_fees', 'collected_fees')
+
+
+def _inc(scope, key, **deltas):
+    deltas = {name: value for name, value in deltas.items() if value}
+    if not deltas:
+        return
+    update = {f'inc__{name}': value for name, value in deltas.items()}
+    DashboardSummary.objects(scope=scope, key=key).update_one(
+        upsert=True, set__updated_at=datetime.utcnow(), **update
+    )
+
+
+def _student_deltas(class_name, hostel_food_opted, economic_status, sign):
+    return {
+        'students': sign,
+        'hostelers': sign if hostel_food_opted else 0,
+        'poor_students': sign if economic_status == 'Poor' else 0,
+    }
+
+
+def student_added(student):
+    _inc('class', student.class_name, **_student_deltas(
+        student.class_name, student.hostel_food_opted, student.economic_status, 1))
+
+
+def student_changed(old_data, student):
+    # old_data holds the field values from before the edit
+    removed = _student_deltas(old_data['class_name'], old_data['hostel_food_opted'],
+                              old_data['economic_status'], -1)
+    added = _student_deltas(student.class_name, student.hostel_food_opted,
+                            student.economic_status, 1)
+    if old_data['class_name'] == student.class_name:
+        _inc('class', student.class_name,
+             **{name: removed[name] + added[name] for name in STUDENT_COUNTERS})
+    else:
+        _inc('class', old_data['class_name'], **removed)
+        _inc('class', student.class_name, **added)
+
+
+def students_changed(changes):
+    # Batched variant for imports: changes is a list of (old, new) dicts with
+    # class_name, hostel_food_opted and economic_status, old being None for a
+    # new student. Issues one $inc per class touched.
+    per_class = {}
+    for old, new in changes:
+        for data, sign in ((old, -1), (new, 1)):
+            if data is None:
+                continue
+            deltas = _student_deltas(data['class_name'], data.get('hostel_food_opted'),
+                                     data['economic_status'], sign)
+            totals = per_class.setdefault(data['class_name'], dict.fromkeys(STUDENT_COUNTERS, 0))
+            for name in STUDENT_COUNTERS:
+                totals[name] += deltas[name]
+    for class_name, deltas in per_class.items():
+        _inc('class', class_name, **deltas)
+
+
+def student_removed(student):
+    # Call before the student's fees are deleted: their totals are taken
+    # back out of the year summaries too
+    _inc('class', student.class_name, **_student_deltas(
+        student.class_name, student.hostel_food_opted, student.economic_status, -1))
+    pipeline = [
+        {'$match': {'student': student.id}},
+        {'$group': {
+            '_id': '$year',
+            'total_fees': {'$sum': '$total_fee'},
+            'collected_fees': {'$sum': '$paid_amount'},
+        }},
+    ]
+    for stat in Fee.objects.aggregate(pipeline):
+        _inc('year', stat['_id'], total_fees=-stat['total_fees'],
+             collected_fees=-stat['collected_fees'])
+
+
+def fee_added(fee):
+    _inc('year', fee.year, total_fees=fee.total_fee, collected_fees=fee.paid_amount)
+
+
+def fee_changed(old_year, old_total_fee, fee):
+    # Editing a fee never touches paid_amount, but moving it to another year
+    # moves what was collected on it as well
+    if old_year == fee.year:
+        _inc('year', fee.year, total_fees=fee.total_fee - old_total_fee)
+    else:
+        _inc('year', old_year, total_fees=-old_total_fee, collected_fees=-fee.paid_amount)
+        fee_added(fee)
+
+
+def fee_totals_added(year, total_fees):
+    # Bulk fee generation: new unpaid fees worth total_fees in year
+    _inc('year', year, total_fees=total_fees)
+
+
+@task('dashboard.payment_added')
+def payment_added(year, amount, payment_id=None):
+    if payment_id is None:
+        # Enqueued before payment ids were passed
+        _inc('year', year, collected_fees=amount)
+        return
+    inc_once(DashboardSummary._get_collection(), {'scope': 'year', 'key': year}, ObjectId(payment_id),
+             {'$inc': {'collected_fees': amount}, '$set': {'updated_at': datetime.utcnow()}})
+
+
+def load_summary(year):
+    # Everything the dashboard shows, in one read on the (scope, key) index,
+    # from a secondary when there is one
+    summaries = DashboardSummary.objects.using(REPORTING).filter(
+        Q(scope='class') | Q(scope='year', key=year)).exclude('counted_payments')
+    totals = {name: 0 for name in STUDENT_COUNTERS + FEE_COUNTERS}
+    class_distribution = []
+    for summary in summaries:
+        if summary.scope == 'class':
+            for name in STUDENT_COUNTERS:
+                totals[name] += summary[name]
+            if summary.students:
+                class_distribution.append((summary.key, summary.students))
+        else:
+            for name in FEE_COUNTERS:
+                totals[name] = summary[name]
+    class_distribution.sort(key=lambda x: x[0])
+    totals['class_distribution'] = class_distribution
+    return totals
+
+
+def compute_summaries():
+    # Recomputes every summary document from Student and Fee
+    summaries = {}
+    class_pipeline = [
+        {'$group': {
+            '_id': '$class_name',
+            'students': {'$sum': 1},
+            'hostelers': {'$sum': {'$cond': ['$hostel_food_opted', 1, 0]}},
+            'poor_students': {'$sum': {'$cond': [{'$eq': ['$economic_status', 'Poor']}, 1, 0]}},
+        }}
+    ]
+    for stat in Student.objects.aggregate(class_pipeline):
+        summaries[('class', stat['_id'])] = {name: stat[name] for name in STUDENT_COUNTERS}
+    year_pipeline = [
+        {'$group': {
+            '_id': '$year',
+            'total_fees': {'$sum': '$total_fee'},
+            'collected_fees': {'$sum': '$paid_amount'},
+        }}
+    ]
+    for stat in Fee.objects.aggregate(year_pipeline):
+        summaries[('year', stat['_id'])] = {name: stat[name] for name in FEE_COUNTERS}
+    return summaries
+
+
+def rebuild_summaries(dry_run=False):
+    # Returns the drift found as a list of (scope, key, counter, stored, actual)
+    # and, unless dry_run, overwrites the stored summaries with the actual values
+    actual = compute_summaries()
+    stored = {(s.scope, s.key): s for s in DashboardSummary.objects(scope__in=('class', 'year'))}
+    drift = []
+    for scope_key in set(actual) | set(stored):
+        scope, key = scope_key
+        counters = STUDENT_COUNTERS if scope == 'class' else FEE_COUNTERS
+        values = actual.get(scope_key, {name: 0 for name in counters})
+        summary = stored.get(scope_key)
+        for name in counters:
+            stored_value = summary[name] if summary else 0
+            if stored_value != values[name]:
+                drift.append((scope, key, name, stored_value, values[name]))
+        if not dry_run:
+            DashboardSummary.objects(scope=scope, key=key).update_one(
+                upsert=True, set__updated_at=datetime.utcnow(),
+                **{f'set__{name}': value for name, value in values.items()}
+            )
+    return drift
@@ -0,0 +1,139 @@
+import csv
+import io
+import tempfile
+import zlib
+from application.models import Admin, Student, Fee, PaymentHistory
+from application.services.connections import REPORTING, collection
+from application.services.money import to_rupees
+
+# Documents fetched per cursor batch; references are resolved once per batch
+BATCH_SIZE = 1000
+
+FEE_COLUMNS = ['roll_number', 'name', 'class_name', 'section', 'month', 'year',
+               'base_fee', 'hostel_food_fee', 'milk_fee', 'discount', 'total_fee',
+               'paid_amount', 'balance']
+PAYMENT_COLUMNS = ['receipt_number', 'payment_date', 'roll_number', 'name', 'class_name',
+                   'amount', 'payment_method', 'transaction_id', 'received_by']
+
+STUDENT_PROJECTION = {'roll_number': 1, 'name': 1, 'class_name': 1, 'section': 1}
+
+
+def _batches(cursor, size=BATCH_SIZE):
+    batch = []
+    for doc in cursor:
+        batch.append(doc)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _students_by_id(ids):
+    return {doc['_id']: doc for doc in collection(Student, REPORTING).find({'_id': {'$in': list(ids)}}, STUDENT_PROJECTION)}
+
+
+def fee_ledger_rows(year, month=None, class_name=None):
+    # Yields one row (list) per fee record of the period, in FEE_COLUMNS order;
+    # amounts in rupees like every export
+    query = {'year': year}
+    if month:
+        query['month'] = month
+    if class_name:
+        query['student'] = {'$in': collection(Student, REPORTING).distinct('_id', {'class_name': class_name})}
+    projection = {'student': 1, 'month': 1, 'year': 1, 'base_fee': 1, 'hostel_food_fee': 1,
+                  'milk_fee': 1, 'discount': 1, 'total_fee': 1, 'paid_amount': 1}
+    cursor = collection(Fee, REPORTING).find(query, projection, batch_size=BATCH_SIZE)
+
+    for batch in _batches(cursor):
+        students = _students_by_id({fee['student'] for fee in batch})
+        for fee in batch:
+            student = students.get(fee['student'], {})
+            total_fee = fee.get('total_fee', 0)
+            paid_amount = fee.get('paid_amount', 0)
+            yield [
+                student.get('roll_number', ''), student.get('name', ''),
+                student.get('class_name', ''), student.get('section', ''),
+                fee['month'], fee['year'],
+                to_rupees(fee.get('base_fee', 0)), to_rupees(fee.get('hostel_food_fee', 0)),
+                to_rupees(fee.get('milk_fee', 0)), to_rupees(fee.get('discount', 0)),
+                to_rupees(total_fee), to_rupees(paid_amount), to_rupees(total_fee - paid_amount),
+            ]
+
+
+def payment_history_rows(start, end):
+    # Yields one row per payment with start <= payment_date < end
+    query = {'payment_date': {'$gte': start, '$lt': end}}
+    projection = {'receipt_number': 1, 'payment_date': 1, 'student': 1, 'amount': 1,
+                  'payment_method': 1, 'transaction_id': 1, 'created_by': 1}
+    cursor = collection(PaymentHistory, REPORTING).find(query, projection, batch_size=BATCH_SIZE) \
+        .sort('payment_date', 1)
+
+    # Only a handful of admins exist; resolve each one once per export
+    admins = {}
+    for batch in _batches(cursor):
+        students = _students_by_id({payment['student'] for payment in batch})
+        new_admins = {payment['created_by'] for payment in batch} - admins.keys()
+        if new_admins:
+            for admin in collection(Admin, REPORTING).find({'_id': {'$in': list(new_admins)}}, {'username': 1}):
+                admins[admin['_id']] = admin['username']
+        for payment in batch:
+            student = students.get(payment['student'], {})
+            yield [
+                payment['receipt_number'], payment['payment_date'].strftime('%Y-%m-%d %H:%M:%S'),
+                student.get('roll_number', ''), student.get('name', ''), student.get('class_name', ''),
+                to_rupees(payment['amount']), payment.get('payment_method', ''),
+                payment.get('transaction_id') or '', admins.get(payment['created_by'], ''),
+            ]
+
+
+def stream_csv(columns, rows, rows_per_chunk=BATCH_SIZE):
+    # Yields encoded CSV chunks of rows_per_chunk rows each
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+    count = 0
+    for row in rows:
+        writer.writerow(row)
+        count += 1
+        if count % rows_per_chunk == 0:
+            yield buffer.getvalue().encode('utf-8')
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue().encode('utf-8')
+
+
+def stream_xlsx(columns, rows, chunk_size=64 * 1024):
+    # XLSX support is optional and needs openpyxl. A workbook can only be
+    # written once complete, so rows go through openpyxl's write-only mode
+    # into a temporary file that is then streamed.
+    try:
+        from openpyxl import Workbook
+    except ImportError:
+        raise ValueError('XLSX export requires openpyxl (pip install openpyxl)')
+
+    def generate():
+        workbook = Workbook(write_only=True)
+        sheet = workbook.create_sheet()
+        sheet.append(columns)
+        for row in rows:
+            sheet.append(row)
+        with tempfile.TemporaryFile() as tmp:
+            workbook.save(tmp)
+            tmp.seek(0)
+            while True:
+                chunk = tmp.read(chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+
+    return generate()
+
+
+def gzip_stream(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits 31: gzip container
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
@@ -0,0 +1,113 @@
+from datetime import datetime
+from pymongo.errors import BulkWriteError
+from application.models import Student, Fee
+from application.services import audit, balances, dashboard, versions
+from application.services.money import format_rupees
+from application.services.pricing import quote_fee
+
+DEFAULT_CHUNK_SIZE = 1000
+
+# MongoDB error code for a duplicate key
+DUPLICATE_KEY = 11000
+
+
+def _fee_document(student, month, year, now):
+    quote = quote_fee(student['class_name'], student.get('hostel_food_opted', False),
+                      student.get('milk_opted', False), student.get('economic_status'), year)
+    return {
+        'student': student['_id'],
+        'month': month,
+        'year': year,
+        'base_fee': quote['base_fee'],
+        'hostel_food_fee': quote['hostel_food_fee'],
+        'milk_fee': quote['milk_fee'],
+        'discount': quote['discount'],
+        'total_fee': quote['total'],
+        'paid_amount': 0,
+        'created_at': now,
+        'updated_at': now,
+    }
+
+
+def _insert_chunk(collection, docs):
+    # Unordered insert; fees created concurrently for the same period are
+    # rejected by the unique (student, year, month) index and skipped.
+    # Returns the documents actually inserted.
+    try:
+        collection.insert_many(docs, ordered=False)
+        return docs
+    except BulkWriteError as e:
+        failed = set()
+        for error in e.details['writeErrors']:
+            if error['code'] != DUPLICATE_KEY:
+                raise
+            failed.add(error['index'])
+        return [doc for i, doc in enumerate(docs) if i not in failed]
+
+
+def normalize_period(month, year):
+    # Periods are stored as ('4', '2025'): '04' would be a different period
+    # to the unique (student, year, month) index
+    try:
+        month, year = int(month), int(year)
+    except (TypeError, ValueError):
+        raise ValueError(f'invalid period {month}/{year}')
+    if not 1 <= month <= 12:
+        raise ValueError(f'month must be between 1 and 12, not {month}')
+    return str(month), str(year)
+
+
+def generate_monthly_fees(month, year, admin, class_name=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    # Creates the fee record of every student (optionally of one class) that
+    # has none for the period, priced like the "Add Fee" form.
+    # Returns {'created': n, 'skipped': n, 'total_fees': paise}.
+    month, year = normalize_period(month, year)
+    existing = set(Fee._get_collection().distinct('student', {'year': year, 'month': month}))
+
+    query = {'class_name': class_name} if class_name else {}
+    projection = {'class_name': 1, 'hostel_food_opted': 1, 'milk_opted': 1, 'economic_status': 1,
+                  'roll_number': 1, 'name': 1}
+    students = Student._get_collection().find(query, projection, batch_size=chunk_size)
+
+    fee_collection = Fee._get_collection()
+    now = datetime.utcnow()
+    created = skipped = 0
+    total_fees = 0
+    chunk = []
+    chunk_students = {}
+
+    def flush():
+        nonlocal created, skipped, total_fees
+        inserted = _insert_chunk(fee_collection, chunk)
+        created += len(inserted)
+        skipped += len(chunk) - len(inserted)
+        total_fees += sum(doc['total_fee'] for doc in inserted)
+        # One balance bulk_write per chunk
+        balances.fees_added(inserted, chunk_students)
+        chunk.clear()
+        chunk_students.clear()
+
+    for student in students:
+        if student['_id'] in existing:
+            skipped += 1
+            continue
+        chunk.append(_fee_document(student, month, year, now))
+        chunk_students[student['_id']] = student
+        if len(chunk) >= chunk_size:
+            flush()
+    if chunk:
+        flush()
+
+    # One dashboard update, version bump and audit entry per run
+    dashboard.fee_totals_added(year, total_fees)
+    if created:
+        versions.bump(versions.FEES)
+    audit.record(
+        admin, 'GENERATE_FEES',
+        entity_type='fee',
+        details=f'Generated {created} fee record(s) for {month}/{year}'
+                + (f', class {class_name}' if class_name else ', all classes')
+                + f'\nSkipped (already existing): {skipped}, Total: ₹{format_rupees(total_fees)}'
+    )
+
+    return {'created': created, 'skipped': skipped, 'total_fees': total_fees}
@@ -0,0 +1,147 @@
+from collections import namedtuple
+from application.models import Student, Fee
+
+# Rows per page of the fee grid
+PAGE_SIZE = 100
+
+# The fields fee/manage.html shows, as lightweight rows
+GridStudent = namedtuple('GridStudent', ['id', 'roll_number', 'name', 'class_name', 'section'])
+GridFee = namedtuple('GridFee', ['id', 'total_fee', 'paid_amount', 'discount'])
+
+
+def _status_match(status):
+    # Status predicates evaluated by the server, on the row status computed
+    # in the pipeline below
+    if status == 'fully_paid':
+        return {'status': 'fully_paid'}
+    if status == 'pending':
+        # A student without a fee record for the period is pending too
+        return {'status': {'$in': ['pending', 'not_set']}}
+    if status == 'discounted':
+        return {'fee.discount': {'$gt': 0}}
+    return None
+
+
+def fee_grid_pipeline(month, year, class_name=None, status=None, after=None, limit=PAGE_SIZE):
+    # One page of rows. The keyset filter is part of the first $match, so the
+    # (class_name, roll_number) index starts the scan at the page. Without a
+    # status filter the page is cut before the $lookup, so a page costs
+    # limit + 1 joins however large the class is.
+    match = {}
+    if class_name:
+        match['class_name'] = class_name
+    if after:
+        match['roll_number'] = {'$gt': after}
+    status_match = _status_match(status)
+
+    pipeline = [
+        {'$match': match},
+        # Keyset order; served by the (class_name, roll_number) index
+        {'$sort': {'roll_number': 1}},
+    ]
+    # One extra row tells us whether there is a next page
+    if not status_match:
+        pipeline.append({'$limit': limit + 1})
+    pipeline += [
+        {'$project': {'roll_number': 1, 'name': 1, 'class_name': 1, 'section': 1}},
+        {'$lookup': {
+            'from': Fee._get_collection_name(),
+            'let': {'student_id': '$_id'},
+            'pipeline': [
+                {'$match': {
+                    'year': year,
+                    'month': month,
+                    '$expr': {'$eq': ['$student', '$$student_id']},
+                }},
+                {'$project': {'total_fee': 1, 'paid_amount': 1, 'discount': 1}},
+            ],
+            'as': 'fee',
+        }},
+        {'$unwind': {'path': '$fee', 'preserveNullAndEmptyArrays': True}},
+        {'$addFields': {'status': {'$switch': {
+            'branches': [
+                {'case': {'$not': ['$fee']}, 'then': 'not_set'},
+                {'case': {'$gte': ['$fee.paid_amount', '$fee.total_fee']}, 'then': 'fully_paid'},
+            ],
+            'default': 'pending',
+        }}}},
+    ]
+    if status_match:
+        # The status comes from the join, so the scan goes on until the page
+        # is full
+        pipeline += [{'$match': status_match}, {'$limit': limit + 1}]
+    return pipeline
+
+
+def grid_total(month, year, class_name=None, status=None):
+    # Rows in the whole grid, from index counts rather than the join: students
+    # of the class, or the period's fee records with the status among them
+    students = Student._get_collection()
+    query = {'class_name': class_name} if class_name else {}
+    student_count = students.count_documents(query) if query else students.estimated_document_count()
+    if not status:
+        return student_count
+
+    fees = {'year': year, 'month': month}
+    if class_name:
+        fees['student'] = {'$in': students.distinct('_id', query)}
+    if status == 'discounted':
+        fees['discount'] = {'$gt': 0}
+    else:
+        fees['$expr'] = {'$gte': ['$paid_amount', '$total_fee']}
+    count = Fee._get_collection().count_documents(fees)
+    # Pending: no fee record for the period, or one not fully paid
+    return student_count - count if status == 'pending' else count
+
+
+def _row(doc):
+    # The (student, fee) pairs fee/manage.html iterates over
+    student = GridStudent(str(doc['_id']), doc['roll_number'], doc['name'], doc['class_name'], doc['section'])
+    fee = doc.get('fee')
+    if fee:
+        fee = GridFee(str(fee['_id']), fee.get('total_fee', 0), fee.get('paid_amount', 0), fee.get('discount', 0))
+    return student, fee
+
+
+def fee_grid(month, year, class_name=None, status=None, after=None, limit=PAGE_SIZE):
+    # Returns one page of the grid as (rows, total, next_after): rows are
+    # (student, fee) pairs with fee None when no record exists for the period,
+    # next_after is the roll number to pass as `after` for the next page
+    # (None on the last page).
+    pipeline = fee_grid_pipeline(month, year, class_name, status, after, limit)
+    docs = list(Student.objects.aggregate(pipeline))
+    total = grid_total(month, year, class_name, status)
+
+    next_after = None
+    if len(docs) > limit:
+        docs = docs[:limit]
+        next_after = docs[-1]['roll_number']
+    return [_row(doc) for doc in docs], total, next_after
+
+
+class FeeGridPage:
+    # fee_grid() run when the template first reads the page, so a streamed
+    # response sends everything above the table before the query runs
+    def __init__(self, month, year, **options):
+        self._query = (month, year, options)
+        self._page = None
+
+    def _load(self):
+        if self._page is None:
+            month, year, options = self._query
+            self._page = fee_grid(month, year, **options)
+        return self._page
+
+    def __iter__(self):
+        return iter(self._load()[0])
+
+    def __len__(self):
+        return len(self._load()[0])
+
+    @property
+    def total(self):
+        return self._load()[1]
+
+    @property
+    def next_after(self):
+        return self._load()[2]
@@ -0,0 +1,118 @@
+from bson import ObjectId
+from pymongo.errors import OperationFailure
+from application.models import Admin, Student, Fee, PaymentHistory, AuditLog, AuditArchive, DashboardSummary, \
+    FeeSchedule, StudentBalance, CollectionRollup
+from application.services.audit_archive import create_archive
+
+# Documents whose declared meta['indexes'] are managed by `flask indexes sync`
+INDEXED_DOCUMENTS = [Admin, Student, Fee, PaymentHistory, AuditLog, AuditArchive, DashboardSummary, FeeSchedule,
+                     StudentBalance, CollectionRollup]
+
+
+def _index_name(key):
+    # key is a list of (field, direction) pairs, as returned by list_indexes()
+    return '_'.join(f'{field}_{direction}' for field, direction in key)
+
+
+def sync_indexes(documents=None, archive_compressor='zstd'):
+    # Creates every declared index (background builds, see meta['index_background'])
+    # and returns {collection: error} for the ones that could not be built,
+    # e.g. a unique index over data that already contains duplicates.
+    errors = {}
+    documents = documents or INDEXED_DOCUMENTS
+    if AuditArchive in documents:
+        # Before ensure_indexes() creates it with the default compression
+        create_archive(archive_compressor)
+    for document in documents:
+        try:
+            document.ensure_indexes()
+        except OperationFailure as e:
+            errors[document._get_collection_name()] = str(e)
+    return errors
+
+
+def index_usage(document):
+    # Per-index access counters from $indexStats. Counters reset when mongod
+    # restarts, so "unused" means unused since the last restart.
+    # Returns None when the server (or mongomock) does not support $indexStats.
+    try:
+        stats = document._get_collection().aggregate([{'$indexStats': {}}])
+        return {stat['name']: stat['accesses']['ops'] for stat in stats}
+    except (OperationFailure, NotImplementedError):
+        return None
+
+
+def index_report(documents=None):
+    report = []
+    for document in documents or INDEXED_DOCUMENTS:
+        diff = document.compare_indexes()
+        usage = index_usage(document)
+        unused = None
+        if usage is not None:
+            unused = [name for name, ops in usage.items() if ops == 0 and name != '_id_']
+        report.append({
+            'collection': document._get_collection_name(),
+            'missing': [_index_name(key) for key in diff['missing']],
+            'extra': [_index_name(key) for key in diff['extra']],
+            'unused': unused,
+        })
+    return report
+
+
+def _plan_stages(plan):
+    stages = [plan.get('stage')]
+    if 'inputStage' in plan:
+        stages += _plan_stages(plan['inputStage'])
+    for child in plan.get('inputStages', []):
+        stages += _plan_stages(child)
+    return stages
+
+
+def winning_stages(explanation):
+    # Plan stages of an explain() result, outermost first
+    if 'queryPlanner' not in explanation and explanation.get('stages'):
+        # Aggregations whose first stage is not pushed down to the query layer
+        explanation = explanation['stages'][0].get('$cursor', {})
+    planner = explanation.get('queryPlanner', {})
+    plan = planner.get('winningPlan', {})
+    # Slot-based engine (MongoDB 7+) wraps the classic plan in queryPlan
+    plan = plan.get('queryPlan', plan)
+    return _plan_stages(plan)
+
+
+def hot_queries():
+    # The queries the routes actually run, with placeholder ids.
+    # Keep in sync with the lookups in application/routes.
+    some_id = ObjectId()
+    return {
+        'fee grid page (manage_fees)': Student.objects(class_name='1', roll_number__gt='R0001')
+                                              .order_by('roll_number').limit(101),
+        'fee grid (manage_fees)': Fee.objects(student__in=[some_id], month='1', year='2024'),
+        'duplicate check (add_fee)': Fee.objects(student=some_id, month='1', year='2024'),
+        'period totals (dashboard)': Fee.objects(year='2024', month='1'),
+        'recent activity (dashboard)': AuditLog.objects.order_by('-timestamp', '-id').limit(10),
+        'audit viewer by action': AuditArchive.objects(action='EDIT_FEE').order_by('-timestamp', '-id').limit(51),
+        'history of a record (audit)': AuditLog.objects(entity_type='student', entity_id=str(some_id))
+                                               .order_by('-timestamp'),
+        'payments by student (delete_student)': PaymentHistory.objects(student=some_id),
+        'payments by fee': PaymentHistory.objects(fee=some_id),
+        'students by class': Student.objects(class_name='1'),
+        'students by economic status': Student.objects(economic_status='Poor'),
+        'collections by day (analytics)': CollectionRollup.objects(day__gte='2024-01-01', day__lte='2024-12-31'),
+        'defaulters (defaulters report)': StudentBalance.objects(outstanding__gt=0, class_name='1')
+                                                        .order_by('-outstanding'),
+        'defaulters by name (defaulters report)': StudentBalance.objects(outstanding__gt=0).order_by('name'),
+    }
+
+
+def explain_hot_queries():
+    # Returns {query name: stages} where stages is the list of plan stages of
+    # the winning plan, or None when explain is unavailable (mongomock
+    # cursors have no explain()).
+    plans = {}
+    for name, queryset in hot_queries().items():
+        try:
+            plans[name] = winning_stages(queryset.explain())
+        except (AttributeError, NotImplementedError):
+            plans[name] = None
+    return plans
@@ -0,0 +1,277 @@
+import atexit
+import json
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+import uuid
+from flask import current_app
+from pymongo.errors import DuplicateKeyError
+
+logger = logging.getLogger(__name__)
+
+# Task functions by name. Arguments must be JSON serialisable (ids, numbers,
+# strings) so every backend can store them.
+TASKS = {}
+
+# A claimed job not finished after this long (worker killed mid-job) is
+# handed out again by the persistent backends
+VISIBILITY_TIMEOUT = 300
+
+
+def task(name):
+    def register(func):
+        TASKS[name] = func
+        return func
+    return register
+
+
+def retry_delay(attempts):
+    return min(2 ** attempts, 60)
+
+
+# Payment ids remembered per document by inc_once(). A retry comes within
+# minutes, long before this many other payments are counted in the same
+# document.
+ONCE_WINDOW = 1000
+
+# (collection, key fields) whose unique index inc_once() has checked in this
+# process
+_unique_keys = set()
+
+
+def _ensure_unique_key(collection, fields):
+    # The models do not build their indexes (see `flask indexes sync`), and
+    # without the unique index a retried upsert would insert a second
+    # document. So the first count into a collection creates the index if it
+    # is missing (a no-op when it exists). If it cannot be built, e.g. over
+    # duplicates, the task fails and is retried rather than counting twice.
+    if (collection.full_name, fields) in _unique_keys:
+        return
+    collection.create_index([(field, 1) for field in fields], unique=True)
+    _unique_keys.add((collection.full_name, fields))
+
+
+def inc_once(collection, key, payment_id, update):
+    # update_one(key, update, upsert=True) for a task that counts a payment
+    # into a running total: skipped when the document counted payment_id
+    # already, so a task retried after its write went through does not count
+    # the payment twice. key must match a unique index: for a counted
+    # payment the upsert's insert then fails with a duplicate key.
+    # Returns whether the payment was counted now.
+    _ensure_unique_key(collection, tuple(key))
+    update = dict(update, **{'$push': {'counted_payments': {'$each': [payment_id], '$slice': -ONCE_WINDOW}}})
+    try:
+        collection.update_one(dict(key, counted_payments={'$ne': payment_id}), update, upsert=True)
+        return True
+    except DuplicateKeyError:
+        return False
+
+
+class JobQueue:
+    # Base class: jobs run on worker threads that are started lazily in each
+    # process, so a queue created before a gunicorn fork still works after it
+    def __init__(self, app, workers=2, max_retries=3):
+        self.app = app
+        self.workers = workers
+        self.max_retries = max_retries
+        self._pid = None
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+
+    def enqueue(self, name, *args):
+        if name not in TASKS:
+            raise ValueError(f'unknown task {name}')
+        self._ensure_started()
+        self._push({'name': name, 'args': list(args), 'attempts': 0})
+
+    def _ensure_started(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._reset()
+            self._stopping.clear()
+            for _ in range(self.workers):
+                threading.Thread(target=self.work, daemon=True).start()
+            self._pid = os.getpid()
+            atexit.register(self.shutdown)
+
+    def work(self):
+        # Consumer loop; also used by `flask jobs work`
+        while not self._stopping.is_set():
+            job = self._pop(timeout=1)
+            if job is None:
+                continue
+            try:
+                with self.app.app_context():
+                    TASKS[job['name']](*job['args'])
+                self._done(job)
+            except Exception:
+                job['attempts'] += 1
+                if job['attempts'] > self.max_retries:
+                    logger.exception('Job %s%s failed, giving up', job['name'], job['args'])
+                    self._dead(job)
+                else:
+                    logger.warning('Job %s%s failed (attempt %d), retrying', job['name'], job['args'],
+                                   job['attempts'], exc_info=True)
+                    self._retry(job, retry_delay(job['attempts']))
+            finally:
+                self._task_done()
+
+    def shutdown(self, timeout=10):
+        self._stopping.set()
+
+    def _reset(self):
+        pass
+
+    def _task_done(self):
+        pass
+
+    def _done(self, job):
+        pass
+
+    def _dead(self, job):
+        pass
+
+
+class ThreadJobQueue(JobQueue):
+    # In-memory queue; jobs pending at exit are run before the process stops,
+    # within the shutdown timeout
+    def _reset(self):
+        self._queue = queue.Queue()
+
+    def _push(self, job):
+        self._queue.put(job)
+
+    def _pop(self, timeout):
+        try:
+            return self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def _task_done(self):
+        self._queue.task_done()
+
+    def _retry(self, job, delay):
+        timer = threading.Timer(delay, self._queue.put, [job])
+        timer.daemon = True
+        timer.start()
+
+    def shutdown(self, timeout=10):
+        if self._pid == os.getpid():
+            deadline = time.monotonic() + timeout
+            while self._queue.unfinished_tasks and time.monotonic() < deadline:
+                time.sleep(0.05)
+        super().shutdown(timeout)
+
+
+class SQLiteJobQueue(JobQueue):
+    # Jobs persisted in a SQLite file shared by all workers of a host; they
+    # survive restarts and can be consumed by `flask jobs work`
+    def __init__(self, app, path, **kwargs):
+        super().__init__(app, **kwargs)
+        self.path = path
+        self._local = threading.local()
+        with self._connect() as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS jobs ('
+                         'id INTEGER PRIMARY KEY, name TEXT, args TEXT, attempts INTEGER, '
+                         'run_at REAL, claimed_by TEXT, claimed_at REAL, failed INTEGER DEFAULT 0)')
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30, isolation_level=None)
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or getattr(self._local, 'pid', None) != os.getpid():
+            conn = self._local.conn = self._connect()
+            self._local.pid = os.getpid()
+        return conn
+
+    def _push(self, job):
+        self._conn().execute('INSERT INTO jobs (name, args, attempts, run_at) VALUES (?, ?, 0, ?)',
+                             (job['name'], json.dumps(job['args']), time.time()))
+
+    def _pop(self, timeout):
+        deadline = time.monotonic() + timeout
+        token = uuid.uuid4().hex
+        conn = self._conn()
+        while True:
+            now = time.time()
+            # The UPDATE runs under SQLite's write lock, so one job is claimed
+            # by one worker only
+            conn.execute('UPDATE jobs SET claimed_by = ?, claimed_at = ? WHERE id = ('
+                         'SELECT id FROM jobs WHERE failed = 0 AND run_at <= ? '
+                         'AND (claimed_by IS NULL OR claimed_at < ?) ORDER BY id LIMIT 1)',
+                         (token, now, now, now - VISIBILITY_TIMEOUT))
+            row = conn.execute('SELECT id, name, args, attempts FROM jobs WHERE claimed_by = ?',
+                               (token,)).fetchone()
+            if row:
+                return {'id': row[0], 'name': row[1], 'args': json.loads(row[2]), 'attempts': row[3]}
+            if time.monotonic() >= deadline or self._stopping.is_set():
+                return None
+            time.sleep(0.2)
+
+    def _done(self, job):
+        self._conn().execute('DELETE FROM jobs WHERE id = ?', (job['id'],))
+
+    def _retry(self, job, delay):
+        self._conn().execute('UPDATE jobs SET attempts = ?, run_at = ?, claimed_by = NULL WHERE id = ?',
+                             (job['attempts'], time.time() + delay, job['id']))
+
+    def _dead(self, job):
+        # Kept for inspection
+        self._conn().execute('UPDATE jobs SET attempts = ?, failed = 1 WHERE id = ?',
+                             (job['attempts'], job['id']))
+
+
+class RedisJobQueue(JobQueue):
+    # Jobs in a Redis (or Redis-compatible) list; needs the redis package.
+    # Retries wait in a sorted set scored by due time.
+    def __init__(self, app, url, key='school_fee:jobs', **kwargs):
+        import redis
+        super().__init__(app, **kwargs)
+        self.redis = redis.Redis.from_url(url)
+        self.key = key
+        self.delayed_key = f'{key}:delayed'
+
+    def _push(self, job):
+        self.redis.lpush(self.key, json.dumps(job))
+
+    def _pop(self, timeout):
+        # Move due retries back to the queue; ZREM succeeds for one worker only
+        for payload in self.redis.zrangebyscore(self.delayed_key, 0, time.time(), start=0, num=100):
+            if self.redis.zrem(self.delayed_key, payload):
+                self.redis.lpush(self.key, payload)
+        item = self.redis.brpop(self.key, timeout=max(1, int(timeout)))
+        return json.loads(item[1]) if item else None
+
+    def _retry(self, job, delay):
+        self.redis.zadd(self.delayed_key, {json.dumps(job): time.time() + delay})
+
+    def _dead(self, job):
+        self.redis.lpush(f'{self.key}:failed', json.dumps(job))
+
+
+def init_app(app):
+    # Import the modules defining tasks so every worker knows them
+    from application.services import analytics, audit, balances, dashboard, receipts  # noqa: F401
+
+    backend = app.config['JOB_QUEUE']
+    options = {'workers': app.config['JOB_WORKERS'], 'max_retries': app.config['JOB_MAX_RETRIES']}
+    if backend == 'sqlite':
+        os.makedirs(app.instance_path, exist_ok=True)
+        jobs = SQLiteJobQueue(app, app.config['JOB_QUEUE_URL'] or os.path.join(app.instance_path, 'jobs.sqlite3'),
+                              **options)
+    elif backend == 'redis':
+        jobs = RedisJobQueue(app, app.config['JOB_QUEUE_URL'] or 'redis://localhost:6379/0', **options)
+    else:
+        jobs = ThreadJobQueue(app, **options)
+    app.extensions['jobs'] = jobs
+
+
+def enqueue(name, *args):
+    current_app.extensions['jobs'].enqueue(name, *args)
@@ -0,0 +1,487 @@
+import atexit
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from flask import current_app, g, has_request_context, request, template_rendered, before_render_template
+from pymongo import monitoring
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds (seconds) of the request and Mongo time histograms
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Upper bounds of the Mongo commands per request histogram
+COMMAND_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+# Commands whose filter shape is shown, and where their filter lives
+FILTER_PATHS = {
+    'find': ('filter',),
+    'count': ('query',),
+    'distinct': ('query',),
+    'findAndModify': ('query',),
+    'update': ('updates', 0, 'q'),
+    'delete': ('deletes', 0, 'q'),
+    'aggregate': ('pipeline', 0, '$match'),
+}
+
+
+def filter_shape(value):
+    # A filter with every value replaced by '?': what the query looks like,
+    # not what it looked for
+    if value is None:
+        return None
+    if isinstance(value, dict):
+        return {key: filter_shape(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [filter_shape(item) for item in value[:1]]
+    return '?'
+
+
+def _command_filter(name, command):
+    if name not in FILTER_PATHS:
+        return None
+    value = command
+    for step in FILTER_PATHS[name]:
+        try:
+            value = value[step]
+        except (KeyError, IndexError, TypeError):
+            return None
+    return value
+
+
+class RequestStats:
+    # What one request spent its time on
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.mongo_commands = 0
+        self.mongo_seconds = 0.0
+        self.slowest = None
+        self.jinja_seconds = 0.0
+        self.pdf_seconds = 0.0
+        self._pending = {}
+        self._template_started = None
+
+    def command_started(self, event):
+        self._pending[event.request_id] = event
+
+    def command_finished(self, event):
+        started = self._pending.pop(event.request_id, None)
+        if started is None:
+            return
+        seconds = event.duration_micros / 1e6
+        self.mongo_commands += 1
+        self.mongo_seconds += seconds
+        if self.slowest is None or seconds > self.slowest['seconds']:
+            command = started.command
+            self.slowest = {
+                'seconds': seconds,
+                'command': event.command_name,
+                'collection': command.get(event.command_name) if isinstance(
+                    command.get(event.command_name), str) else None,
+                'filter': filter_shape(_command_filter(event.command_name, command)),
+            }
+
+
+def _current():
+    if not has_request_context():
+        return None
+    return g.get('request_stats')
+
+
+class CommandListener(monitoring.CommandListener):
+    # Passed to the MongoClient (MONGODB_SETTINGS event_listeners). Runs in
+    # the thread that issued the command, so commands are attributed to the
+    # request being served; background jobs and CLI commands are ignored.
+    def started(self, event):
+        stats = _current()
+        if stats is not None:
+            stats.command_started(event)
+
+    def succeeded(self, event):
+        stats = _current()
+        if stats is not None:
+            stats.command_finished(event)
+
+    def failed(self, event):
+        stats = _current()
+        if stats is not None:
+            stats.command_finished(event)
+
+
+command_listener = CommandListener()
+
+
+@contextmanager
+def rendering_pdf():
+    # Adds the time spent in the block to the request's PDF time; does
+    # nothing outside a request (batch printing workers, jobs)
+    stats = _current()
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        if stats is not None:
+            stats.pdf_seconds += time.perf_counter() - started
+
+
+@contextmanager
+def rendering_chunk():
+    # Around each chunk of a streamed template (streaming.stream_template):
+    # adds its render time to the request's template time. The template
+    # signals of a stream also span the client reading it, so they are not
+    # timed.
+    stats = _current()
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        if stats is not None:
+            stats.jinja_seconds += time.perf_counter() - started
+            stats._template_started = None
+
+
+def escape(value):
+    # A label value as the Prometheus text format quotes it
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+        self.count += 1
+        self.sum += value
+
+
+class Registry:
+    # Request metrics of this process, rendered in the Prometheus text format
+    COUNTERS = ('requests', 'jinja_seconds', 'pdf_seconds', 'slow_requests')
+    HISTOGRAMS = {'durations': DURATION_BUCKETS, 'mongo_durations': DURATION_BUCKETS,
+                  'mongo_commands': COMMAND_BUCKETS}
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        with self._lock:
+            self.requests = {}
+            self.durations = {}
+            self.mongo_durations = {}
+            self.mongo_commands = {}
+            self.jinja_seconds = {}
+            self.pdf_seconds = {}
+            self.slow_requests = {}
+            self.changed = False
+
+    def observe(self, endpoint, method, status, seconds, stats, slow):
+        key = (endpoint, method)
+        with self._lock:
+            self.requests[key + (str(status),)] = self.requests.get(key + (str(status),), 0) + 1
+            self.durations.setdefault(key, Histogram(DURATION_BUCKETS)).observe(seconds)
+            self.mongo_durations.setdefault(key, Histogram(DURATION_BUCKETS)).observe(stats.mongo_seconds)
+            self.mongo_commands.setdefault(key, Histogram(COMMAND_BUCKETS)).observe(stats.mongo_commands)
+            self.jinja_seconds[key] = self.jinja_seconds.get(key, 0.0) + stats.jinja_seconds
+            self.pdf_seconds[key] = self.pdf_seconds.get(key, 0.0) + stats.pdf_seconds
+            if slow:
+                self.slow_requests[key] = self.slow_requests.get(key, 0) + 1
+            self.changed = True
+
+    def state(self):
+        # Everything observed so far, as JSON-serialisable lists
+        with self._lock:
+            state = {name: [[list(key), value] for key, value in getattr(self, name).items()]
+                     for name in self.COUNTERS}
+            for name in self.HISTOGRAMS:
+                state[name] = [[list(key), [hist.counts, hist.count, hist.sum]]
+                               for key, hist in getattr(self, name).items()]
+            self.changed = False
+        return state
+
+    def merge(self, state):
+        # Adds another process' state() to this registry
+        with self._lock:
+            for name in self.COUNTERS:
+                values = getattr(self, name)
+                for key, value in state.get(name, []):
+                    values[tuple(key)] = values.get(tuple(key), 0) + value
+            for name, buckets in self.HISTOGRAMS.items():
+                values = getattr(self, name)
+                for key, (counts, count, total) in state.get(name, []):
+                    hist = values.setdefault(tuple(key), Histogram(buckets))
+                    hist.counts = [a + b for a, b in zip(hist.counts, counts)]
+                    hist.count += count
+                    hist.sum += total
+
+    def render(self, gauges=()):
+        # gauges: extra (name, help, [(labels, value)]) series, e.g. cache
+        # statistics per worker
+        lines = []
+
+        def labels(key, **extra):
+            names = dict(zip(('endpoint', 'method', 'status'), key), **extra)
+            return ','.join(f'{name}="{escape(value)}"' for name, value in names.items())
+
+        def counter(name, help_text, values):
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} counter')
+            for key, value in sorted(values.items()):
+                lines.append(f'{name}{{{labels(key)}}} {value}')
+
+        def histogram(name, help_text, values):
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} histogram')
+            for key, hist in sorted(values.items()):
+                for bound, count in zip(hist.buckets, hist.counts):
+                    lines.append(f'{name}_bucket{{{labels(key, le=bound)}}} {count}')
+                lines.append(f'{name}_bucket{{{labels(key, le="+Inf")}}} {hist.count}')
+                lines.append(f'{name}_sum{{{labels(key)}}} {hist.sum}')
+                lines.append(f'{name}_count{{{labels(key)}}} {hist.count}')
+
+        with self._lock:
+            counter('http_requests_total', 'Requests served.', self.requests)
+            histogram('http_request_duration_seconds', 'Request duration.', self.durations)
+            histogram('mongo_request_duration_seconds', 'Time per request spent in Mongo commands.',
+                      self.mongo_durations)
+            histogram('mongo_commands_per_request', 'Mongo commands per request.', self.mongo_commands)
+            counter('template_render_seconds_total', 'Time spent rendering templates.', self.jinja_seconds)
+            counter('pdf_render_seconds_total', 'Time spent rendering PDFs.', self.pdf_seconds)
+            counter('slow_requests_total', 'Requests over SLOW_REQUEST_MS.', self.slow_requests)
+        for name, help_text, series in gauges:
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} gauge')
+            for series_labels, value in series:
+                lines.append(f'{name}{{{labels((), **series_labels)}}} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+# When this worker started and how long it took to finish its first request.
+# gunicorn's post_fork hook (gunicorn.conf.py) resets the start to the fork;
+# otherwise it is when this module was imported.
+_worker = {'pid': os.getpid(), 'started': time.monotonic(), 'first_request': None}
+
+
+def worker_forked(started):
+    # started: time.monotonic() right after the fork
+    _worker.update(pid=os.getpid(), started=started, first_request=None)
+
+
+class SharedState:
+    # With METRICS_DIR set, every process writes its registry to
+    # <METRICS_DIR>/<pid>.json (from a background thread, at most every
+    # flush_interval seconds, and at exit) and /admin/metrics adds up the
+    # files of all of them. So one scrape covers every gunicorn worker.
+    # Files of workers that have exited are kept, so totals never go back.
+    def __init__(self, flush_interval=1.0):
+        self.directory = None
+        self.flush_interval = flush_interval
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def configure(self, directory):
+        self.directory = directory
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def ensure_started(self):
+        if not self.directory or self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            # Requests counted before a fork are the parent's
+            registry.clear()
+            threading.Thread(target=self._run, daemon=True).start()
+            self._pid = os.getpid()
+            atexit.register(self.flush)
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            if registry.changed:
+                self.flush()
+
+    def _path(self, pid):
+        return os.path.join(self.directory, f'{pid}.json')
+
+    def flush(self):
+        if self._pid != os.getpid():
+            return
+        state = {'registry': registry.state(), 'first_request': _worker['first_request']}
+        temporary = self._path(self._pid) + '.tmp'
+        try:
+            with open(temporary, 'w') as f:
+                json.dump(state, f)
+            # Readers never see a half-written file
+            os.replace(temporary, self._path(self._pid))
+        except OSError:
+            logger.exception('Writing metrics to %s failed', self.directory)
+
+    def collect(self):
+        # (registry of all processes, {pid: first request seconds})
+        combined = Registry()
+        combined.merge(registry.state())
+        first_requests = {os.getpid(): _worker['first_request']}
+        if self.directory:
+            for name in os.listdir(self.directory):
+                pid, extension = os.path.splitext(name)
+                if extension != '.json' or not pid.isdigit() or int(pid) == os.getpid():
+                    continue
+                try:
+                    with open(os.path.join(self.directory, name)) as f:
+                        state = json.load(f)
+                except (OSError, ValueError):
+                    continue
+                combined.merge(state['registry'])
+                first_requests[int(pid)] = state.get('first_request')
+        return combined, first_requests
+
+
+shared = SharedState()
+
+
+def _start_request():
+    shared.ensure_started()
+    g.request_stats = RequestStats()
+
+
+def _template_started(sender, template, context, **extra):
+    stats = _current()
+    if stats is not None:
+        stats._template_started = time.perf_counter()
+
+
+def _template_finished(sender, template, context, **extra):
+    stats = _current()
+    if stats is not None and stats._template_started is not None:
+        stats.jinja_seconds += time.perf_counter() - stats._template_started
+        stats._template_started = None
+
+
+class StreamedBody:
+    # The body of a streamed response, which is produced after the request
+    # handlers return: the request is recorded once the server has sent the
+    # body (or given up on it), so its time counts
+    def __init__(self, body, finish):
+        self._body = body
+        self._finish = finish
+        self._failed = False
+
+    def __iter__(self):
+        try:
+            yield from self._body
+        except Exception:
+            self._failed = True
+            raise
+
+    def close(self):
+        try:
+            if hasattr(self._body, 'close'):
+                self._body.close()
+        finally:
+            finish, self._finish = self._finish, None
+            if finish is not None:
+                finish(failed=self._failed)
+
+
+def _finish_request(response):
+    app = current_app
+    stats = g.get('request_stats')
+    if stats is None:
+        return response
+    if app.config['SERVER_TIMING']:
+        # For a streamed response this covers the time to its first chunk
+        seconds = time.perf_counter() - stats.started
+        timings = [f'mongo;dur={stats.mongo_seconds * 1000:.1f};desc="{stats.mongo_commands} commands"']
+        if stats.jinja_seconds:
+            timings.append(f'jinja;dur={stats.jinja_seconds * 1000:.1f}')
+        if stats.pdf_seconds:
+            timings.append(f'pdf;dur={stats.pdf_seconds * 1000:.1f}')
+        timings.append(f'app;dur={seconds * 1000:.1f}')
+        response.headers.add('Server-Timing', ', '.join(timings))
+
+    entry = {
+        'endpoint': request.endpoint or 'unmatched',
+        'method': request.method,
+        'path': request.path,
+        'status': response.status_code,
+    }
+    slow_ms = app.config['SLOW_REQUEST_MS']
+    if response.is_streamed and not response.direct_passthrough:
+        # g.request_stats stays: stream_with_context bodies run in this
+        # request's context, so their queries and templates count
+        entry['streamed'] = True
+        response.response = StreamedBody(
+            response.response, lambda failed: _record(entry, stats, slow_ms, failed))
+    else:
+        g.pop('request_stats')
+        _record(entry, stats, slow_ms)
+    return response
+
+
+def _record(entry, stats, slow_ms, failed=False):
+    # Adds a finished request to the registry and logs it; entry: its
+    # endpoint, method, path and status
+    seconds = time.perf_counter() - stats.started
+    if failed:
+        entry['status'] = 500
+    slow = seconds * 1000 >= slow_ms
+    registry.observe(entry['endpoint'], entry['method'], entry['status'], seconds, stats, slow)
+    if _worker['first_request'] is None:
+        _worker['first_request'] = time.monotonic() - _worker['started']
+        logger.info('worker ready %s', json.dumps({
+            'pid': os.getpid(), 'first_request_ms': round(_worker['first_request'] * 1000, 1)}))
+
+    entry.update({
+        'duration_ms': round(seconds * 1000, 1),
+        'mongo_commands': stats.mongo_commands,
+        'mongo_ms': round(stats.mongo_seconds * 1000, 1),
+        'jinja_ms': round(stats.jinja_seconds * 1000, 1),
+        'pdf_ms': round(stats.pdf_seconds * 1000, 1),
+    })
+    if stats.slowest is not None:
+        entry['slowest'] = dict(stats.slowest)
+        entry['slowest']['ms'] = round(entry['slowest'].pop('seconds') * 1000, 1)
+    if slow:
+        # No query plan here: explaining the command would hold up the
+        # worker on the requests that are already slow. `flask indexes
+        # explain` checks the plans of the hot queries instead.
+        logger.warning('slow request %s', json.dumps(entry, default=str))
+    elif failed:
+        logger.warning('request %s', json.dumps(entry, default=str))
+    else:
+        logger.info('request %s', json.dumps(entry, default=str))
+
+
+def init_app(app):
+    # Call before db.init_app(): the listener is handed to every MongoClient
+    for settings in app.config['MONGODB_SETTINGS']:
+        settings.setdefault('event_listeners', []).append(command_listener)
+    shared.configure(app.config['METRICS_DIR'])
+    app.before_request(_start_request)
+    app.after_request(_finish_request)
+    before_render_template.connect(_template_started, app)
+    template_rendered.connect(_template_finished, app)
+
+
+def render(gauges=()):
+    # gauges: (name, help, value) of this worker; labelled with its pid, as
+    # other workers report their own values
+    combined, first_requests = shared.collect()
+    pid = {'pid': os.getpid()}
+    series = [(name, help_text, [(pid, value)]) for name, help_text, value in gauges]
+    series.append(('worker_first_request_seconds', 'Time from worker start to its first response.',
+                   [({'pid': worker}, seconds) for worker, seconds in sorted(first_requests.items())
+                    if seconds is not None]))
+    return combined.render(series)
@@ -0,0 +1,41 @@
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
+
+# Money is stored and computed as integer paise (1 rupee = 100 paise), so
+# sums are exact. Rupees only appear at the edges: form input, JSON, PDFs,
+# exports and templates.
+PAISE_PER_RUPEE = 100
+
+# Money fields of each collection, all integer paise
+MONEY_FIELDS = {
+    'fee': ('base_fee', 'hostel_food_fee', 'milk_fee', 'discount', 'total_fee', 'paid_amount'),
+    'payment_history': ('amount',),
+    'dashboard_summary': ('total_fees', 'collected_fees'),
+    'student_balances': ('billed', 'paid', 'outstanding'),
+    'collection_rollups': ('amount',),
+}
+
+
+def to_paise(rupees):
+    # Rupees as entered ('1250.50', 1250.5, Decimal) to integer paise,
+    # rounding half up; raises ValueError for anything else
+    if isinstance(rupees, bool):
+        raise ValueError(f'Invalid amount: {rupees}')
+    try:
+        value = Decimal(str(rupees).strip())
+    except InvalidOperation:
+        raise ValueError(f'Invalid amount: {rupees}')
+    if not value.is_finite():
+        raise ValueError(f'Invalid amount: {rupees}')
+    return int((value * PAISE_PER_RUPEE).quantize(Decimal(1), rounding=ROUND_HALF_UP))
+
+
+def to_rupees(paise):
+    # For JSON and charts; exact for any amount a school deals in
+    return paise / PAISE_PER_RUPEE
+
+
+def format_rupees(paise):
+    # '1250.50'; also the `rupees` template filter
+    sign = '-' if paise < 0 else ''
+    rupees, rest = divmod(abs(int(paise)), PAISE_PER_RUPEE)
+    return f'{sign}{rupees}.{rest:02d}'
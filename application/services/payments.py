@@ -0,0 +1,132 @@
+from datetime import datetime, timedelta
+from flask import current_app
+from pymongo import ReturnDocument
+from application.models import Fee, PaymentHistory
+from application.services.balances import period_key
+from application.services import versions
+from application.services.jobs import enqueue
+from application.services.money import format_rupees
+
+# Deployments that support multi-document transactions
+TRANSACTION_TOPOLOGIES = ('ReplicaSetWithPrimary', 'Sharded', 'LoadBalanced')
+
+
+class PaymentError(ValueError):
+    pass
+
+
+def transactions_available(collection):
+    setting = current_app.config['PAYMENT_TRANSACTIONS']
+    if setting != 'auto':
+        return setting == 'on'
+    description = getattr(collection.database.client, 'topology_description', None)
+    return description is not None and description.topology_type_name in TRANSACTION_TOPOLOGIES
+
+
+def _apply_to_fee(fee_id, payment_id, amount, session=None):
+    # Conditional $inc: succeeds only if the payment is not applied yet and
+    # does not take paid_amount over total_fee. No read-modify-write, so
+    # concurrent payments on one fee can neither lose an update nor overpay.
+    return Fee._get_collection().find_one_and_update(
+        {
+            '_id': fee_id,
+            'applied_payments': {'$ne': payment_id},
+            '$expr': {'$lte': [{'$add': ['$paid_amount', amount]}, '$total_fee']},
+        },
+        {
+            '$inc': {'paid_amount': amount},
+            '$push': {'applied_payments': payment_id},
+            '$set': {'updated_at': datetime.utcnow()},
+        },
+        projection={'student': 1, 'month': 1, 'year': 1, 'total_fee': 1, 'paid_amount': 1},
+        return_document=ReturnDocument.AFTER,
+        session=session,
+    )
+
+
+def _rejection(fee_id, amount):
+    fee = Fee._get_collection().find_one({'_id': fee_id}, {'total_fee': 1, 'paid_amount': 1})
+    if fee is None:
+        return PaymentError('Fee record no longer exists')
+    remaining = fee['total_fee'] - fee['paid_amount']
+    return PaymentError(f"Payment amount exceeds remaining fee (₹{format_rupees(remaining)})")
+
+
+def apply_payment(payment):
+    # Records an unsaved PaymentHistory and adds it to its fee atomically.
+    # Returns the updated fee as a dict (student, month, year, total_fee,
+    # paid_amount), or
+    # raises PaymentError when the fee cannot take the amount.
+    if payment.amount <= 0:
+        raise PaymentError("Payment amount must be greater than 0")
+    payments = PaymentHistory._get_collection()
+    fee_id = payment.to_mongo()['fee']
+
+    if transactions_available(payments):
+        payment.status = 'applied'
+        payment.validate()
+        doc = payment.to_mongo()
+
+        def record(session):
+            payments.insert_one(doc, session=session)
+            fee = _apply_to_fee(fee_id, doc['_id'], payment.amount, session=session)
+            if fee is None:
+                # Aborts the transaction, taking the insert back with it
+                raise _rejection(fee_id, payment.amount)
+            return fee
+
+        with payments.database.client.start_session() as session:
+            fee = session.with_transaction(record)
+        payment.id = doc['_id']
+        versions.bump(versions.FEES)
+        return fee
+
+    # No transactions: the payment document doubles as the outbox record.
+    # It is written as pending, the fee update is made idempotent by the
+    # payment id, and the payment is either marked applied or removed again.
+    # recover_pending_payments() settles payments interrupted in between.
+    payment.status = 'pending'
+    payment.save()
+    fee = _apply_to_fee(fee_id, payment.id, payment.amount)
+    if fee is None:
+        payments.delete_one({'_id': payment.id, 'status': 'pending'})
+        raise _rejection(fee_id, payment.amount)
+    payments.update_one({'_id': payment.id}, {'$set': {'status': 'applied'}})
+    payment.status = 'applied'
+    versions.bump(versions.FEES)
+    return fee
+
+
+def enqueue_payment_side_effects(admin_id, payment_id, fee, amount, balance):
+    # Secondary writes of a payment, run as background jobs. fee is the fee
+    # dict returned by apply_payment().
+    # Retried on failure; the payment id keeps them from counting it twice
+    enqueue('dashboard.payment_added', fee['year'], amount, payment_id)
+    enqueue('balances.payment_added', str(fee['student']), period_key(fee['month'], fee['year']), amount,
+            payment_id)
+    enqueue('analytics.payment_added', payment_id)
+    enqueue('audit.payment', admin_id, payment_id)
+    enqueue('receipts.render', payment_id, balance)
+
+
+def recover_pending_payments(older_than=timedelta(minutes=5)):
+    # Settles payments left pending by a worker that died mid-payment: applied
+    # if the fee already includes them, removed otherwise (the cashier saw an
+    # error). Returns (applied, removed).
+    payments = PaymentHistory._get_collection()
+    fees = Fee._get_collection()
+    applied = removed = 0
+    cutoff = datetime.utcnow() - older_than
+    for doc in payments.find({'status': 'pending', 'payment_date': {'$lt': cutoff}}):
+        fee = fees.find_one({'_id': doc['fee'], 'applied_payments': doc['_id']},
+                            {'student': 1, 'month': 1, 'year': 1, 'total_fee': 1, 'paid_amount': 1})
+        if fee is not None:
+            payments.update_one({'_id': doc['_id']}, {'$set': {'status': 'applied'}})
+            enqueue_payment_side_effects(str(doc['created_by']), str(doc['_id']), fee, doc['amount'], None)
+            applied += 1
+        else:
+            payments.delete_one({'_id': doc['_id'], 'status': 'pending'})
+            removed += 1
+    if applied:
+        versions.bump(versions.FEES)
+    return applied, removed
@@ -0,0 +1,162 @@
+import threading
+import time
+from bisect import bisect_right
+from datetime import datetime
+from application.models import Counter, FeeSchedule
+from application.services.money import to_paise
+
+# Rates used for years before the first stored schedule. Schedules are
+# written in rupees; quotes are in paise.
+DEFAULT_CLASSES = {
+    '1': {'base': 5000, 'hostel': 20000, 'milk': 500},
+    '2': {'base': 5500, 'hostel': 20000, 'milk': 500},
+    '3': {'base': 6000, 'hostel': 20000, 'milk': 500},
+    '4': {'base': 6500, 'hostel': 20000, 'milk': 500},
+    '5': {'base': 7000, 'hostel': 20000, 'milk': 500},
+    '6': {'base': 7500, 'hostel': 20000, 'milk': 500},
+    '7': {'base': 8000, 'hostel': 20000, 'milk': 500},
+    '8': {'base': 8500, 'hostel': 20000, 'milk': 500},
+    '9': {'base': 9000, 'hostel': 20000, 'milk': 500},
+    '10': {'base': 9500, 'hostel': 20000, 'milk': 500},
+}
+
+# Bumped by publish_schedule(); workers recompile when it changes
+VERSION_COUNTER = 'fee_schedule'
+
+
+def _compile(classes, discounts):
+    # {class_name: (base, hostel, milk)}, {economic_status: (percent, amount)}
+    # with amounts in paise
+    return (
+        {name: (to_paise(rates.get('base', 0)), to_paise(rates.get('hostel', 0)), to_paise(rates.get('milk', 0)))
+         for name, rates in classes.items()},
+        {status: (float(rule.get('percent', 0)), to_paise(rule.get('amount', 0)))
+         for status, rule in (discounts or {}).items()},
+    )
+
+
+class PricingEngine:
+    # Fee schedules compiled into per-year lookup tables. A worker checks the
+    # schedule version counter at most every refresh_interval seconds and
+    # recompiles when it has changed, so quotes need no queries.
+    def __init__(self, refresh_interval=30.0):
+        self.refresh_interval = refresh_interval
+        self._lock = threading.Lock()
+        self._version = None
+        self._checked_at = None
+        # (start years, compiled tables), replaced as one so a reader never
+        # pairs the years of one load with the tables of another
+        self._schedules = ([], [])
+        self._default = _compile(DEFAULT_CLASSES, {})
+
+    def _refresh(self):
+        now = time.monotonic()
+        if self._checked_at is not None and now - self._checked_at < self.refresh_interval:
+            return
+        with self._lock:
+            if self._checked_at is not None and now - self._checked_at < self.refresh_interval:
+                return
+            counter = Counter._get_collection().find_one({'_id': VERSION_COUNTER})
+            version = counter['value'] if counter else 0
+            if version != self._version:
+                self._load()
+                self._version = version
+            self._checked_at = now
+
+    def _load(self):
+        latest = {}
+        for doc in FeeSchedule._get_collection().find({}, {'year': 1, 'version': 1, 'classes': 1, 'discounts': 1}):
+            if doc['year'] not in latest or doc['version'] > latest[doc['year']]['version']:
+                latest[doc['year']] = doc
+        years = sorted(latest, key=int)
+        self._schedules = ([int(year) for year in years],
+                           [_compile(latest[year]['classes'], latest[year].get('discounts')) for year in years])
+
+    def invalidate(self):
+        self._checked_at = None
+
+    def table(self, year):
+        # The schedule in force in year: the latest one starting at or before it
+        self._refresh()
+        years, tables = self._schedules
+        index = bisect_right(years, int(year)) - 1
+        return tables[index] if index >= 0 else self._default
+
+    def quote(self, class_name, hostel_food_opted, milk_opted, economic_status=None, year=None):
+        classes, discounts = self.table(year or datetime.now().year)
+        base_fee, hostel, milk = classes.get(class_name, (0, 0, 0))
+        hostel_food_fee = hostel if hostel_food_opted else 0
+        milk_fee = milk if milk_opted else 0
+        percent, amount = discounts.get(economic_status, (0.0, 0))
+        # Percentages round half up to the paisa
+        discount = min(int(base_fee * percent / 100 + 0.5) + amount, base_fee)
+        return {
+            'base_fee': base_fee,
+            'hostel_food_fee': hostel_food_fee,
+            'milk_fee': milk_fee,
+            'discount': discount,
+            'total': base_fee + hostel_food_fee + milk_fee - discount
+        }
+
+
+engine = PricingEngine()
+
+
+def init_app(app):
+    engine.refresh_interval = app.config['PRICING_REFRESH_INTERVAL']
+
+
+def quote_fee(class_name, hostel_food_opted, milk_opted, economic_status=None, year=None):
+    # Monthly fee components for a student in paise, as offered by the
+    # "Add Fee" form
+    return engine.quote(class_name, hostel_food_opted, milk_opted, economic_status, year)
+
+
+def quote_students(students, year=None):
+    # {student id: quote} for raw student documents
+    return {
+        str(student['_id']): quote_fee(
+            student['class_name'], student.get('hostel_food_opted', False), student.get('milk_opted', False),
+            student.get('economic_status'), year)
+        for student in students
+    }
+
+
+def current_schedule(year):
+    # (version, classes, discounts) in force in year; version 0 is the default
+    # Years are four digit strings, so they compare as strings
+    doc = FeeSchedule._get_collection().find_one(
+        {'year': {'$lte': str(year)}}, sort=[('year', -1), ('version', -1)])
+    if doc is None:
+        return 0, DEFAULT_CLASSES, {}
+    return doc['version'], doc['classes'], doc.get('discounts', {})
+
+
+def publish_schedule(year, classes, discounts=None, admin=None):
+    # Stores a new version of the year's schedule and bumps the version
+    # counter so every worker recompiles
+    for name, rates in classes.items():
+        unknown = set(rates) - {'base', 'hostel', 'milk'}
+        if unknown:
+            raise ValueError(f'class {name}: unknown component(s) {", ".join(sorted(unknown))}')
+    for status, rule in (discounts or {}).items():
+        unknown = set(rule) - {'percent', 'amount'}
+        if unknown:
+            raise ValueError(f'discount {status}: unknown field(s) {", ".join(sorted(unknown))}')
+    # Every amount must be a valid rupee amount before anything is stored
+    _compile(classes, discounts)
+
+    year = str(year)
+    if not (len(year) == 4 and year.isdigit()):
+        raise ValueError(f'year must have four digits, got {year}')
+    latest = FeeSchedule.objects(year=year).order_by('-version').only('version').first()
+    schedule = FeeSchedule(
+        year=year,
+        version=(latest.version if latest else 0) + 1,
+        classes=classes,
+        discounts=discounts or {},
+        created_by=admin,
+    ).save()
+    Counter._get_collection().update_one({'_id': VERSION_COUNTER}, {'$inc': {'value': 1}}, upsert=True)
+    engine.invalidate()
+    return schedule
@@ -0,0 +1,96 @@
+import threading
+import time
+from collections import OrderedDict
+from bson import ObjectId
+from bson.errors import InvalidId
+from flask_login import UserMixin
+from mongoengine import signals
+from application.models import Admin
+
+
+class Principal(UserMixin):
+    # What a request needs to know about the logged in admin; routes use
+    # current_user.id and current_user.username only
+    def __init__(self, id, username, email):
+        self.id = id
+        self.username = username
+        self.email = email
+
+
+class PrincipalCache:
+    # Per-process LRU of principals by id, each kept for at most ttl seconds.
+    # Changes made through this process invalidate the entry at once (see
+    # the signal handlers below); other workers see them after the ttl.
+    def __init__(self, max_size=256, ttl=60.0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def configure(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.clear()
+
+    def get(self, user_id):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None and entry[0] > now:
+                self._entries.move_to_end(user_id)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+
+        principal = self._load(user_id)
+        if principal is not None and self.max_size:
+            with self._lock:
+                self._entries[user_id] = (now + self.ttl, principal)
+                self._entries.move_to_end(user_id)
+                while len(self._entries) > self.max_size:
+                    self._entries.popitem(last=False)
+        return principal
+
+    def _load(self, user_id):
+        try:
+            pk = ObjectId(user_id)
+        except (InvalidId, TypeError):
+            return None
+        doc = Admin._get_collection().find_one({'_id': pk}, {'username': 1, 'email': 1})
+        if doc is None:
+            return None
+        return Principal(doc['_id'], doc['username'], doc.get('email'))
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._entries.pop(str(user_id), None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'size': len(self._entries)}
+
+
+cache = PrincipalCache()
+
+
+def _admin_changed(sender, document, **kwargs):
+    cache.invalidate(document.pk)
+
+
+signals.post_save.connect(_admin_changed, sender=Admin)
+signals.post_delete.connect(_admin_changed, sender=Admin)
+
+
+def init_app(app, login_manager):
+    cache.configure(app.config['PRINCIPAL_CACHE_SIZE'], app.config['PRINCIPAL_CACHE_TTL'])
+    login_manager.user_loader(cache.get)
+
+
+def stats():
+    return cache.stats()
@@ -0,0 +1,60 @@
+import os
+import threading
+from datetime import datetime
+from flask import current_app
+from pymongo import ReturnDocument
+from application.models import Counter
+
+
+class ReceiptNumberAllocator:
+    # Hands out receipt numbers from blocks reserved with one $inc on the
+    # counters collection, so most numbers need no round trip. Blocks are
+    # never shared between processes: a forked worker reserves its own.
+    # Numbers left in a block when a process stops are skipped, so the
+    # sequence is unique and increasing but may have gaps.
+    def __init__(self, block_size=50, number_format='RCP{series}{number:06d}'):
+        self.block_size = block_size
+        self.number_format = number_format
+        self._lock = threading.Lock()
+        self._pid = None
+        self._blocks = {}
+
+    def _reserve(self, series):
+        counter = Counter._get_collection().find_one_and_update(
+            {'_id': f'receipt:{series}'},
+            {'$inc': {'value': self.block_size}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+        end = counter['value']
+        return [end - self.block_size + 1, end]
+
+    def next_number(self, series):
+        with self._lock:
+            if self._pid != os.getpid():
+                self._blocks = {}
+                self._pid = os.getpid()
+            block = self._blocks.get(series)
+            if block is None or block[0] > block[1]:
+                block = self._blocks[series] = self._reserve(series)
+            number = block[0]
+            block[0] += 1
+        return number
+
+    def next_receipt_number(self, series=None):
+        # series defaults to the current year: numbering restarts every year
+        series = series or str(datetime.now().year)
+        return self.number_format.format(series=series, number=self.next_number(series))
+
+
+def get_allocator():
+    allocator = current_app.extensions.get('receipt_numbers')
+    if allocator is None:
+        allocator = ReceiptNumberAllocator(current_app.config['RECEIPT_NUMBER_BLOCK'],
+                                           current_app.config['RECEIPT_NUMBER_FORMAT'])
+        current_app.extensions['receipt_numbers'] = allocator
+    return allocator
+
+
+def next_receipt_number(series=None):
+    return get_allocator().next_receipt_number(series or current_app.config['RECEIPT_NUMBER_SERIES'])
@@ -0,0 +1,145 @@
+import os
+from datetime import datetime, timezone
+from flask import current_app
+from application.models import PaymentHistory
+from application.utils import generate_receipt_pdf, RECEIPT_TEMPLATE_VERSION
+from application.services.jobs import task
+from application.services.references import resolve
+
+
+def receipt_key(payment_id, version=RECEIPT_TEMPLATE_VERSION):
+    return f'{payment_id}-v{version}'
+
+
+def _is_current(key):
+    return key.endswith(f'-v{RECEIPT_TEMPLATE_VERSION}')
+
+
+class FilesystemReceiptStore:
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, f'{key}.pdf')
+
+    def get(self, key):
+        # Returns (bytes, last modified) or None
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            modified = os.path.getmtime(path)
+        except FileNotFoundError:
+            return None
+        return data, datetime.fromtimestamp(modified, timezone.utc)
+
+    def exists(self, key):
+        return os.path.exists(self._path(key))
+
+    def put(self, key, data):
+        # Write then rename, so a concurrent reader never sees half a file
+        path = self._path(key)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        return datetime.fromtimestamp(os.path.getmtime(path), timezone.utc)
+
+    def prune(self):
+        # Deletes receipts rendered with an older template version
+        removed = 0
+        for name in os.listdir(self.directory):
+            if name.endswith('.pdf') and not _is_current(name[:-4]):
+                os.remove(os.path.join(self.directory, name))
+                removed += 1
+        return removed
+
+
+class GridFSReceiptStore:
+    def __init__(self, database, collection='receipts'):
+        import gridfs
+        self.fs = gridfs.GridFS(database, collection=collection)
+
+    def get(self, key):
+        stored = self.fs.find_one({'filename': key})
+        if stored is None:
+            return None
+        return stored.read(), stored.upload_date.replace(tzinfo=timezone.utc)
+
+    def exists(self, key):
+        return self.fs.exists({'filename': key})
+
+    def put(self, key, data):
+        # Two workers rendering the same receipt store identical bytes;
+        # get() returns whichever was stored first
+        file_id = self.fs.put(data, filename=key, contentType='application/pdf')
+        return self.fs.get(file_id).upload_date.replace(tzinfo=timezone.utc)
+
+    def prune(self):
+        removed = 0
+        for stored in self.fs.find():
+            if not _is_current(stored.filename):
+                self.fs.delete(stored._id)
+                removed += 1
+        return removed
+
+
+def get_store():
+    # One store per app, built from RECEIPT_STORE ('filesystem' or 'gridfs')
+    store = current_app.extensions.get('receipt_store')
+    if store is None:
+        if current_app.config['RECEIPT_STORE'] == 'gridfs':
+            from mongoengine.connection import get_db
+            store = GridFSReceiptStore(get_db())
+        else:
+            store = FilesystemReceiptStore(current_app.config['RECEIPT_CACHE_DIR'])
+        current_app.extensions['receipt_store'] = store
+    return store
+
+
+def _balance_after(payment, fee):
+    # Balance on the fee right after this payment, so a receipt renders the
+    # same whenever it is first requested
+    pipeline = [
+        {'$match': {'fee': fee.id, 'payment_date': {'$lte': payment.payment_date}}},
+        {'$group': {'_id': None, 'paid': {'$sum': '$amount'}}},
+    ]
+    result = list(PaymentHistory.objects.aggregate(pipeline))
+    return fee.total_fee - (result[0]['paid'] if result else 0)
+
+
+def get_receipt(payment, student=None, fee=None, admin=None, balance=None):
+    # Returns (pdf bytes, etag, last modified), rendering and storing the
+    # receipt the first time it is asked for
+    store = get_store()
+    key = receipt_key(payment.id)
+    cached = store.get(key)
+    if cached is not None:
+        data, modified = cached
+        return data, key, modified
+
+    resolve([payment], *(name for name, given in (('fee', fee), ('student', student), ('created_by', admin))
+                         if given is None))
+    fee = fee or payment.fee
+    if balance is None:
+        balance = _balance_after(payment, fee)
+    buffer = generate_receipt_pdf(payment, student or payment.student, fee,
+                                  admin or payment.created_by, balance=balance)
+    data = buffer.getvalue()
+    modified = store.put(key, data)
+    return data, key, modified
+
+
+@task('receipts.render')
+def render_receipt(payment_id, balance=None):
+    # Background rendering after a payment; a no-op if already rendered
+    if get_store().exists(receipt_key(payment_id)):
+        return
+    payment = PaymentHistory.objects(pk=payment_id).first()
+    if payment is not None:
+        get_receipt(payment, balance=balance)
+
+
+def receipt_ready(payment_id):
+    return get_store().exists(receipt_key(payment_id))
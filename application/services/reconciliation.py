@@ -0,0 +1,189 @@
+import csv
+import time
+from bson import ObjectId
+from pymongo import UpdateOne
+from application.models import Fee, PaymentHistory
+from application.services import versions
+from application.services.money import MONEY_FIELDS, format_rupees, to_paise
+
+# Documents fetched per cursor batch while loading the arrays
+DEFAULT_BATCH_SIZE = 50000
+
+# Fee updates per bulk_write when repairing
+REPAIR_BATCH_SIZE = 1000
+
+FEE_AMOUNTS = ('base_fee', 'hostel_food_fee', 'milk_fee', 'discount', 'total_fee', 'paid_amount')
+
+REPORT_COLUMNS = ['record', 'id', 'check', 'stored', 'expected']
+
+
+def _numpy():
+    # Reconciliation is an operator task and the only user of NumPy
+    try:
+        import numpy
+    except ImportError:
+        raise ValueError('Reconciliation requires numpy (pip install numpy)')
+    return numpy
+
+
+def _columns(np, cursor, fields, batch_size):
+    # Streams a projected cursor into one array per field: ObjectIds as
+    # 12 byte strings, amounts as int64 paise. Built batch by batch so only
+    # one batch of documents is held as Python objects at a time.
+    chunks = {field: [] for field in fields}
+    batch = []
+
+    def flush():
+        for field, kind in fields.items():
+            if kind == 'id':
+                chunks[field].append(np.array([doc[field].binary for doc in batch], dtype='S12'))
+                continue
+            values = np.array([doc.get(field, 0) for doc in batch])
+            if values.size and values.dtype.kind not in 'iu':
+                raise ValueError(f'{field} holds non-integer amounts; run `flask money migrate` first')
+            chunks[field].append(values.astype(np.int64))
+        batch.clear()
+
+    for doc in cursor.batch_size(batch_size):
+        batch.append(doc)
+        if len(batch) >= batch_size:
+            flush()
+    if batch:
+        flush()
+    return {
+        field: np.concatenate(parts) if parts else np.array([], dtype='S12' if fields[field] == 'id' else np.int64)
+        for field, parts in chunks.items()
+    }
+
+
+def _object_id(value):
+    # NumPy drops trailing NUL bytes from fixed size byte strings
+    return ObjectId(bytes(value).ljust(12, b'\0'))
+
+
+def reconcile(report_path=None, repair=False, batch_size=DEFAULT_BATCH_SIZE):
+    # Checks, for every fee, that total_fee is base + hostel/food + milk -
+    # discount and that paid_amount is the sum of its applied payments, and
+    # finds payments whose fee no longer exists. Both collections are loaded
+    # into NumPy arrays, so every check is a handful of vectorized operations.
+    # repair sets total_fee and paid_amount to the expected values, only on
+    # fees that have not changed since they were read. Returns the counts.
+    np = _numpy()
+    started = time.perf_counter()
+
+    fee_fields = dict.fromkeys(FEE_AMOUNTS, 'amount')
+    fee_fields['_id'] = 'id'
+    fees = _columns(np, Fee._get_collection().find({}, {field: 1 for field in FEE_AMOUNTS}),
+                    fee_fields, batch_size)
+    # Pending payments are not part of paid_amount yet (see payments.py)
+    payments = _columns(np, PaymentHistory._get_collection().find(
+        {'status': {'$ne': 'pending'}}, {'fee': 1, 'amount': 1}),
+        {'_id': 'id', 'fee': 'id', 'amount': 'amount'}, batch_size)
+    loaded = time.perf_counter()
+
+    # Payments are matched to fees by binary search over the sorted fee ids
+    order = np.argsort(fees['_id'], kind='stable')
+    sorted_ids = fees['_id'][order]
+    position = np.searchsorted(sorted_ids, payments['fee'])
+    position[position >= len(sorted_ids)] = 0
+    found = sorted_ids[position] == payments['fee'] if len(sorted_ids) else np.zeros(len(position), dtype=bool)
+    # Float weights are exact for sums below 2**53 paise
+    paid = np.rint(np.bincount(order[position[found]], weights=payments['amount'][found],
+                               minlength=len(order))).astype(np.int64)
+    total = fees['base_fee'] + fees['hostel_food_fee'] + fees['milk_fee'] - fees['discount']
+
+    bad_total = np.flatnonzero(fees['total_fee'] != total)
+    bad_paid = np.flatnonzero(fees['paid_amount'] != paid)
+    overpaid = np.flatnonzero(paid > total)
+    orphans = np.flatnonzero(~found)
+    checked = time.perf_counter()
+
+    if report_path:
+        with open(report_path, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(REPORT_COLUMNS)
+            for check, rows, stored, expected in (
+                ('total_fee', bad_total, fees['total_fee'], total),
+                ('paid_amount', bad_paid, fees['paid_amount'], paid),
+                ('overpaid', overpaid, paid, total),
+            ):
+                for i in rows:
+                    writer.writerow(['fee', str(_object_id(fees['_id'][i])), check,
+                                     format_rupees(stored[i]), format_rupees(expected[i])])
+            for i in orphans:
+                writer.writerow(['payment', str(_object_id(payments['_id'][i])), 'missing_fee',
+                                 format_rupees(payments['amount'][i]), ''])
+
+    repaired = skipped = 0
+    if repair:
+        operations = []
+        for i in np.union1d(bad_total, bad_paid):
+            operations.append(UpdateOne(
+                {'_id': _object_id(fees['_id'][i]), 'total_fee': int(fees['total_fee'][i]),
+                 'paid_amount': int(fees['paid_amount'][i])},
+                {'$set': {'total_fee': int(total[i]), 'paid_amount': int(paid[i])}}
+            ))
+        collection = Fee._get_collection()
+        for start in range(0, len(operations), REPAIR_BATCH_SIZE):
+            result = collection.bulk_write(operations[start:start + REPAIR_BATCH_SIZE], ordered=False)
+            repaired += result.modified_count
+        # Fees paid or edited since they were read are left for the next run
+        skipped = len(operations) - repaired
+        if repaired:
+            versions.bump(versions.FEES)
+
+    return {
+        'fees': len(fees['_id']),
+        'payments': len(payments['_id']),
+        'total_mismatches': len(bad_total),
+        'paid_mismatches': len(bad_paid),
+        'overpaid': len(overpaid),
+        'orphan_payments': len(orphans),
+        'repaired': repaired,
+        'skipped': skipped,
+        'load_seconds': loaded - started,
+        'check_seconds': checked - loaded,
+    }
+
+
+def _converted(doc, fields):
+    # $set of the fields of doc still stored as float rupees
+    update = {field: to_paise(doc[field]) for field in fields if isinstance(doc.get(field), float)}
+    for key, amount in (doc.get('periods') or {}).items():
+        if isinstance(amount, float):
+            update[f'periods.{key}'] = to_paise(amount)
+    return update
+
+
+def migrate_to_paise(batch_size=REPAIR_BATCH_SIZE):
+    # Converts money stored as float rupees to integer paise, in place. Only
+    # doubles are converted, so the migration can be interrupted and run
+    # again. Returns {collection: documents converted}.
+    db = Fee._get_collection().database
+    converted = {}
+    for name, fields in MONEY_FIELDS.items():
+        collection = db[name]
+        query = {'$or': [{field: {'$type': 'double'}} for field in fields]}
+        projection = {field: 1 for field in fields}
+        if name == 'student_balances':
+            # Period amounts are keyed by month, so those documents are all read
+            query = {}
+            projection['periods'] = 1
+        operations = []
+        count = 0
+        for doc in collection.find(query, projection, batch_size=batch_size):
+            update = _converted(doc, fields)
+            if not update:
+                continue
+            operations.append(UpdateOne({'_id': doc['_id']}, {'$set': update}))
+            if len(operations) >= batch_size:
+                collection.bulk_write(operations, ordered=False)
+                count += len(operations)
+                operations = []
+        if operations:
+            collection.bulk_write(operations, ordered=False)
+            count += len(operations)
+        converted[name] = count
+    if any(converted.values()):
+        versions.bump(versions.STUDENTS, versions.FEES)
+    return converted
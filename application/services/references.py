@@ -0,0 +1,90 @@
+import logging
+from bson import DBRef
+from flask import current_app, g, has_app_context
+from mongoengine.base import get_document
+from application import db
+
+logger = logging.getLogger(__name__)
+
+# Lazy dereferences of one field allowed per request before it counts as N+1
+DEFAULT_LAZY_LOAD_LIMIT = 3
+
+
+class NPlusOneError(RuntimeError):
+    pass
+
+
+def _identity_map():
+    # Documents loaded in this request (app context), by (collection, id)
+    if not has_app_context():
+        return None
+    if 'identity_map' not in g:
+        g.identity_map = {}
+    return g.identity_map
+
+
+def _referenced_class(field, ref):
+    return get_document(ref.cls) if hasattr(ref, 'cls') else field.document_type
+
+
+def _count_lazy_load(owner, field):
+    if not has_app_context():
+        return
+    if 'lazy_loads' not in g:
+        g.lazy_loads = {}
+    key = f'{type(owner).__name__}.{field.name}'
+    g.lazy_loads[key] = count = g.lazy_loads.get(key, 0) + 1
+    limit = current_app.config.get('REFERENCE_LAZY_LOAD_LIMIT', DEFAULT_LAZY_LOAD_LIMIT)
+    if count != limit + 1:
+        return
+    message = f'{key} dereferenced one by one more than {limit} times; use references.resolve()'
+    # Fails the request in debug/testing, so N+1 patterns are caught early
+    if current_app.debug or current_app.testing:
+        raise NPlusOneError(message)
+    logger.warning(message)
+
+
+class ReferenceField(db.ReferenceField):
+    # ReferenceField whose lazy dereferences go through the request's
+    # identity map and are counted by the N+1 guard
+    def __get__(self, instance, owner):
+        if instance is not None:
+            ref = instance._data.get(self.name)
+            if isinstance(ref, DBRef) and instance._fields[self.name]._auto_dereference:
+                documents = _identity_map()
+                key = (ref.collection, ref.id)
+                if documents is not None and key in documents:
+                    instance._data[self.name] = documents[key]
+                else:
+                    _count_lazy_load(instance, self)
+                    value = super().__get__(instance, owner)
+                    if documents is not None:
+                        documents[key] = value
+                    return value
+        return super().__get__(instance, owner)
+
+
+def resolve(documents, *fields):
+    # Fills in the given reference fields of a list of documents with one $in
+    # query per referenced collection, skipping documents already loaded in
+    # this request. Returns the documents as a list.
+    documents = list(documents)
+    loaded = _identity_map()
+    if loaded is None:
+        loaded = {}
+    for name in fields:
+        wanted = {}
+        for document in documents:
+            ref = document._data.get(name)
+            if isinstance(ref, DBRef) and (ref.collection, ref.id) not in loaded:
+                cls = _referenced_class(document._fields[name], ref)
+                wanted.setdefault(cls, set()).add(ref.id)
+        for cls, ids in wanted.items():
+            for son in cls._get_collection().find({'_id': {'$in': list(ids)}}):
+                loaded[(cls._get_collection_name(), son['_id'])] = cls._from_son(son)
+        for document in documents:
+            ref = document._data.get(name)
+            if isinstance(ref, DBRef) and (ref.collection, ref.id) in loaded:
+                document._data[name] = loaded[(ref.collection, ref.id)]
+    return documents
+
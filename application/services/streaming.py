@@ -0,0 +1,59 @@
+import logging
+from flask import (before_render_template, current_app, get_flashed_messages, render_template,
+                   stream_with_context, template_rendered)
+from application.services import metrics
+
+logger = logging.getLogger(__name__)
+
+# Template output pieces joined into one chunk of a streamed response; each
+# chunk is one write to the socket
+STREAM_BUFFER = 64
+
+
+def stream_template(template_name, **context):
+    # Renders a template as the browser receives it: the top of the page is
+    # sent before the rows below it are read. Flask 2.0 has no
+    # stream_template, so this is its equivalent. Falls back to
+    # render_template when STREAM_TEMPLATES is off.
+    app = current_app._get_current_object()
+    if not app.config['STREAM_TEMPLATES']:
+        return render_template(template_name, **context)
+    # The session is saved before the body is sent: take pending flash
+    # messages out of it now (the template still gets them for this request)
+    get_flashed_messages()
+    app.update_template_context(context)
+    template = app.jinja_env.get_template(template_name)
+    # The signals render_template sends; template_rendered once the last
+    # chunk has been rendered
+    before_render_template.send(app, template=template, context=context)
+    stream = template.stream(context)
+    stream.enable_buffering(STREAM_BUFFER)
+
+    # The first chunk is rendered before the response starts. If that fails,
+    # the page is rendered whole instead, so an error still gets an error
+    # page rather than a 200 that stops short.
+    try:
+        with metrics.rendering_chunk():
+            first = next(stream, '')
+    except Exception:
+        logger.warning('Streaming %s failed before the first chunk; rendering it whole', template_name,
+                       exc_info=True)
+        return render_template(template_name, **context)
+
+    def chunks():
+        yield first
+        while True:
+            try:
+                with metrics.rendering_chunk():
+                    chunk = next(stream, None)
+            except Exception:
+                # The status line is gone: all that is left is to log it and
+                # drop the connection, so the browser sees an incomplete page
+                logger.exception('Streaming %s failed after the first chunk', template_name)
+                raise
+            if chunk is None:
+                break
+            yield chunk
+        template_rendered.send(app, template=template, context=context)
+
+    return app.response_class(stream_with_context(chunks()), mimetype='text/html')
@@ -0,0 +1,171 @@
+import csv
+import io
+from datetime import datetime
+from mongoengine.errors import ValidationError
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+from application.models import Student
+from application.services import audit, balances, dashboard, versions
+
+DEFAULT_BATCH_SIZE = 500
+
+# Row errors kept in the report; further errors are only counted so a bad
+# file cannot make the report grow without bound
+MAX_REPORTED_ERRORS = 1000
+
+COLUMNS = ('name', 'roll_number', 'class_name', 'section', 'contact',
+           'economic_status', 'hostel_food_opted', 'milk_opted')
+ECONOMIC_STATUSES = ('Normal', 'Poor')
+TRUE_VALUES = ('1', 'y', 'yes', 'true', 'on')
+
+
+def _header_key(value):
+    return str(value or '').strip().lower().replace(' ', '_')
+
+
+def iter_csv_rows(stream):
+    # Yields (line number, row dict) without reading the whole file
+    text = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='')
+    reader = csv.reader(text)
+    header = [_header_key(h) for h in next(reader, [])]
+    for row in reader:
+        if any(cell.strip() for cell in row):
+            yield reader.line_num, dict(zip(header, row))
+
+
+def iter_xlsx_rows(stream):
+    # XLSX support is optional and needs openpyxl; read_only mode streams rows
+    try:
+        from openpyxl import load_workbook
+    except ImportError:
+        raise ValueError('XLSX import requires openpyxl (pip install openpyxl)')
+    workbook = load_workbook(stream, read_only=True, data_only=True)
+    try:
+        rows = workbook.active.iter_rows(values_only=True)
+        header = [_header_key(h) for h in next(rows, [])]
+        for line, row in enumerate(rows, start=2):
+            if any(cell not in (None, '') for cell in row):
+                yield line, dict(zip(header, ('' if cell is None else str(cell) for cell in row)))
+    finally:
+        workbook.close()
+
+
+def parse_row(row):
+    # Returns the Student fields of a row, or raises ValueError
+    missing = [column for column in COLUMNS[:6] if not str(row.get(column) or '').strip()]
+    if missing:
+        raise ValueError(f"missing {', '.join(missing)}")
+    fields = {column: str(row[column]).strip() for column in COLUMNS[:6]}
+    # Spreadsheets turn "5" into "5.0"
+    if fields['class_name'].endswith('.0'):
+        fields['class_name'] = fields['class_name'][:-2]
+    if fields['economic_status'].capitalize() not in ECONOMIC_STATUSES:
+        raise ValueError(f"economic_status must be one of {', '.join(ECONOMIC_STATUSES)}")
+    fields['economic_status'] = fields['economic_status'].capitalize()
+    for column in COLUMNS[6:]:
+        fields[column] = str(row.get(column) or '').strip().lower() in TRUE_VALUES
+    try:
+        Student(**fields).validate()
+    except ValidationError as e:
+        raise ValueError('; '.join(f'{field}: {error}' for field, error in e.to_dict().items()))
+    return fields
+
+
+class ImportReport:
+    def __init__(self):
+        self.inserted = 0
+        self.updated = 0
+        self.error_count = 0
+        self.errors = []
+
+    def add_error(self, line, roll_number, message):
+        self.error_count += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append((line, roll_number, message))
+
+
+def _write_batch(batch, report):
+    # batch is a list of (line, fields); one $in prefetch, one bulk_write
+    collection = Student._get_collection()
+    rolls = [fields['roll_number'] for _, fields in batch]
+    existing = {
+        doc['roll_number']: doc for doc in collection.find(
+            {'roll_number': {'$in': rolls}},
+            {'roll_number': 1, 'class_name': 1, 'hostel_food_opted': 1, 'economic_status': 1}
+        )
+    }
+
+    now = datetime.utcnow()
+    operations = [
+        UpdateOne(
+            {'roll_number': fields['roll_number']},
+            {'$set': dict(fields, updated_at=now), '$setOnInsert': {'created_at': now}},
+            upsert=True
+        )
+        for _, fields in batch
+    ]
+    failed = set()
+    try:
+        collection.bulk_write(operations, ordered=False)
+    except BulkWriteError as e:
+        for error in e.details['writeErrors']:
+            failed.add(error['index'])
+            line, fields = batch[error['index']]
+            report.add_error(line, fields['roll_number'], error.get('errmsg', 'write failed'))
+
+    changes = []
+    updated = []
+    for i, (_, fields) in enumerate(batch):
+        if i in failed:
+            continue
+        old = existing.get(fields['roll_number'])
+        if old:
+            report.updated += 1
+            updated.append(dict(fields, _id=old['_id']))
+        else:
+            report.inserted += 1
+        changes.append((old, fields))
+    dashboard.students_changed(changes)
+    # Only existing students can have a balance
+    balances.students_changed(updated)
+    versions.bump(versions.STUDENTS)
+
+
+def import_students(rows, admin, batch_size=DEFAULT_BATCH_SIZE):
+    # rows is an iterator of (line, row dict), see iter_csv_rows/iter_xlsx_rows.
+    # Valid rows are upserted on roll_number in batches of batch_size.
+    report = ImportReport()
+    batch = []
+    batch_lines = {}
+    for line, row in rows:
+        try:
+            fields = parse_row(row)
+        except ValueError as e:
+            report.add_error(line, row.get('roll_number'), str(e))
+            continue
+        roll_number = fields['roll_number']
+        if roll_number in batch_lines:
+            report.add_error(line, roll_number, f'duplicate of line {batch_lines[roll_number]}')
+            continue
+        batch_lines[roll_number] = line
+        batch.append((line, fields))
+        if len(batch) >= batch_size:
+            _write_batch(batch, report)
+            batch = []
+            batch_lines = {}
+    if batch:
+        _write_batch(batch, report)
+
+    audit.record(
+        admin, 'IMPORT_STUDENTS',
+        entity_type='student',
+        details=f'Imported students: {report.inserted} created, {report.updated} updated, '
+                f'{report.error_count} row(s) rejected'
+    )
+    return report
+
+
+def rows_from_file(stream, filename):
+    if filename.lower().endswith('.xlsx'):
+        return iter_xlsx_rows(stream)
+    return iter_csv_rows(stream)
@@ -0,0 +1,43 @@
+from collections import namedtuple
+from application.models import Student
+
+# Documents fetched per cursor batch while the list streams
+BATCH_SIZE = 500
+
+# The fields student/list.html shows, as lightweight rows instead of Student
+# documents
+StudentRow = namedtuple('StudentRow', ['id', 'roll_number', 'name', 'class_name', 'section', 'contact',
+                                       'economic_status', 'hostel_food_opted', 'milk_opted'])
+PROJECTION = {field: 1 for field in StudentRow._fields if field != 'id'}
+
+
+class StudentRows:
+    # The matching students as StudentRows, read from a projected cursor so
+    # only one batch is held in memory while the page renders. Each iteration
+    # runs the query again, so a page rendered a second time (see
+    # streaming.stream_template) gets every row.
+    def __init__(self, query, batch_size=BATCH_SIZE):
+        self._query = query
+        self._batch_size = batch_size
+
+    def __iter__(self):
+        for doc in Student._get_collection().find(self._query, PROJECTION, batch_size=self._batch_size):
+            yield StudentRow(
+                str(doc['_id']), doc.get('roll_number'), doc.get('name'), doc.get('class_name'),
+                doc.get('section'), doc.get('contact'), doc.get('economic_status'),
+                doc.get('hostel_food_opted', False), doc.get('milk_opted', False),
+            )
+
+
+def student_rows(class_name=None, hostel_food_opted=None, milk_opted=None, economic_status=None,
+                 batch_size=BATCH_SIZE):
+    query = {}
+    if class_name:
+        query['class_name'] = class_name
+    if hostel_food_opted is not None:
+        query['hostel_food_opted'] = hostel_food_opted
+    if milk_opted is not None:
+        query['milk_opted'] = milk_opted
+    if economic_status:
+        query['economic_status'] = economic_status
+    return StudentRows(query, batch_size)
@@ -0,0 +1,86 @@
+import hashlib
+import os
+from datetime import date, datetime
+from functools import wraps
+from flask import current_app, make_response, request, session
+from flask_login import current_user
+from application.models import Counter
+
+# Change counters of the collections list pages and fee JSON are built
+# from, kept in the counters collection. Every write path bumps the
+# counters of what it changed, so a page's version is one _id lookup
+# instead of a scan.
+STUDENTS = 'version:students'
+FEES = 'version:fees'
+
+_template_stamp = None
+
+
+def bump(*counters):
+    # Call after a write
+    now = datetime.utcnow()
+    for counter in counters:
+        Counter._get_collection().update_one(
+            {'_id': counter}, {'$inc': {'value': 1}, '$set': {'updated_at': now}}, upsert=True)
+
+
+def current(*counters):
+    # {counter: (value, updated_at)}; counters never bumped are at (0, None)
+    stamps = dict.fromkeys(counters, (0, None))
+    for doc in Counter._get_collection().find({'_id': {'$in': list(counters)}}):
+        stamps[doc['_id']] = (doc.get('value', 0), doc.get('updated_at'))
+    return stamps
+
+
+def _templates():
+    # Changes when a deploy changes a template, so pages cached by browsers
+    # are not served with the old layout; the same in every worker
+    global _template_stamp
+    if _template_stamp is None:
+        digest = hashlib.sha1()
+        for root, _, files in sorted(os.walk(os.path.join(current_app.root_path, current_app.template_folder))):
+            for name in sorted(files):
+                stat = os.stat(os.path.join(root, name))
+                digest.update(f'{name}:{stat.st_size}:{stat.st_mtime_ns};'.encode())
+        _template_stamp = digest.hexdigest()
+    return _template_stamp
+
+
+def versioned(*counters):
+    # Conditional GET for a view built only from the given counters'
+    # collections: answers 304 Not Modified when none changed since the
+    # browser's copy. The ETag also covers the URL, the admin, today's date
+    # (pages default to the current month) and the templates; it is weak, so
+    # it holds when the response is compressed.
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            # Pending flash messages are shown, and consumed, by rendering
+            if session.get('_flashes'):
+                return view(*args, **kwargs)
+            # Read before rendering: a write during rendering makes the next
+            # request miss rather than serve a stale page
+            stamps = current(*counters)
+            key = [request.full_path, current_user.get_id(), date.today().isoformat(), _templates()]
+            key += [f'{counter}={value}' for counter, (value, _) in sorted(stamps.items())]
+            etag = hashlib.sha1('|'.join(map(str, key)).encode()).hexdigest()
+            modified = [updated_at for _, updated_at in stamps.values() if updated_at]
+            last_modified = max(modified) if modified else None
+
+            # If-Modified-Since is not enough on its own: the page also depends
+            # on the URL and the admin, and dates have one second resolution
+            if request.if_none_match.contains_weak(etag):
+                response = current_app.response_class(status=304)
+            else:
+                response = make_response(view(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+            response.set_etag(etag, weak=True)
+            if last_modified:
+                response.last_modified = last_modified
+            # Always revalidated, never shared
+            response.cache_control.private = True
+            response.cache_control.no_cache = True
+            return response
+        return wrapper
+    return decorator
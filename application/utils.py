@@ -1,16 +1,17 @@
 from io import BytesIO
-from reportlab.pdfgen import canvas
-from reportlab.lib.pagesizes import letter
+from application.services.money import format_rupees
+from application.services.metrics import rendering_pdf
 
-def generate_receipt_pdf(payment, student, fee, admin):
-    # Create PDF
-    buffer = BytesIO()
-    p = canvas.Canvas(buffer, pagesize=letter)
-    
+# Bump whenever the receipt layout below changes: cached receipts are keyed
+# by this version, so every receipt is re-rendered with the new layout.
+RECEIPT_TEMPLATE_VERSION = 2
+
+def draw_receipt(p, payment, student, fee, admin, balance):
+    # Draws one receipt page on canvas p
     # School header
     p.setFont("Helvetica-Bold", 18)
     p.drawCentredString(300, 750, "School Fee Receipt")
-    
+
     # Student details
     p.setFont("Helvetica", 12)
     p.drawString(50, 700, f"Receipt No: {payment.receipt_number}")
@@ -18,28 +19,82 @@ def generate_receipt_pdf(payment, student, fee, admin):
     p.drawString(50, 660, f"Student Name: {student.name}")
     p.drawString(50, 640, f"Roll Number: {student.roll_number}")
     p.drawString(50, 620, f"Class: {student.class_name}")
-    
+
     # Fee details
     p.drawString(50, 580, "Fee Details:")
-    p.drawString(70, 560, f"Base Fee: ₹{fee.base_fee}")
+    p.drawString(70, 560, f"Base Fee: ₹{format_rupees(fee.base_fee)}")
     if fee.hostel_food_fee:
-        p.drawString(70, 540, f"Hostel+Food Fee: ₹{fee.hostel_food_fee}")
+        p.drawString(70, 540, f"Hostel+Food Fee: ₹{format_rupees(fee.hostel_food_fee)}")
     if fee.milk_fee:
-        p.drawString(70, 520, f"Milk Fee: ₹{fee.milk_fee}")
+        p.drawString(70, 520, f"Milk Fee: ₹{format_rupees(fee.milk_fee)}")
     if fee.discount:
-        p.drawString(70, 500, f"Discount: ₹{fee.discount}")
-    p.drawString(50, 460, f"Total Fee: ₹{fee.total_fee}")
-    p.drawString(50, 440, f"Amount Paid: ₹{payment.amount}")
-    p.drawString(50, 420, f"Balance: ₹{fee.total_fee - fee.paid_amount}")
+        p.drawString(70, 500, f"Discount: ₹{format_rupees(fee.discount)}")
+    p.drawString(50, 460, f"Total Fee: ₹{format_rupees(fee.total_fee)}")
+    p.drawString(50, 440, f"Amount Paid: ₹{format_rupees(payment.amount)}")
+    p.drawString(50, 420, f"Balance: ₹{format_rupees(balance)}")
     p.drawString(50, 400, f"Payment Method: {payment.payment_method.upper()}")
     if payment.transaction_id:
         p.drawString(50, 380, f"Transaction ID: {payment.transaction_id}")
-    
+
     # Signature
     p.drawString(50, 320, "Received by:")
     p.drawString(50, 300, admin.username)
-    
+
+    p.showPage()
+
+def draw_statement(p, student, fee, payments):
+    # Draws one monthly fee statement page: the fee and every payment on it
+    p.setFont("Helvetica-Bold", 18)
+    p.drawCentredString(300, 750, "Monthly Fee Statement")
+
+    p.setFont("Helvetica", 12)
+    p.drawString(50, 700, f"Period: {fee.month}/{fee.year}")
+    p.drawString(50, 680, f"Student Name: {student.name}")
+    p.drawString(50, 660, f"Roll Number: {student.roll_number}")
+    p.drawString(50, 640, f"Class: {student.class_name} {student.section}")
+
+    p.drawString(50, 600, "Fee Details:")
+    p.drawString(70, 580, f"Base Fee: ₹{format_rupees(fee.base_fee)}")
+    p.drawString(70, 560, f"Hostel+Food Fee: ₹{format_rupees(fee.hostel_food_fee)}")
+    p.drawString(70, 540, f"Milk Fee: ₹{format_rupees(fee.milk_fee)}")
+    p.drawString(70, 520, f"Discount: ₹{format_rupees(fee.discount)}")
+    p.drawString(50, 500, f"Total Fee: ₹{format_rupees(fee.total_fee)}")
+
+    y = 460
+    p.drawString(50, y, "Payments:")
+    for payment in payments:
+        y -= 20
+        if y < 100:
+            p.drawString(70, y, "...")
+            break
+        p.drawString(70, y, f"{payment.payment_date.strftime('%d-%m-%Y')}  {payment.receipt_number}  "
+                            f"₹{format_rupees(payment.amount)}  {payment.payment_method.upper()}")
+    if not payments:
+        p.drawString(70, y - 20, "None")
+        y -= 20
+
+    p.drawString(50, y - 40, f"Amount Paid: ₹{format_rupees(fee.paid_amount)}")
+    p.drawString(50, y - 60, f"Balance: ₹{format_rupees(fee.total_fee - fee.paid_amount)}")
+
     p.showPage()
-    p.save()
-    
-    return buffer
\ No newline at end of file
+
+def new_canvas(buffer):
+    # reportlab is imported on the first PDF rather than at startup
+    from reportlab.pdfgen import canvas
+    from reportlab.lib.pagesizes import letter
+    return canvas.Canvas(buffer, pagesize=letter)
+
+def generate_receipt_pdf(payment, student, fee, admin, balance=None):
+    # balance is what was left to pay on the fee right after this payment;
+    # defaults to the fee's current balance
+    if balance is None:
+        balance = fee.total_fee - fee.paid_amount
+
+    # Create PDF; the time counts towards the request's PDF time
+    buffer = BytesIO()
+    with rendering_pdf():
+        p = new_canvas(buffer)
+        draw_receipt(p, payment, student, fee, admin, balance)
+        p.save()
+
+    return buffer
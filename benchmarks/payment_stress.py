@@ -0,0 +1,118 @@
+"""Concurrent payment stress test.
+
+Hammers one fee with payments from many threads in several processes and
+checks the invariants of application.services.payments.apply_payment:
+
+- paid_amount equals the sum of the applied payments and never exceeds total_fee
+- every applied payment is listed exactly once in the fee's applied_payments
+- no payment is left pending
+
+Run it against a scratch database; it creates and removes its own records:
+
+    MONGO_URI=mongodb://localhost:27017/school_fee_bench python benchmarks/payment_stress.py
+"""
+import argparse
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+from multiprocessing import Process
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from application import create_app  # noqa: E402
+from application.models import Admin, Student, Fee, PaymentHistory  # noqa: E402
+from application.services.bootstrap import create_default_admin  # noqa: E402
+from application.services.payments import apply_payment, PaymentError  # noqa: E402
+from application.services.money import format_rupees, to_paise  # noqa: E402
+
+
+def pay(fee_id, admin_id, payments, results):
+    fee = Fee.objects.get(pk=fee_id)
+    student_id = fee.to_mongo()['student']
+    for _ in range(payments):
+        payment = PaymentHistory(
+            student=student_id, fee=fee, amount=random.randint(100, 5000),
+            receipt_number=f'STRESS{uuid.uuid4().hex[:14]}', created_by=admin_id,
+        )
+        try:
+            apply_payment(payment)
+            results['applied'] += 1
+        except PaymentError:
+            results['rejected'] += 1
+
+
+def run_process(fee_id, admin_id, threads, payments):
+    app = create_app()
+    with app.app_context():
+        results = {'applied': 0, 'rejected': 0}
+        workers = [threading.Thread(target=pay, args=(fee_id, admin_id, payments, results))
+                   for _ in range(threads)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--processes', type=int, default=4)
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--payments', type=int, default=50, help='payments per thread')
+    parser.add_argument('--total-fee', type=float, default=20000.0, help='in rupees')
+    args = parser.parse_args()
+
+    app = create_app()
+    with app.app_context():
+        admin = Admin.objects.first() or create_default_admin()
+        student = Student(name='Stress Test', roll_number=f'STRESS{uuid.uuid4().hex[:12]}',
+                          class_name='1', section='A', contact='0', economic_status='Normal').save()
+        fee = Fee(student=student, month='1', year='1900', base_fee=to_paise(args.total_fee),
+                  total_fee=to_paise(args.total_fee)).save()
+
+    attempts = args.processes * args.threads * args.payments
+    started = time.perf_counter()
+    processes = [Process(target=run_process, args=(str(fee.id), str(admin.id), args.threads, args.payments))
+                 for _ in range(args.processes)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    elapsed = time.perf_counter() - started
+
+    with app.app_context():
+        fee.reload()
+        applied = list(PaymentHistory.objects(fee=fee, status='applied'))
+        pending = PaymentHistory.objects(fee=fee, status='pending').count()
+        applied_ids = [str(pid) for pid in fee.applied_payments]
+        paid = sum(payment.amount for payment in applied)
+
+        failures = []
+        if fee.paid_amount != paid:
+            failures.append(f'paid_amount {fee.paid_amount} != sum of payments {paid}')
+        if fee.paid_amount > fee.total_fee:
+            failures.append(f'overpaid: {fee.paid_amount} > {fee.total_fee}')
+        if sorted(applied_ids) != sorted(str(payment.id) for payment in applied):
+            failures.append('applied_payments does not match the applied payments')
+        if len(set(applied_ids)) != len(applied_ids):
+            failures.append('a payment was applied twice')
+        if pending:
+            failures.append(f'{pending} payment(s) left pending')
+
+        print(f'{attempts} attempts, {len(applied)} applied in {elapsed:.2f}s '
+              f'({attempts / elapsed:.0f} attempts/s), paid {format_rupees(fee.paid_amount)} of {format_rupees(fee.total_fee)}')
+
+        PaymentHistory.objects(fee=fee).delete()
+        fee.delete()
+        student.delete()
+
+    for failure in failures:
+        print(f'FAIL: {failure}')
+    print('FAILED' if failures else 'OK: invariants hold')
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+"""Receipt number allocator benchmark.
+
+Allocates receipt numbers from many threads in several processes, in two
+rounds of fresh processes (a restart), and checks that no number was handed
+out twice. Reports receipts per second.
+
+Run it against a scratch database; it removes its counter afterwards:
+
+    MONGO_URI=mongodb://localhost:27017/school_fee_bench python benchmarks/receipt_numbers.py
+"""
+import argparse
+import os
+import sys
+import threading
+import time
+import uuid
+from multiprocessing import Pool
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from application import create_app  # noqa: E402
+from application.models import Counter  # noqa: E402
+from application.services.receipt_numbers import next_receipt_number  # noqa: E402
+
+
+def allocate(series, threads, count):
+    app = create_app()
+    numbers = []
+    lock = threading.Lock()
+
+    def run():
+        with app.app_context():
+            local = [next_receipt_number(series) for _ in range(count)]
+        with lock:
+            numbers.extend(local)
+
+    workers = [threading.Thread(target=run) for _ in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return numbers
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--processes', type=int, default=8)
+    parser.add_argument('--threads', type=int, default=4)
+    parser.add_argument('--receipts', type=int, default=2000, help='receipts per thread and round')
+    parser.add_argument('--rounds', type=int, default=2)
+    args = parser.parse_args()
+
+    series = f'BENCH{uuid.uuid4().hex[:6]}'
+    numbers = []
+    started = time.perf_counter()
+    for _ in range(args.rounds):
+        with Pool(args.processes) as pool:
+            for result in pool.starmap(allocate, [(series, args.threads, args.receipts)] * args.processes):
+                numbers.extend(result)
+    elapsed = time.perf_counter() - started
+
+    duplicates = len(numbers) - len(set(numbers))
+    print(f'{len(numbers)} receipt numbers in {elapsed:.2f}s ({len(numbers) / elapsed:.0f}/s), '
+          f'{duplicates} duplicate(s)')
+
+    with create_app().app_context():
+        Counter.objects(name=f'receipt:{series}').delete()
+
+    print('FAILED' if duplicates else 'OK: no collisions')
+    sys.exit(1 if duplicates else 0)
+
+
+if __name__ == '__main__':
+    main()
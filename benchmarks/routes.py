@@ -0,0 +1,326 @@
+"""Route benchmark suite.
+
+Requests every blueprint route (and renders receipts with
+generate_receipt_pdf directly) through the Flask test client, logged in as an
+admin (the login page as a visitor who is not). Reports latency percentiles
+and the MongoDB round trips each request makes, and compares them with a
+saved baseline. Routes that need a file upload or destroy data (logging in
+and out, student add/delete and import, adding a fee) are not covered. The
+analytics cache is turned off, so the analytics routes time the rollup
+queries.
+
+Against a database seeded with benchmarks/seed.py:
+
+    MONGO_URI=mongodb://localhost:27017/school_fee_bench python benchmarks/routes.py --save
+
+or in memory, seeding a fresh school every run (needs `pip install mongomock`;
+routes whose queries mongomock cannot run, listed in MONGOMOCK_UNSUPPORTED,
+are reported as skipped):
+
+    python benchmarks/routes.py --mongomock --students 300
+
+--save writes the results to the baseline file; later runs compare against
+it and exit with status 1 when a route got slower than --tolerance allows or
+makes more round trips.
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+
+# Slowdowns below this many milliseconds are noise, whatever the ratio
+NOISE_FLOOR_MS = 1.0
+
+# Cases requested without logging in: logged in, /login only redirects
+ANONYMOUS = ('auth.login',)
+
+# Routes mongomock cannot serve, by case name prefix, and why
+MONGOMOCK_UNSUPPORTED = {
+    'fee.manage_fees': '$lookup with let',
+}
+
+
+class RoundTrips:
+    # Counts MongoDB operations issued from the benchmarking thread, so
+    # background jobs do not show up in a request's count
+    def __init__(self):
+        self.count = 0
+        self._thread = threading.get_ident()
+
+    def hit(self):
+        if threading.get_ident() == self._thread:
+            self.count += 1
+
+    def install(self, mongomock=False):
+        # Before the application is imported: clients created after this
+        # report to the listener
+        if mongomock:
+            self._wrap_mongomock()
+            return
+        from pymongo import monitoring
+
+        counter = self
+
+        class Listener(monitoring.CommandListener):
+            def started(self, event):
+                counter.hit()
+
+            def succeeded(self, event):
+                pass
+
+            def failed(self, event):
+                pass
+
+        monitoring.register(Listener())
+
+    def _wrap_mongomock(self):
+        # mongomock has no command monitoring; count collection calls instead
+        from mongomock.collection import Collection
+
+        def counted(method):
+            def wrapper(*args, **kwargs):
+                self.hit()
+                return method(*args, **kwargs)
+            return wrapper
+
+        for name in ('find', 'find_one', 'insert_one', 'insert_many', 'update_one', 'update_many',
+                     'replace_one', 'delete_one', 'delete_many', 'aggregate', 'bulk_write',
+                     'count_documents', 'distinct', 'find_one_and_update', 'find_one_and_replace',
+                     'find_one_and_delete'):
+            setattr(Collection, name, counted(getattr(Collection, name)))
+
+
+def percentile(values, q):
+    # Nearest-rank percentile of a non-empty list
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, int(round(q / 100 * len(ordered) + 0.5)) - 1))]
+
+
+def build_cases(app):
+    # (name, method, path, request kwargs) of every route, with ids taken
+    # from the seeded data
+    from application.models import Student, Fee, PaymentHistory
+    from application.services.money import format_rupees
+
+    now = datetime.now()
+    month, year = str(now.month), str(now.year)
+    with app.app_context():
+        student = Student.objects.order_by('roll_number').first()
+        if student is None:
+            raise SystemExit('no students; seed the database with benchmarks/seed.py or use --mongomock')
+        fee = Fee.objects(student=student).order_by('-year', '-month').first()
+        # A fee with room for every benchmark payment of one rupee
+        open_fee = Fee.objects(__raw__={'$expr': {'$gte': [
+            {'$subtract': ['$total_fee', '$paid_amount']}, 100000]}}).first()
+        payment = PaymentHistory.objects.order_by('-payment_date').first()
+        payment_ids = [str(p.id) for p in PaymentHistory.objects.order_by('-payment_date').only('id').limit(5)]
+        student_ids = [str(s.id) for s in Student.objects.only('id').limit(100)]
+        fee_form = {'month': fee.month, 'year': fee.year, 'base_fee': format_rupees(fee.base_fee),
+                    'hostel_food_fee': format_rupees(fee.hostel_food_fee),
+                    'milk_fee': format_rupees(fee.milk_fee), 'discount': format_rupees(fee.discount)}
+        class_name = student.class_name
+
+    cases = [
+        ('auth.login', 'GET', '/login', {}),
+        ('admin.dashboard', 'GET', '/dashboard', {}),
+        ('admin.collection_analytics', 'GET', '/analytics/collections', {}),
+        ('admin.collection_analytics by class', 'GET', '/analytics/collections?interval=month&by=class_name', {}),
+        ('student.list_students', 'GET', '/student/', {}),
+        ('student.list_students class', 'GET', f'/student/?class={class_name}', {}),
+        ('student.add_student form', 'GET', '/student/add', {}),
+        ('student.edit_student form', 'GET', f'/student/edit/{student.id}', {}),
+        ('student.import_students_file form', 'GET', '/student/import', {}),
+        ('fee.manage_fees', 'GET', f'/fee/?month={month}&year={year}', {}),
+        ('fee.manage_fees pending', 'GET', f'/fee/?month={month}&year={year}&status=pending', {}),
+        ('fee.manage_fees class', 'GET', f'/fee/?month={month}&year={year}&class={class_name}', {}),
+        ('fee.defaulters', 'GET', '/fee/defaulters', {}),
+        ('fee.calculate_fee', 'GET', f'/fee/calculate/{student.id}', {}),
+        ('fee.quote_fees', 'POST', '/fee/quotes', {'json': {'student_ids': student_ids, 'year': year}}),
+        ('fee.get_fee', 'GET', f'/fee/get/{fee.id}', {}),
+        ('fee.edit_fee', 'POST', f'/fee/edit/{fee.id}', {'data': fee_form}),
+        ('fee.generate_fees existing', 'POST', '/fee/generate',
+         {'data': {'month': month, 'year': year, 'class': class_name}}),
+        ('export.index', 'GET', '/export/', {}),
+        ('export.fee_ledger', 'GET', f'/export/fees?year={year}&month={month}', {}),
+        ('export.payment_history', 'GET',
+         f"/export/payments?from={now.strftime('%Y-%m-01')}&to={now.strftime('%Y-%m-%d')}", {}),
+    ]
+    if payment is not None:
+        cases += [
+            ('fee.generate_receipt', 'GET', f'/fee/receipt/{payment.id}', {}),
+            ('fee.receipt_status', 'GET', f'/fee/receipt/{payment.id}/status', {}),
+            ('export.documents', 'GET', f"/export/documents?ids={','.join(payment_ids)}&output=pdf", {}),
+        ]
+    if open_fee is not None:
+        cases.append(('fee.add_payment', 'POST', f'/fee/payment/{open_fee.id}',
+                      {'data': {'amount': '1', 'payment_method': 'cash'},
+                       'headers': {'X-Requested-With': 'XMLHttpRequest'}}))
+    return cases
+
+
+def run_case(client, counter, method, path, options, requests, warmup):
+    # Returns (latencies in ms, round trips per request, error or None)
+    latencies, round_trips = [], []
+    for i in range(warmup + requests):
+        counter.count = 0
+        started = time.perf_counter()
+        try:
+            response = client.open(path, method=method, **options)
+            # A streamed page raises here rather than in open()
+            response.get_data()
+        except Exception as e:
+            # e.g. a query mongomock does not implement
+            return latencies, round_trips, f'{type(e).__name__}: {e}'[:80]
+        elapsed = (time.perf_counter() - started) * 1000
+        response.close()
+        if response.status_code >= 400:
+            return latencies, round_trips, f'HTTP {response.status_code}'
+        if i >= warmup:
+            latencies.append(elapsed)
+            round_trips.append(counter.count)
+    return latencies, round_trips, None
+
+
+def run_receipt_pdf(app, counter, requests, warmup):
+    # generate_receipt_pdf on its own: the layout cost of one receipt
+    from application.models import PaymentHistory
+    from application.services.references import resolve
+    from application.utils import generate_receipt_pdf
+
+    with app.app_context():
+        payment = PaymentHistory.objects.order_by('-payment_date').first()
+        if payment is None:
+            return [], [], 'no payments'
+        resolve([payment], 'student', 'fee', 'created_by')
+        latencies, round_trips = [], []
+        for i in range(warmup + requests):
+            counter.count = 0
+            started = time.perf_counter()
+            generate_receipt_pdf(payment, payment.student, payment.fee, payment.created_by, balance=0)
+            elapsed = (time.perf_counter() - started) * 1000
+            if i >= warmup:
+                latencies.append(elapsed)
+                round_trips.append(counter.count)
+    return latencies, round_trips, None
+
+
+def summarize(latencies, round_trips):
+    return {
+        'requests': len(latencies),
+        'p50_ms': round(percentile(latencies, 50), 3),
+        'p90_ms': round(percentile(latencies, 90), 3),
+        'p99_ms': round(percentile(latencies, 99), 3),
+        'round_trips': percentile(round_trips, 50),
+    }
+
+
+def compare(result, baseline, tolerance):
+    # Returns (note, regressed)
+    if baseline is None:
+        return 'new', False
+    notes = []
+    regressed = False
+    change = result['p50_ms'] / baseline['p50_ms'] - 1 if baseline['p50_ms'] else 0.0
+    notes.append(f'p50 {change:+.0%}')
+    if change > tolerance and result['p50_ms'] - baseline['p50_ms'] > NOISE_FLOOR_MS:
+        regressed = True
+    if result['round_trips'] != baseline['round_trips']:
+        notes.append(f"round trips {baseline['round_trips']} -> {result['round_trips']}")
+        regressed = regressed or result['round_trips'] > baseline['round_trips']
+    return ', '.join(notes) + (' REGRESSED' if regressed else ''), regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--requests', type=int, default=30, help='measured requests per route')
+    parser.add_argument('--warmup', type=int, default=3, help='unmeasured requests per route first')
+    parser.add_argument('--only', help='only routes whose name contains this')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE, help='baseline JSON file')
+    parser.add_argument('--save', action='store_true', help='save the results as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='allowed p50 slowdown against the baseline, as a fraction')
+    parser.add_argument('--username', default='admin')
+    parser.add_argument('--password', default='admin123')
+    parser.add_argument('--mongomock', action='store_true', help='use an in-memory database, seeded each run')
+    parser.add_argument('--students', type=int, default=300, help='students seeded with --mongomock')
+    parser.add_argument('--years', type=int, default=1, help='years of fees seeded with --mongomock')
+    args = parser.parse_args()
+
+    counter = RoundTrips()
+    if args.mongomock:
+        from seed import use_mongomock
+        use_mongomock()
+    counter.install(mongomock=args.mongomock)
+    os.environ.setdefault('RECEIPT_CACHE_DIR', tempfile.mkdtemp(prefix='receipts-bench-'))
+    # Every analytics request computes its series rather than hitting the
+    # per-process cache
+    os.environ['ANALYTICS_CACHE_TTL'] = '0'
+
+    from application import create_app
+    app = create_app()
+    if not app.config.get('SECRET_KEY'):
+        app.config['SECRET_KEY'] = os.urandom(16)
+
+    if args.mongomock:
+        from seed import seed_school
+        with app.app_context():
+            seed_school(args.students, args.years, progress=lambda message: None)
+
+    client = app.test_client()
+    anonymous = app.test_client()
+    response = client.post('/login', data={'username': args.username, 'password': args.password})
+    if response.status_code != 302:
+        raise SystemExit(f'could not log in as {args.username}')
+
+    cases = build_cases(app)
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f).get('cases', {})
+
+    results = {}
+    regressions = 0
+    print(f"{'route':<42} {'n':>4} {'p50 ms':>9} {'p90 ms':>9} {'p99 ms':>9} {'trips':>6}  vs baseline")
+    runs = [(name, lambda c=anonymous if name in ANONYMOUS else client, m=method, p=path, o=options:
+             run_case(c, counter, m, p, o, args.requests, args.warmup))
+            for name, method, path, options in cases]
+    runs.append(('utils.generate_receipt_pdf', lambda: run_receipt_pdf(app, counter, args.requests, args.warmup)))
+    for name, run in runs:
+        if args.only and args.only not in name:
+            continue
+        unsupported = next((reason for prefix, reason in MONGOMOCK_UNSUPPORTED.items()
+                            if name.startswith(prefix)), None)
+        if args.mongomock and unsupported:
+            print(f'{name:<42} skipped: mongomock has no {unsupported}')
+            continue
+        latencies, round_trips, error = run()
+        if error:
+            print(f'{name:<42} {error}')
+            continue
+        result = results[name] = summarize(latencies, round_trips)
+        note, regressed = compare(result, baseline.get(name), args.tolerance)
+        regressions += regressed
+        print(f"{name:<42} {result['requests']:>4} {result['p50_ms']:>9.2f} {result['p90_ms']:>9.2f} "
+              f"{result['p99_ms']:>9.2f} {result['round_trips']:>6}  {note}")
+
+    if args.save:
+        with open(args.baseline, 'w') as f:
+            json.dump({'created': datetime.now().isoformat(timespec='seconds'),
+                       'mongomock': args.mongomock, 'cases': results}, f, indent=2, sort_keys=True)
+        print(f'Saved baseline to {args.baseline}')
+    elif regressions:
+        print(f'{regressions} route(s) regressed')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,252 @@
+"""Synthetic school generator.
+
+Builds a school of a configurable size: students across classes 1-10,
+monthly fee records for the last --years years (up to the current month),
+and payments on them: most fees fully paid, some partly (in one to three
+payments), the rest unpaid, in cash or by QR. Fees are priced with the fee
+schedule in force, and the dashboard summary, student balances and
+collection rollups are rebuilt from the generated records.
+
+Run it against a scratch database, or in memory with --mongomock (needs
+`pip install mongomock`):
+
+    MONGO_URI=mongodb://localhost:27017/school_fee_bench python benchmarks/seed.py --students 2000 --drop
+"""
+import argparse
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+SECTIONS = 'ABCD'
+
+# Share of fees that are fully paid / partly paid; the rest are unpaid.
+# The current month has had less time to be paid.
+PAID_SHARE = 0.75
+PARTLY_PAID_SHARE = 0.12
+CURRENT_MONTH_PAID_SHARE = 0.35
+
+QR_SHARE = 0.4
+
+
+def use_mongomock():
+    # Points every mongoengine connection at mongomock clients sharing one
+    # in-memory server, so the reporting alias sees the same data. Must run
+    # before the app is created.
+    try:
+        import mongomock
+        from mongomock.store import ServerStore
+    except ImportError:
+        raise SystemExit('--mongomock requires mongomock (pip install mongomock)')
+    import mongoengine.connection
+    from mongomock.collection import BulkOperationBuilder
+
+    # mongomock 4.3 predates the sort argument pymongo 4.9+ passes on for
+    # UpdateOne/ReplaceOne in bulk_write; the app never sets it
+    for name in ('add_update', 'add_replace'):
+        def without_sort(self, *args, _original=getattr(BulkOperationBuilder, name), sort=None, **kwargs):
+            return _original(self, *args, **kwargs)
+        setattr(BulkOperationBuilder, name, without_sort)
+
+    register_connection = mongoengine.connection.register_connection
+    store = ServerStore()
+
+    def register(alias, *args, **kwargs):
+        kwargs.pop('tlsCAFile', None)
+        kwargs['mongo_client_class'] = mongomock.MongoClient
+        kwargs['_store'] = store
+        return register_connection(alias, *args, **kwargs)
+
+    mongoengine.connection.register_connection = register
+
+
+def _periods(years, today):
+    # (month, year) of every month from January years - 1 years ago up to now
+    return [(month, year) for year in range(today.year - years + 1, today.year + 1)
+            for month in range(1, 13) if (year, month) <= (today.year, today.month)]
+
+
+def _payments(rng, fee, period_start, current, admin_id, next_receipt):
+    # Payment documents on one fee; returns (payments, paid)
+    paid_share = CURRENT_MONTH_PAID_SHARE if current else PAID_SHARE
+    total = fee['total_fee']
+    roll = rng.random()
+    if roll < paid_share:
+        target = total
+    elif roll < paid_share + PARTLY_PAID_SHARE and total >= 200:
+        target = rng.randint(1, total // 100 - 1) * 100
+    else:
+        target = 0
+    # One to three payments of whole rupees, each at most half of what is left
+    amounts = []
+    remaining = target
+    for _ in range(rng.randint(0, 2)):
+        if remaining < 200:
+            break
+        amounts.append(rng.randint(1, remaining // 200) * 100)
+        remaining -= amounts[-1]
+    if remaining:
+        amounts.append(remaining)
+
+    payments = []
+    for amount in amounts:
+        method = 'qr' if rng.random() < QR_SHARE else 'cash'
+        payments.append({
+            'student': fee['student'],
+            'fee': fee['_id'],
+            'amount': amount,
+            'payment_date': period_start + timedelta(days=rng.randint(0, 27), hours=rng.randint(3, 11),
+                                                     minutes=rng.randint(0, 59)),
+            'receipt_number': next_receipt(),
+            'created_by': admin_id,
+            'payment_method': method,
+            'transaction_id': f'TXN{rng.getrandbits(40):013d}' if method == 'qr' else None,
+            'status': 'applied',
+        })
+    return payments, target
+
+
+def seed_school(students=1000, years=2, seed=1, batch_size=5000, progress=print):
+    # Generates the school in the current app's database. Returns the number
+    # of students, fees and payments written.
+    from bson import ObjectId
+    from application.models import Admin, Student, Fee, PaymentHistory, StudentBalance, CollectionRollup
+    from application.services import versions
+    from application.services.analytics import backfill_rollups
+    from application.services.balances import compute_balances
+    from application.services.bootstrap import create_default_admin
+    from application.services.dashboard import rebuild_summaries
+    from application.services.pricing import quote_fee
+
+    rng = random.Random(seed)
+    now = datetime.utcnow()
+    # Payments are recorded by the admin `flask bootstrap` creates
+    create_default_admin()
+    admin_id = Admin.objects.first().id
+    periods = _periods(years, now)
+
+    student_docs = []
+    for n in range(students):
+        student_docs.append({
+            '_id': ObjectId(),
+            'name': f'Student {n + 1}',
+            'roll_number': f'SEED{n + 1:06d}',
+            'class_name': str(n % 10 + 1),
+            'section': SECTIONS[n // 10 % len(SECTIONS)],
+            'contact': f'9{rng.randint(0, 10 ** 9 - 1):09d}',
+            'economic_status': 'Poor' if rng.random() < 0.2 else 'Normal',
+            'hostel_food_opted': rng.random() < 0.3,
+            'milk_opted': rng.random() < 0.4,
+            'created_at': now,
+            'updated_at': now,
+        })
+    for i in range(0, len(student_docs), batch_size):
+        Student._get_collection().insert_many(student_docs[i:i + batch_size], ordered=False)
+    progress(f'{len(student_docs)} students')
+
+    receipts = iter(range(1, 10 ** 9))
+
+    def next_receipt():
+        return f'SEED{next(receipts):010d}'
+
+    fees = payments = 0
+    fee_batch, payment_batch = [], []
+
+    def flush():
+        if fee_batch:
+            Fee._get_collection().insert_many(fee_batch, ordered=False)
+        if payment_batch:
+            PaymentHistory._get_collection().insert_many(payment_batch, ordered=False)
+        fee_batch.clear()
+        payment_batch.clear()
+
+    for month, year in periods:
+        period_start = datetime(year, month, 1)
+        current = (year, month) == (now.year, now.month)
+        for student in student_docs:
+            quote = quote_fee(student['class_name'], student['hostel_food_opted'], student['milk_opted'],
+                              student['economic_status'], str(year))
+            fee = {
+                '_id': ObjectId(),
+                'student': student['_id'],
+                'month': str(month),
+                'year': str(year),
+                'base_fee': quote['base_fee'],
+                'hostel_food_fee': quote['hostel_food_fee'],
+                'milk_fee': quote['milk_fee'],
+                'discount': quote['discount'],
+                'total_fee': quote['total'],
+                'created_at': period_start,
+                'updated_at': period_start,
+            }
+            fee_payments, paid = _payments(rng, fee, period_start, current, admin_id, next_receipt)
+            fee['paid_amount'] = paid
+            fee['applied_payments'] = [ObjectId() for _ in fee_payments]
+            for payment, payment_id in zip(fee_payments, fee['applied_payments']):
+                payment['_id'] = payment_id
+            fee_batch.append(fee)
+            payment_batch.extend(fee_payments)
+            fees += 1
+            payments += len(fee_payments)
+            if len(fee_batch) >= batch_size:
+                flush()
+        progress(f'{month}/{year}: {fees} fees, {payments} payments so far')
+    flush()
+
+    # Read models, rebuilt from the generated records
+    rebuild_summaries()
+    StudentBalance._get_collection().delete_many({})
+    balances = list(compute_balances().values())
+    for i in range(0, len(balances), batch_size):
+        StudentBalance._get_collection().insert_many(balances[i:i + batch_size], ordered=False)
+    if periods:
+        CollectionRollup._get_collection().delete_many({})
+        first_month, first_year = periods[0]
+        backfill_rollups(f'{first_year}-{first_month:02d}-01', now.strftime('%Y-%m-%d'))
+    versions.bump(versions.STUDENTS, versions.FEES)
+    progress('dashboard summary, balances and rollups rebuilt')
+    return {'students': len(student_docs), 'fees': fees, 'payments': payments}
+
+
+def drop_school():
+    # Removes every student, fee, payment and read model
+    from application.models import (
+        Student, Fee, PaymentHistory, DashboardSummary, StudentBalance, CollectionRollup
+    )
+    from application.services import versions
+
+    for document in (Student, Fee, PaymentHistory, DashboardSummary, StudentBalance, CollectionRollup):
+        document._get_collection().delete_many({})
+    versions.bump(versions.STUDENTS, versions.FEES)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--students', type=int, default=1000)
+    parser.add_argument('--years', type=int, default=2, help='years of monthly fees, up to the current month')
+    parser.add_argument('--seed', type=int, default=1, help='random seed; the same seed builds the same school')
+    parser.add_argument('--drop', action='store_true', help='remove existing students, fees and payments first')
+    parser.add_argument('--mongomock', action='store_true', help='use an in-memory database')
+    args = parser.parse_args()
+
+    if args.mongomock:
+        use_mongomock()
+    from application import create_app
+    from application.models import Student
+
+    with create_app().app_context():
+        if args.drop:
+            drop_school()
+        elif Student.objects.first():
+            raise SystemExit('the database already has students; use --drop to replace them')
+        started = time.perf_counter()
+        counts = seed_school(args.students, args.years, args.seed)
+        print(f"{counts['students']} students, {counts['fees']} fees and {counts['payments']} payments "
+              f'in {time.perf_counter() - started:.1f}s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+"""Worker startup benchmark.
+
+Measures how long a gunicorn-style worker takes from the fork to its first
+response, in both ways gunicorn can start workers:
+
+    cold     every worker imports the application and creates the app after
+             the fork (gunicorn's default)
+    preload  the app is created once before the fork (gunicorn --preload);
+             workers only open their MongoDB connection
+
+Each mode forks --workers processes at once, as gunicorn does, and every
+worker reports its import, create_app and first request times. The first
+request is a login attempt, so it includes the worker's first MongoDB query.
+
+    MONGO_URI=mongodb://localhost:27017/school_fee_bench python benchmarks/startup.py --workers 4
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+MODES = ('cold', 'preload')
+
+
+def create():
+    # (app, seconds spent importing the application, seconds in create_app)
+    started = time.perf_counter()
+    from application import create_app
+    imported = time.perf_counter()
+    app = create_app()
+    if not app.config.get('SECRET_KEY'):
+        app.config['SECRET_KEY'] = os.urandom(16)
+    return app, imported - started, time.perf_counter() - imported
+
+
+def first_request(app):
+    client = app.test_client()
+    started = time.perf_counter()
+    response = client.post('/login', data={'username': 'startup-benchmark', 'password': 'x'})
+    if response.status_code >= 500:
+        raise RuntimeError(f'first request failed with {response.status_code}')
+    return time.perf_counter() - started
+
+
+def worker(app, results):
+    forked = time.perf_counter()
+    timings = {'import': 0.0, 'create_app': 0.0}
+    try:
+        if app is None:
+            app, timings['import'], timings['create_app'] = create()
+        timings['first_request'] = first_request(app)
+    except Exception as e:
+        results.put({'error': repr(e)})
+        raise
+    timings['total'] = time.perf_counter() - forked
+    results.put(timings)
+
+
+def run_mode(mode, workers, mongomock):
+    # Runs in a fresh interpreter, so the cold workers start with nothing imported
+    if mongomock:
+        sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+        from seed import use_mongomock
+        use_mongomock()
+    master = {}
+    app = None
+    if mode == 'preload':
+        app, master['import'], master['create_app'] = create()
+
+    context = multiprocessing.get_context('fork')
+    results = context.Queue()
+    processes = [context.Process(target=worker, args=(app, results)) for _ in range(workers)]
+    for process in processes:
+        process.start()
+    timings = [results.get(timeout=120) for _ in processes]
+    for process in processes:
+        process.join()
+    errors = [timing['error'] for timing in timings if 'error' in timing]
+    if errors:
+        raise SystemExit(f'{mode}: {errors[0]}')
+    print(json.dumps({'master': master, 'workers': timings}))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--mongomock', action='store_true', help='use an in-memory database')
+    parser.add_argument('--mode', choices=MODES, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.mode:
+        run_mode(args.mode, args.workers, args.mongomock)
+        return
+
+    print(f"{'mode':<8} {'master ms':>10} {'import ms':>10} {'create ms':>10} {'request ms':>11} "
+          f"{'ready ms':>9} {'slowest':>8}")
+    for mode in MODES:
+        command = [sys.executable, os.path.abspath(__file__), '--mode', mode, '--workers', str(args.workers)]
+        if args.mongomock:
+            command.append('--mongomock')
+        process = subprocess.run(command, capture_output=True, text=True)
+        if process.returncode:
+            raise SystemExit(process.stderr.strip().splitlines()[-1])
+        result = json.loads(process.stdout.strip().splitlines()[-1])
+
+        def median(key):
+            return statistics.median(timing[key] for timing in result['workers']) * 1000
+
+        master = sum(result['master'].values()) * 1000
+        slowest = max(timing['total'] for timing in result['workers']) * 1000
+        print(f"{mode:<8} {master:>10.1f} {median('import'):>10.1f} {median('create_app'):>10.1f} "
+              f"{median('first_request'):>11.1f} {median('total'):>9.1f} {slowest:>8.1f}")
+    print('Worker columns are medians over the workers; ready is fork to first response.')
+
+
+if __name__ == '__main__':
+    main()
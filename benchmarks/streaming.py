@@ -0,0 +1,86 @@
+"""Streamed vs whole rendering of the student list and fee grid.
+
+Requests each page with STREAM_TEMPLATES off and on. For each mode it
+reports the time to the first byte of the body, the time to the last byte,
+and the peak memory traced while serving the request. Run it against a
+database seeded with benchmarks/seed.py, or in memory with --mongomock:
+
+    MONGO_URI=mongodb://localhost:27017/school_fee_bench python benchmarks/streaming.py
+    python benchmarks/streaming.py --mongomock --students 5000
+"""
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+PAGES = ('/student/', '/fee/')
+
+
+def measure(client, path):
+    # (ms to first byte, ms to last byte, bytes, peak traced KiB)
+    tracemalloc.start()
+    started = time.perf_counter()
+    response = client.get(path, buffered=False)
+    if response.status_code != 200:
+        tracemalloc.stop()
+        raise RuntimeError(f'{path} answered {response.status_code}')
+    chunks = iter(response.response)
+    size = len(next(chunks, b''))
+    first = time.perf_counter() - started
+    for chunk in chunks:
+        size += len(chunk)
+    last = time.perf_counter() - started
+    response.close()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return first * 1000, last * 1000, size, peak / 1024
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--requests', type=int, default=5, help='requests per page and mode; the best is kept')
+    parser.add_argument('--username', default='admin')
+    parser.add_argument('--password', default='admin123')
+    parser.add_argument('--mongomock', action='store_true', help='use an in-memory database, seeded each run')
+    parser.add_argument('--students', type=int, default=2000, help='students seeded with --mongomock')
+    args = parser.parse_args()
+
+    if args.mongomock:
+        from seed import use_mongomock
+        use_mongomock()
+    from application import create_app
+    app = create_app()
+    if not app.config.get('SECRET_KEY'):
+        app.config['SECRET_KEY'] = os.urandom(16)
+    if args.mongomock:
+        from seed import seed_school
+        with app.app_context():
+            seed_school(args.students, years=1, progress=lambda message: None)
+
+    client = app.test_client()
+    response = client.post('/login', data={'username': args.username, 'password': args.password})
+    if response.status_code != 302:
+        raise SystemExit(f'could not log in as {args.username}')
+
+    print(f"{'page':<12} {'mode':<8} {'first byte ms':>14} {'last byte ms':>13} {'KiB sent':>9} {'peak KiB':>9}")
+    for path in PAGES:
+        for stream in (False, True):
+            app.config['STREAM_TEMPLATES'] = stream
+            try:
+                runs = [measure(client, path) for _ in range(args.requests)]
+            except Exception as e:
+                # e.g. a query mongomock does not implement
+                print(f"{path:<12} {'stream' if stream else 'whole':<8} failed: {e!r:.80}")
+                continue
+            first = min(run[0] for run in runs)
+            last = min(run[1] for run in runs)
+            peak = min(run[3] for run in runs)
+            print(f"{path:<12} {'stream' if stream else 'whole':<8} {first:>14.1f} {last:>13.1f} "
+                  f"{runs[0][2] / 1024:>9.0f} {peak:>9.0f}")
+
+
+if __name__ == '__main__':
+    main()
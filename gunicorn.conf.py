@@ -0,0 +1,44 @@
+# Picked up by gunicorn from the working directory (see Procfile).
+import glob
+import os
+import tempfile
+import time
+
+# Workers share their request metrics through files in METRICS_DIR, so that
+# /admin/metrics covers all of them. Set here, before --preload builds the app.
+if 'METRICS_DIR' not in os.environ:
+    os.environ['METRICS_DIR'] = tempfile.mkdtemp(prefix='school-fee-metrics-')
+
+
+def on_starting(server):
+    # Metrics of an earlier run in the same METRICS_DIR start over
+    for path in glob.glob(os.path.join(os.environ['METRICS_DIR'], '*.json')):
+        os.remove(path)
+
+# Writes buffered audit entries before a worker goes away; atexit covers
+# normal interpreter shutdown, these hooks cover worker restarts and signals.
+
+
+def _flush_audit_log():
+    from application.services import audit
+    audit.flush()
+
+
+def post_fork(server, worker):
+    # Time to first request is measured from here (see /admin/metrics).
+    # Taken before the import, which is the app's own startup without --preload.
+    started = time.monotonic()
+    from application.services import metrics
+    metrics.worker_forked(started)
+
+
+def worker_int(worker):
+    _flush_audit_log()
+
+
+def worker_abort(worker):
+    _flush_audit_log()
+
+
+def worker_exit(server, worker):
+    _flush_audit_log()
@@ -0,0 +1,103 @@
+import os
+import pytest
+from pymongo import MongoClient
+from pymongo.errors import PyMongoError
+
+# Tests run against TEST_MONGO_URI (a single node or a replica set) when a
+# mongod answers there, and against mongomock otherwise. Tests that need the
+# server itself (query plans, transactions, concurrent updates) take the
+# mongod fixture and are skipped on mongomock. The database is dropped
+# before each test.
+TEST_MONGO_URI = os.getenv('TEST_MONGO_URI', 'mongodb://localhost:27017/school_fee_test')
+
+
+def _reachable(uri):
+    client = MongoClient(uri, serverSelectionTimeoutMS=1000)
+    try:
+        client.admin.command('ping')
+        return True
+    except PyMongoError:
+        return False
+    finally:
+        client.close()
+
+
+def _patch_mongomock(monkeypatch):
+    # mongomock 4.3 predates the sort argument pymongo 4.9+ passes on for
+    # UpdateOne/ReplaceOne in bulk_write; the app never sets it
+    from mongomock.collection import BulkOperationBuilder
+
+    for name in ('add_update', 'add_replace'):
+        def without_sort(self, *args, _original=getattr(BulkOperationBuilder, name), sort=None, **kwargs):
+            return _original(self, *args, **kwargs)
+        monkeypatch.setattr(BulkOperationBuilder, name, without_sort)
+
+
+def _mongomock_settings(connection_settings):
+    # Both connection aliases on one in-memory mongomock server
+    import mongomock
+    from mongomock.store import ServerStore
+
+    store = ServerStore()
+
+    def settings():
+        aliases = connection_settings()
+        for alias in aliases:
+            alias.pop('tlsCAFile', None)
+            alias.update(mongo_client_class=mongomock.MongoClient, _store=store)
+        return aliases
+    return settings
+
+
+@pytest.fixture(scope='session')
+def live():
+    return _reachable(TEST_MONGO_URI)
+
+
+@pytest.fixture(scope='session')
+def app(live, tmp_path_factory):
+    # One app per session: mongoengine registers connection aliases globally
+    os.environ['MONGO_URI'] = TEST_MONGO_URI
+    os.environ.pop('MONGO_REPORTING_URI', None)
+    # Audit entries written as they are recorded, no background flusher
+    os.environ['AUDIT_BUFFER_SIZE'] = '0'
+    os.environ['RECEIPT_CACHE_DIR'] = str(tmp_path_factory.mktemp('receipts'))
+    from application import create_app
+    from application.services import connections
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        if not live:
+            _patch_mongomock(monkeypatch)
+            monkeypatch.setattr(connections, 'connection_settings',
+                                _mongomock_settings(connections.connection_settings))
+        app = create_app()
+        app.config.update(TESTING=True, SECRET_KEY='test')
+        with app.app_context():
+            yield app
+
+
+@pytest.fixture(scope='session')
+def mongod(live):
+    if not live:
+        pytest.skip(f'needs a mongod at {TEST_MONGO_URI}')
+
+
+@pytest.fixture
+def db(app):
+    from mongoengine.connection import get_db
+    database = get_db()
+    database.client.drop_database(database.name)
+    yield database
+    database.client.drop_database(database.name)
+
+
+@pytest.fixture
+def client(app, db):
+    # A test client logged in as an admin
+    from application.models import Admin
+    admin = Admin(username='admin', email='admin@school.com')
+    admin.set_password('secret')
+    admin.save()
+    client = app.test_client()
+    response = client.post('/login', data={'username': 'admin', 'password': 'secret'})
+    assert response.status_code == 302
+    return client
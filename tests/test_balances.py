@@ -0,0 +1,61 @@
+import uuid
+import pytest
+from application.models import Admin, DashboardSummary, Student, Fee, PaymentHistory, StudentBalance
+from application.services import balances, dashboard
+from application.services.payments import apply_payment
+
+
+@pytest.fixture
+def paid_fee(db):
+    # A fee with one payment applied, whose balances.payment_added job has
+    # not run yet
+    admin = Admin(username='cashier', email='cashier@school.com')
+    admin.set_password('secret')
+    admin.save()
+    student = Student(name='Asha', roll_number='R001', class_name='5', section='A', contact='9999999999',
+                      economic_status='Normal').save()
+    fee = Fee(student=student, month='4', year='2025', base_fee=20000, total_fee=20000).save()
+    payment = PaymentHistory(student=student, fee=fee, amount=5000, created_by=admin,
+                             receipt_number=f'T{uuid.uuid4().hex[:16]}')
+    apply_payment(payment)
+    return fee, payment
+
+
+def test_rebuild_computes_balances(paid_fee):
+    fee, payment = paid_fee
+    drift = balances.rebuild_balances()
+    assert drift == [('R001', 'outstanding', 0, 15000)]
+    balance = StudentBalance._get_collection().find_one({'student': fee.student.id})
+    assert (balance['billed'], balance['paid'], balance['outstanding']) == (20000, 5000, 15000)
+    assert balance['periods'] == {'2025-04': 15000}
+    assert balances.rebuild_balances() == []
+
+
+def test_a_job_run_after_a_rebuild_does_not_count_again(paid_fee):
+    fee, payment = paid_fee
+    balances.rebuild_balances()
+    balances.payment_added(str(fee.student.id), '2025-04', payment.amount, str(payment.id))
+    balance = StudentBalance._get_collection().find_one({'student': fee.student.id})
+    assert (balance['paid'], balance['outstanding']) == (5000, 15000)
+    assert balance['counted_payments'] == [payment.id]
+
+
+def test_defaulter_totals_come_from_the_summaries(paid_fee):
+    fee, payment = paid_fee
+    balances.rebuild_balances()
+    student = Student(name='Ravi', roll_number='R002', class_name='6', section='A', contact='9999999998',
+                      economic_status='Poor').save()
+    Fee(student=student, month='4', year='2025', base_fee=30000, total_fee=30000).save()
+    balances.rebuild_balances()
+    totals = {'students': 2, 'billed': 50000, 'paid': 5000, 'outstanding': 45000}
+    assert balances.defaulters()[1] == totals
+    assert balances.defaulters(class_name='6')[1] == {'students': 1, 'billed': 30000, 'paid': 0,
+                                                      'outstanding': 30000}
+    assert balances.defaulters(class_name='6', economic_status='Normal')[1]['students'] == 0
+    assert balances.defaulters(min_outstanding=20000)[1]['students'] == 1
+
+    # Read from the summaries, which a dashboard rebuild leaves alone
+    StudentBalance.objects(student=student).delete()
+    dashboard.rebuild_summaries()
+    assert balances.defaulters()[1] == totals
+    assert DashboardSummary.objects(scope=balances.TOTALS_SCOPE, key=balances.ALL_DEFAULTERS).count() == 1
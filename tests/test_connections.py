@@ -0,0 +1,126 @@
+from datetime import datetime, timedelta
+import pytest
+from mongoengine import connection as mongoengine_connection
+from mongoengine.base import _document_registry
+from pymongo.read_preferences import SecondaryPreferred
+from application.models import Admin, AuditLog, Fee, PaymentHistory, Student
+from application.services import analytics, audit_archive, balances, dashboard, export
+from application.services.connections import (DEFAULT, MIN_MAX_STALENESS, REPORTING, REPORTING_POOL_SIZE,
+                                              connection_settings)
+
+
+def test_reporting_settings_default_to_the_primary_uri(monkeypatch):
+    monkeypatch.setenv('MONGO_URI', 'mongodb://primary.example:27017/school')
+    monkeypatch.delenv('MONGO_REPORTING_URI', raising=False)
+    monkeypatch.delenv('MONGO_REPORTING_MAX_STALENESS', raising=False)
+    default, reporting = connection_settings()
+    assert default['alias'] == DEFAULT
+    assert reporting['alias'] == REPORTING
+    assert reporting['host'] == default['host'] == 'mongodb://primary.example:27017/school'
+    assert reporting['read_preference'] == SecondaryPreferred(max_staleness=MIN_MAX_STALENESS)
+    assert reporting['maxPoolSize'] == REPORTING_POOL_SIZE
+    assert 'read_preference' not in default
+
+
+def test_reporting_settings_from_the_environment(monkeypatch):
+    monkeypatch.setenv('MONGO_REPORTING_URI', 'mongodb://analytics.example:27017/school')
+    monkeypatch.setenv('MONGO_REPORTING_MAX_STALENESS', '300')
+    monkeypatch.setenv('MONGO_REPORTING_MAX_POOL_SIZE', '3')
+    reporting = connection_settings()[1]
+    assert reporting['host'] == 'mongodb://analytics.example:27017/school'
+    assert reporting['read_preference'] == SecondaryPreferred(max_staleness=300)
+    assert reporting['maxPoolSize'] == 3
+
+    monkeypatch.setenv('MONGO_REPORTING_MAX_STALENESS', str(MIN_MAX_STALENESS - 1))
+    with pytest.raises(ValueError):
+        connection_settings()
+
+
+def test_reporting_alias_reads_from_the_primary_of_a_single_node(db, live):
+    reporting = mongoengine_connection.get_db(REPORTING)
+    assert reporting.client is not db.client
+    assert reporting.client.read_preference == SecondaryPreferred(max_staleness=MIN_MAX_STALENESS)
+    if live and reporting.client.topology_description.topology_type_name != 'Single':
+        pytest.skip('TEST_MONGO_URI is a replica set')
+    student = Student(name='Asha', roll_number='R001', class_name='5', section='A', contact='9999999999',
+                      economic_status='Normal').save()
+    assert Student.objects.using(REPORTING).get(pk=student.id).roll_number == 'R001'
+
+
+READS = ('find', 'find_one', 'aggregate', 'count_documents', 'estimated_document_count', 'distinct')
+
+
+class RecordingCollection:
+    def __init__(self, collection, reads):
+        self._collection = collection
+        self._reads = reads
+
+    def __getattr__(self, name):
+        if name in READS:
+            self._reads.add(self._collection.name)
+        return getattr(self._collection, name)
+
+
+class RecordingDatabase:
+    # A connection alias' database that notes the collections read through it
+    def __init__(self, database):
+        self._database = database
+        self.collections = set()
+
+    def __getitem__(self, name):
+        return RecordingCollection(self._database[name], self.collections)
+
+    def get_collection(self, name, *args, **kwargs):
+        return RecordingCollection(self._database.get_collection(name, *args, **kwargs), self.collections)
+
+    def __getattr__(self, name):
+        return getattr(self._database, name)
+
+
+def _forget_collections(monkeypatch):
+    # Collections cached on the documents were taken from other databases
+    for document in _document_registry.values():
+        if getattr(document, '_collection', None) is not None:
+            monkeypatch.setattr(document, '_collection', None)
+
+
+@pytest.fixture
+def recorders(db, monkeypatch):
+    recorders = {}
+    for alias in (DEFAULT, REPORTING):
+        recorders[alias] = RecordingDatabase(mongoengine_connection.get_db(alias))
+        monkeypatch.setitem(mongoengine_connection._dbs, alias, recorders[alias])
+    _forget_collections(monkeypatch)
+    return recorders
+
+
+def _report_data():
+    admin = Admin(username='cashier', email='cashier@school.com')
+    admin.set_password('secret')
+    admin.save()
+    student = Student(name='Asha', roll_number='R001', class_name='5', section='A', contact='9999999999',
+                      economic_status='Normal').save()
+    fee = Fee(student=student, month='4', year='2025', base_fee=20000, total_fee=20000).save()
+    PaymentHistory(student=student, fee=fee, amount=5000, created_by=admin, receipt_number='R-1',
+                   payment_date=datetime.utcnow()).save()
+    AuditLog(admin=admin, action='add_payment', details='R-1').save()
+
+
+@pytest.mark.parametrize('report, collections', [
+    (lambda: dashboard.load_summary('2025'), {'dashboard_summary'}),
+    (lambda: balances.defaulters(), {'student_balances', 'dashboard_summary'}),
+    (lambda: analytics.collection_series(*analytics.default_range()), {'collection_rollups'}),
+    (lambda: audit_archive.search(), {'audit_log', 'audit_archive'}),
+    (lambda: audit_archive.actions(), {'audit_log', 'audit_archive'}),
+    (lambda: list(export.fee_ledger_rows('2025', class_name='5')), {'fee', 'student'}),
+    (lambda: list(export.payment_history_rows(datetime.utcnow() - timedelta(days=1),
+                                              datetime.utcnow() + timedelta(days=1))),
+     {'payment_history', 'student', 'admin'}),
+], ids=['dashboard', 'defaulters', 'analytics', 'audit search', 'audit actions', 'fee ledger', 'payment history'])
+def test_reports_read_through_the_reporting_alias(recorders, report, collections, monkeypatch):
+    _report_data()
+    _forget_collections(monkeypatch)
+    recorders[DEFAULT].collections.clear()
+    report()
+    assert collections <= recorders[REPORTING].collections
+    assert collections & recorders[DEFAULT].collections == set()
@@ -0,0 +1,27 @@
+from application.services.indexes import INDEXED_DOCUMENTS, explain_hot_queries, index_report, sync_indexes
+
+
+def test_sync_creates_every_declared_index(db):
+    assert sync_indexes() == {}
+    missing = {entry['collection']: entry['missing'] for entry in index_report() if entry['missing']}
+    assert missing == {}
+
+
+def test_unique_indexes_are_unique(db):
+    # Upserts keyed on these fields rely on the server refusing a duplicate
+    sync_indexes()
+    for document in INDEXED_DOCUMENTS:
+        declared = [spec for spec in document._meta['index_specs'] if spec.get('unique')]
+        built = document._get_collection().index_information()
+        for spec in declared:
+            index = next(index for index in built.values() if index['key'] == spec['fields'])
+            assert index.get('unique'), (document.__name__, spec['fields'])
+
+
+def test_hot_queries_use_an_index(db, mongod):
+    assert sync_indexes() == {}
+    plans = explain_hot_queries()
+    assert plans
+    not_indexed = {name: stages for name, stages in plans.items()
+                   if stages is None or 'COLLSCAN' in stages or 'IXSCAN' not in stages}
+    assert not_indexed == {}
@@ -0,0 +1,25 @@
+from bson import ObjectId
+from application.models import DashboardSummary
+from application.services import dashboard
+from application.services.jobs import inc_once
+
+
+def test_a_retried_count_is_skipped_without_synced_indexes(db):
+    # No `flask indexes sync`: inc_once builds the unique key index itself
+    payment_id = ObjectId()
+    dashboard.payment_added('2025', 5000, str(payment_id))
+    dashboard.payment_added('2025', 5000, str(payment_id))
+    dashboard.payment_added('2025', 700, str(ObjectId()))
+    summaries = list(DashboardSummary._get_collection().find({'scope': 'year', 'key': '2025'}))
+    assert len(summaries) == 1
+    assert summaries[0]['collected_fees'] == 5700
+
+
+def test_inc_once_reports_whether_it_counted(db):
+    collection = db['inc_once_test']
+    payment_id = ObjectId()
+    update = {'$inc': {'total': 1}}
+    assert inc_once(collection, {'key': 'a'}, payment_id, update) is True
+    assert inc_once(collection, {'key': 'a'}, payment_id, update) is False
+    assert collection.find_one({'key': 'a'})['total'] == 1
+    assert collection.index_information()['key_1'].get('unique')
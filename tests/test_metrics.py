@@ -0,0 +1,9 @@
+from application.services.metrics import RequestStats, Registry
+
+
+def test_label_values_are_escaped():
+    registry = Registry()
+    registry.observe('fee.receipt', 'GET', 200, 0.01, RequestStats(), slow=False)
+    text = registry.render(gauges=[('cache_entries', 'Entries.', [({'name': 'a\\b "c"\nd'}, 1)])])
+    assert 'cache_entries{name="a\\\\b \\"c\\"\\nd"} 1' in text
+    assert 'http_requests_total{endpoint="fee.receipt",method="GET",status="200"} 1' in text
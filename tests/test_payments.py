@@ -0,0 +1,122 @@
+import random
+import threading
+import uuid
+from datetime import datetime, timedelta
+import pytest
+from application.models import Admin, Student, Fee, PaymentHistory
+from application.services.payments import PaymentError, _apply_to_fee, apply_payment, recover_pending_payments
+
+TOTAL_FEE = 20000  # paise; the threads below try to pay several times this
+THREADS = 8
+PAYMENTS_PER_THREAD = 15
+
+
+@pytest.fixture
+def fee(db):
+    admin = Admin(username='cashier', email='cashier@school.com')
+    admin.set_password('secret')
+    admin.save()
+    student = Student(name='Asha', roll_number='R001', class_name='5', section='A', contact='9999999999',
+                      economic_status='Normal').save()
+    return Fee(student=student, month='4', year='2025', base_fee=TOTAL_FEE, total_fee=TOTAL_FEE).save()
+
+
+def _payment(fee, amount, **fields):
+    return PaymentHistory(student=fee.student, fee=fee, amount=amount, created_by=Admin.objects.first(),
+                          receipt_number=f'T{uuid.uuid4().hex[:16]}', **fields)
+
+
+def _interrupted(fee, amount, applied):
+    # A payment written as pending by a worker that died before marking it
+    # applied: before the fee update, or after it
+    payment = _payment(fee, amount, status='pending', payment_date=datetime.utcnow() - timedelta(hours=1))
+    payment.save()
+    if applied:
+        Fee._get_collection().update_one(
+            {'_id': fee.id}, {'$inc': {'paid_amount': amount}, '$push': {'applied_payments': payment.id}})
+    return payment
+
+
+def test_payment_is_applied_once(fee):
+    payment = _payment(fee, 5000)
+    updated = apply_payment(payment)
+    assert updated['paid_amount'] == 5000
+    assert PaymentHistory.objects(pk=payment.id).first().status == 'applied'
+    # A retried fee update of the same payment changes nothing
+    assert _apply_to_fee(fee.id, payment.id, payment.amount) is None
+    fee.reload()
+    assert fee.paid_amount == 5000
+    assert fee.applied_payments == [payment.id]
+
+
+def test_overpayment_is_rejected(fee):
+    apply_payment(_payment(fee, TOTAL_FEE - 1000))
+    with pytest.raises(PaymentError, match='exceeds remaining fee'):
+        apply_payment(_payment(fee, 1001))
+    fee.reload()
+    assert fee.paid_amount == TOTAL_FEE - 1000
+    # The rejected payment is not left behind, pending or otherwise
+    assert PaymentHistory.objects(fee=fee.id).count() == 1
+    apply_payment(_payment(fee, 1000))
+    fee.reload()
+    assert fee.paid_amount == TOTAL_FEE
+
+
+def test_recovery_settles_interrupted_payments(fee):
+    settled = _interrupted(fee, 300, applied=True)
+    abandoned = _interrupted(fee, 400, applied=False)
+    recent = _interrupted(fee, 500, applied=False)
+    recent.update(set__payment_date=datetime.utcnow())
+
+    assert recover_pending_payments(timedelta(minutes=5)) == (1, 1)
+    assert PaymentHistory.objects(pk=settled.id).first().status == 'applied'
+    assert PaymentHistory.objects(pk=abandoned.id).first() is None
+    # Possibly still being recorded: left alone
+    assert PaymentHistory.objects(pk=recent.id).first().status == 'pending'
+    fee.reload()
+    assert fee.paid_amount == 300
+
+
+@pytest.mark.parametrize('transactions', ['off', 'auto'])
+def test_concurrent_payments_on_one_fee(app, fee, transactions, monkeypatch, mongod):
+    # Needs a server: mongomock does not make the conditional update atomic
+    # across threads. 'auto' uses transactions when TEST_MONGO_URI is a
+    # replica set.
+    monkeypatch.setitem(app.config, 'PAYMENT_TRANSACTIONS', transactions)
+    settled = _interrupted(fee, 300, applied=True)
+    abandoned = _interrupted(fee, 400, applied=False)
+    errors = []
+
+    def pay():
+        try:
+            with app.app_context():
+                for _ in range(PAYMENTS_PER_THREAD):
+                    try:
+                        apply_payment(_payment(fee, random.randint(100, 700)))
+                    except PaymentError:
+                        pass
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=pay) for _ in range(THREADS)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+
+    assert recover_pending_payments(timedelta(minutes=5)) == (1, 1)
+    assert PaymentHistory.objects(status='pending').count() == 0
+    assert PaymentHistory.objects(pk=settled.id).first().status == 'applied'
+    assert PaymentHistory.objects(pk=abandoned.id).first() is None
+
+    fee.reload()
+    payments = list(PaymentHistory.objects(fee=fee.id))
+    # No lost update, no overpayment
+    assert fee.paid_amount == sum(payment.amount for payment in payments)
+    assert fee.paid_amount <= TOTAL_FEE
+    # Each stored payment applied exactly once
+    assert len(fee.applied_payments) == len(set(fee.applied_payments))
+    assert sorted(fee.applied_payments) == sorted(payment.id for payment in payments)
+    # More was offered than the fee could take, so it was paid close to full
+    assert fee.paid_amount > TOTAL_FEE - 700
@@ -0,0 +1,67 @@
+import time
+import uuid
+import pytest
+from bson import ObjectId
+from application.models import Admin, AuditLog, Fee, PaymentHistory, Student
+from application.services.payments import apply_payment
+
+
+def test_receipt_status_answers_at_once(client):
+    started = time.monotonic()
+    response = client.get(f'/fee/receipt/{ObjectId()}/status?wait=5')
+    assert time.monotonic() - started < 1
+    assert response.status_code == 200
+    assert response.json['ready'] is False
+
+
+def test_documents_reject_a_malformed_payment_id(client):
+    response = client.get(f'/export/documents?kind=receipts&ids={ObjectId()},not-an-id')
+    assert response.status_code == 400
+    assert 'ids' in response.json['error']
+
+
+@pytest.fixture
+def strict_references(app, monkeypatch):
+    # Any reference dereferenced one document at a time fails the request
+    # with NPlusOneError (raised through the test client, as TESTING is on)
+    monkeypatch.setitem(app.config, 'REFERENCE_LAZY_LOAD_LIMIT', 0)
+
+
+def _payments(count):
+    # count payments on one fee each, recorded by count different admins
+    payments = []
+    for i in range(count):
+        admin = Admin(username=f'cashier{i}', email=f'cashier{i}@school.com')
+        admin.set_password('secret')
+        admin.save()
+        student = Student(name=f'Student {i}', roll_number=f'R{i:03d}', class_name='5', section='A',
+                          contact='9999999999', economic_status='Normal').save()
+        fee = Fee(student=student, month='4', year='2025', base_fee=20000, total_fee=20000).save()
+        payment = PaymentHistory(student=student, fee=fee, amount=5000, created_by=admin,
+                                 receipt_number=f'T{uuid.uuid4().hex[:16]}')
+        apply_payment(payment)
+        AuditLog(admin=admin, action='add_payment', details=payment.receipt_number).save()
+        payments.append(payment)
+    return payments
+
+
+def test_dashboard_resolves_log_admins(client, strict_references):
+    _payments(4)
+    response = client.get('/dashboard')
+    assert response.status_code == 200
+    assert b'cashier3' in response.data
+
+
+def test_receipt_resolves_its_references(client, strict_references):
+    payment = _payments(1)[0]
+    response = client.get(f'/fee/receipt/{payment.id}')
+    assert response.status_code == 200
+    assert response.mimetype == 'application/pdf'
+
+
+def test_fee_grid_makes_no_lazy_loads(client, strict_references, mongod):
+    # The grid's $lookup uses let, which mongomock does not implement
+    _payments(4)
+    response = client.get('/fee/?month=4&year=2025')
+    assert response.status_code == 200
+    assert b'R003' in response.get_data()